@@ -1,9 +1,10 @@
 from datetime import timedelta
 
-from django.db.models import DateTimeField, OuterRef, Q, Subquery
+from django.conf import settings
+from django.db.models import Q
 from django.utils import timezone
 
-from apps.gps_devices.models import Device, LocationData
+from apps.gps_devices.models import Device
 
 
 def admin_dashboard_stats(request):
@@ -24,18 +25,10 @@ def admin_dashboard_stats(request):
 
     active_devices = active_qs.count()
 
-    latest_seen_subquery = (
-        LocationData.objects.filter(device_id=OuterRef('pk'))
-        .order_by('-created_at')
-        .values('created_at')[:1]
-    )
-
-    online_cutoff = now - timedelta(minutes=10)
-    online_devices = (
-        active_qs.annotate(last_seen=Subquery(latest_seen_subquery, output_field=DateTimeField()))
-        .filter(last_seen__gte=online_cutoff)
-        .count()
-    )
+    # Precomputed by the receiver (DevicePresence); the cutoff covers a receiver that is down
+    silence = (getattr(settings, 'GPS_OFFLINE_AFTER_SECONDS', 600) or 600) + getattr(settings, 'GPS_PRESENCE_FLUSH_INTERVAL', 30)
+    online_cutoff = now - timedelta(seconds=silence)
+    online_devices = active_qs.filter(presence__online=True, presence__last_seen_at__gte=online_cutoff).count()
 
     expiring_cutoff = now + timedelta(days=7)
     expiring_devices = active_qs.filter(expires_at__isnull=False, expires_at__lte=expiring_cutoff).count()
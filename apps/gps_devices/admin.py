@@ -132,7 +132,7 @@ class RawGpsDataAdmin(admin.ModelAdmin):
 
     def _decode_rawgps(self, raw_packet: str):
         decoder = HQFullDecoder()
-        decoded = decoder.decode(raw_packet)
+        decoded = decoder.resolve_lbs(decoder.decode(raw_packet))
 
         device_id = decoded.get('imei') or decoded.get('device_id')
         parsed = {
@@ -7,5 +7,4 @@ class GpsDevicesConfig(AppConfig):
     verbose_name = 'دستگاه‌های GPS'
 
     def ready(self):
-        # import apps.gps_devices.signals
-        pass
+        import apps.gps_devices.signals  # noqa: F401
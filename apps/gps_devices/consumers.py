@@ -11,7 +11,7 @@ class DeviceUpdateConsumer(AsyncWebsocketConsumer):
     - Joins groups:
         * user_group_{user.id}  --> for normal users
         * admins_group          --> if user.is_staff or user.is_superuser
-    - Receives "device_update" events from channel layer and forwards to client.
+    - Receives "device_update" events (and batched "device_updates") from channel layer and forwards to client.
     """
     async def connect(self):
         # Try to get token from query string
@@ -160,6 +160,15 @@ class DeviceUpdateConsumer(AsyncWebsocketConsumer):
             "timestamp": event.get("timestamp")
         }))
 
+    async def device_updates(self, event):
+        # batch from the GPS receiver broadcaster: latest update per device
+        updates = event.get("data") or []
+        await self.send(text_data=json.dumps({
+            "type": "device_updates",
+            "data": updates,
+            "timestamp": event.get("timestamp")
+        }))
+
     async def device_assignment(self, event):
         payload = event.get("data") or {}
         await self.send(text_data=json.dumps({
@@ -16,10 +16,12 @@ from __future__ import annotations
 import json
 import os
 import re
+from collections.abc import Mapping
 from typing import Optional, Dict, Any, Callable
-from functools import lru_cache
 from datetime import datetime, timezone
 
+from .batch import BatchDecodeMixin
+
 # network requests
 try:
     import requests
@@ -84,41 +86,10 @@ def parse_flags_from_hex(hex_str, byteorder='little'):
     """
     Parse a hex string like 'fbfffbff' into 32 boolean bits.
     byteorder: 'little' or 'big' — default 'little' (common in many text trackers).
-    Returns integer value and dict bits.
+    Returns integer value and the bits as HQFlags (a read-only bit -> dict mapping).
     """
-    try:
-        # Clean: remove non-hex
-        cleaned = re.sub(r'[^0-9a-fA-F]', '', str(hex_str))
-        # ensure even-length
-        if len(cleaned) % 2 == 1:
-            cleaned = '0' + cleaned
-        b = bytes.fromhex(cleaned)
-        # pad or trim to 4 bytes
-        if len(b) < 4:
-            b = b.ljust(4, b'\x00')
-        elif len(b) > 4:
-            b = b[:4]
-        if byteorder == 'little':
-            value = int.from_bytes(b, 'little')
-        else:
-            value = int.from_bytes(b, 'big')
-        bits = {}
-        for bit in range(32):
-            bit_val = (value >> bit) & 1
-            meta = FLAGS_MAP.get(bit, {"name": f"bit_{bit}", "desc":"Unknown/reserved", "notes":""})
-            bits[bit] = {
-                "bit": bit,
-                "value": bool(bit_val),
-                "name": meta.get("name"),
-                "desc": meta.get("desc"),
-                "notes": meta.get("notes", "")
-            }
-        return value, bits
-    except Exception:
-        # fallback: all zero
-        bits = {bit: {"bit": bit, "value": False, "name": FLAGS_MAP.get(bit, {}).get("name", f"bit_{bit}"),
-                      "desc": FLAGS_MAP.get(bit, {}).get("desc",""), "notes":""} for bit in range(32)}
-        return 0, bits
+    flags = HQFlags.from_hex(hex_str, byteorder)
+    return flags.value, flags
 
 
 # ---------- Flags map (bits 0..31) ----------
@@ -159,17 +130,107 @@ FLAGS_MAP = {
     31: {"name":"reserved_31", "desc":"Reserved / vendor specific", "notes":""},
 }
 
+
+class HQFlags(Mapping):
+    """
+    The 32 status bits of a packet, kept as one int.
+
+    Decoding only needs a few bits (ACC, SOS), so the verbose per-bit dicts
+    with FLAGS_MAP metadata are built on demand: ``flags[bit]`` /
+    ``items()`` / ``expand()`` give the same {"bit", "value", "name", "desc",
+    "notes"} dicts as before, for admin and debug output.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value: int = 0):
+        self.value = value
+
+    @classmethod
+    def from_hex(cls, hex_str, byteorder: str = 'little') -> "HQFlags":
+        """Flags from 4 hex-encoded bytes; other lengths are padded/trimmed, garbage gives 0."""
+        if isinstance(hex_str, str) and len(hex_str) == 8:
+            # Common case: exactly 4 bytes of hex
+            try:
+                return cls(int.from_bytes(bytes.fromhex(hex_str), byteorder))
+            except ValueError:
+                pass
+        try:
+            # Clean: remove non-hex
+            cleaned = re.sub(r'[^0-9a-fA-F]', '', str(hex_str))
+            # ensure even-length
+            if len(cleaned) % 2 == 1:
+                cleaned = '0' + cleaned
+            # pad or trim to 4 bytes
+            b = bytes.fromhex(cleaned)[:4].ljust(4, b'\x00')
+            return cls(int.from_bytes(b, 'little' if byteorder == 'little' else 'big'))
+        except Exception:
+            # fallback: all zero
+            return cls(0)
+
+    def bit(self, bit: int) -> bool:
+        return bool((self.value >> bit) & 1)
+
+    def active(self) -> list:
+        """Indexes of the bits that are set."""
+        value = self.value
+        return [bit for bit in range(32) if (value >> bit) & 1]
+
+    def active_names(self) -> list:
+        return [FLAGS_MAP.get(bit, {}).get("name", f"bit_{bit}") for bit in self.active()]
+
+    def expand(self) -> Dict[int, Dict[str, Any]]:
+        """The verbose bit -> {"bit", "value", "name", "desc", "notes"} dict."""
+        return {bit: self[bit] for bit in range(32)}
+
+    # Mapping interface (bit -> verbose dict), compatible with the former dict of dicts
+    def __getitem__(self, bit):
+        if not isinstance(bit, int) or not 0 <= bit < 32:
+            raise KeyError(bit)
+        meta = FLAGS_MAP.get(bit, {"name": f"bit_{bit}", "desc": "Unknown/reserved", "notes": ""})
+        return {
+            "bit": bit,
+            "value": self.bit(bit),
+            "name": meta.get("name"),
+            "desc": meta.get("desc"),
+            "notes": meta.get("notes", ""),
+        }
+
+    def __iter__(self):
+        return iter(range(32))
+
+    def __len__(self):
+        return 32
+
+    def __int__(self):
+        return self.value
+
+    def __eq__(self, other):
+        if isinstance(other, HQFlags):
+            return self.value == other.value
+        return Mapping.__eq__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"HQFlags(0x{self.value:08x})"
+
 # -----------------------
-# LBS resolver class: tries opencellid then mozilla then fallback
+# LBS resolver class: tries the local cell store, then opencellid, then mozilla, then fallback
 # -----------------------
 class LBSResolver:
-    def __init__(self, providers: Optional[Dict[str, Dict[str, Any]]] = None):
+    def __init__(self, providers: Optional[Dict[str, Dict[str, Any]]] = None, cell_store=None,
+                 network: bool = True, pseudo_fallback: bool = True):
         """
         providers example:
           {"opencellid": {"key": "YOUR_KEY"},
            "mozilla": {"key": "test"}}
         If providers is None, OpenCellID is used with OPENCELLID_API_KEY variable.
+        cell_store: local CellTowerStore (receiver.cell_towers), consulted first.
+        network: query the online providers; pseudo_fallback: fake coordinates as a last resort.
         """
+        self.cell_store = cell_store
+        self.network = network
+        self.pseudo_fallback = pseudo_fallback
         if providers is None:
             providers = {}
         # ensure opencellid key present if not provided
@@ -179,48 +240,24 @@ class LBSResolver:
             providers["mozilla"] = {"key": "test"}  # test key; limited
         self.providers = providers
 
-    @lru_cache(maxsize=4096)
     def resolve(self, lac: int, cid: int, mcc: int = 432, mnc: int = 1) -> Optional[Dict[str, Any]]:
         """
-        Attempt providers in order: opencellid -> mozilla -> fallback.
+        Attempt providers in order: local store -> opencellid -> mozilla -> fallback.
         Uses Iran's default MCC=432, MNC=1 if not provided.
         Returns dict {lat, lon, accuracy, provider} or None.
+        Not cached here; the receiver caches results per cell (receiver.lbs.CellLocator).
         """
-        # try OpenCellID if configured
-        if "opencellid" in self.providers and requests is not None:
-            cfg = self.providers["opencellid"]
-            key = cfg.get("key")
-            if key:
-                try:
-                    loc = self._resolve_opencellid(key, mcc, mnc, lac, cid)
-                    if loc:
-                        loc["provider"] = "opencellid"
-                        return loc
-                except Exception:
-                    pass
-
-        # try Mozilla Location Service
-        if "mozilla" in self.providers and requests is not None:
-            cfg = self.providers["mozilla"]
-            key = cfg.get("key", "test")
+        if self.cell_store is not None:
             try:
-                loc = self._resolve_mozilla(key, mcc, mnc, lac, cid)
+                loc = self.cell_store.lookup(mcc, mnc, lac, cid)
                 if loc:
-                    loc["provider"] = "mozilla"
                     return loc
             except Exception:
                 pass
 
-        # fallback
-        loc = self._fallback_pseudo(mcc, mnc, lac, cid)
-        loc["provider"] = "pseudo"
-        return loc
-    
-    
-        """
-        Attempt providers in order: opencellid -> mozilla -> fallback.
-        Returns dict {lat, lon, accuracy, provider} or None.
-        """
+        if not self.network:
+            return self._pseudo(mcc, mnc, lac, cid) if self.pseudo_fallback else None
+
         # try OpenCellID if configured
         if "opencellid" in self.providers and requests is not None:
             cfg = self.providers["opencellid"]
@@ -246,7 +283,10 @@ class LBSResolver:
             except Exception:
                 pass
 
-        # fallback deterministic pseudo-resolver (not accurate - for dev/testing)
+        # fallback
+        return self._pseudo(mcc, mnc, lac, cid) if self.pseudo_fallback else None
+
+    def _pseudo(self, mcc: int, mnc: int, lac: int, cid: int) -> Dict[str, Any]:
         loc = self._fallback_pseudo(mcc, mnc, lac, cid)
         loc["provider"] = "pseudo"
         return loc
@@ -314,8 +354,8 @@ class LBSResolver:
 # -----------------------
 # HQFullDecoder (comprehensive)
 # -----------------------
-class HQFullDecoder:
-    def __init__(self, lbs_providers: Optional[Dict[str, Dict[str, Any]]] = None):
+class HQFullDecoder(BatchDecodeMixin):
+    def __init__(self, lbs_providers: Optional[Dict[str, Dict[str, Any]]] = None, lbs: Optional[LBSResolver] = None):
         """
         Create decoder. Pass lbs_providers to configure which LBS services to use.
         Example:
@@ -323,8 +363,9 @@ class HQFullDecoder:
                 "opencellid":{"key":"pk.4db..."},
                 "mozilla":{"key":"test"}
             })
+        or a configured LBSResolver as ``lbs`` (e.g. with a local cell store).
         """
-        self.lbs = LBSResolver(lbs_providers)
+        self.lbs = lbs if lbs is not None else LBSResolver(lbs_providers)
         # handlers map
         self.packet_handlers: Dict[str, Callable[[list], dict]] = {
             "V1": self._handle_v1,
@@ -379,6 +420,33 @@ class HQFullDecoder:
             return {"type": "unknown", "raw": raw_packet, "parts": parts}
     
     
+    def resolve_lbs(self, decoded: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Fill the coordinates of a decoded V0 / no-fix V1 packet from its cell,
+        synchronously (network lookups). For offline tools; the receiver
+        resolves cells asynchronously instead.
+        """
+        if decoded.get("location_resolved_via") != "pending":
+            return decoded
+        mcc = decoded.get("mcc")
+        mnc = decoded.get("mnc")
+        loc = self.lbs.resolve(decoded["lac"], decoded["cid"],
+                               mcc=432 if mcc is None else mcc, mnc=1 if mnc is None else mnc)
+        if loc:
+            decoded["latitude"] = loc.get("lat")
+            decoded["longitude"] = loc.get("lon")
+            decoded["location_resolved_via"] = loc.get("provider")
+            decoded["accuracy_m"] = loc.get("accuracy")
+        else:
+            decoded["location_resolved_via"] = "none"
+        return decoded
+
+    def prepare_frame(self, frame):
+        """decode_many accepts the received bytes as well as text."""
+        if isinstance(frame, (bytes, bytearray, memoryview)):
+            return bytes(frame).decode('utf-8', errors='ignore').strip()
+        return frame
+
     # ---------- Handlers ----------
     def _handle_heartbeat(self, parts: list) -> dict:
         """Handle heartbeat packets: HTBT or XT."""
@@ -430,18 +498,17 @@ class HQFullDecoder:
 
         # Flags
         if flags_raw:
-            flags_value, flags_bits = parse_flags_from_hex(flags_raw, byteorder='little')
-            res["flags_value"] = flags_value
-            res["flags"] = flags_bits
+            flags = HQFlags.from_hex(flags_raw, byteorder='little')
+            res["flags_value"] = flags.value
+            res["flags"] = flags
             # Extract ACC and SOS from flags
-            res["acc_on"] = flags_bits.get(1, {}).get("value", False)  # Bit 1 = ACC
-            res["sos_active"] = flags_bits.get(3, {}).get("value", False)  # Bit 3 = SOS
+            res["acc_on"] = flags.bit(1)  # Bit 1 = ACC
+            res["sos_active"] = flags.bit(3)  # Bit 3 = SOS
             if res["sos_active"]:
                 res["alarm_type"] = "sos"
         else:
             res["flags_value"] = 0
-            res["flags"] = {bit: {"bit": bit, "value": False, **FLAGS_MAP.get(bit, {"name": f"bit_{bit}", "desc": "", "notes": ""})}
-                            for bit in range(32)}
+            res["flags"] = HQFlags(0)
             res["acc_on"] = None
             res["sos_active"] = False
 
@@ -475,23 +542,16 @@ class HQFullDecoder:
                 res["lac"] = lac
                 res["cid"] = cid
 
-        # LBS fallback if no GPS
+        # No GPS: the cell can be resolved later (resolve_lbs / the receiver's LBS stage)
         if not res["gps_valid"] and res["lac"] is not None and res["cid"] is not None:
-            loc = self.lbs.resolve(res["lac"], res["cid"])  # Note: MCC/MNC are now optional in LBSResolver
-            if loc:
-                res["latitude"] = loc.get("lat")
-                res["longitude"] = loc.get("lon")
-                res["location_resolved_via"] = loc.get("provider")
-                res["accuracy_m"] = loc.get("accuracy")
-            else:
-                res["location_resolved_via"] = "none"
+            res["location_resolved_via"] = "pending"
 
         return res
 
 
 
     def _handle_v0(self, parts: list) -> dict:
-        """V0: LBS-only packet. Resolve to coords if possible."""
+        """V0: LBS-only packet. Coordinates come from resolving the cell (see resolve_lbs)."""
         if len(parts) < 9:
             raise ValueError("V0 too short")
         protocol = parts[0] if len(parts) > 0 else None
@@ -511,21 +571,12 @@ class HQFullDecoder:
         res["mnc"] = self._safe_int(mnc_raw)
         res["lac"] = self._safe_int(lac_raw)
         res["cid"] = self._safe_int(cid_raw)
-        # resolve
+        res["latitude"] = None
+        res["longitude"] = None
+        # Resolved later (resolve_lbs / the receiver's LBS stage); decode does no network I/O
         if None not in (res["mcc"], res["mnc"], res["lac"], res["cid"]):
-            loc = self.lbs.resolve(res["mcc"], res["mnc"], res["lac"], res["cid"])
-            if loc:
-                res["latitude"] = loc.get("lat")
-                res["longitude"] = loc.get("lon")
-                res["location_resolved_via"] = loc.get("provider")
-                res["accuracy_m"] = loc.get("accuracy")
-            else:
-                res["latitude"] = None
-                res["longitude"] = None
-                res["location_resolved_via"] = "none"
+            res["location_resolved_via"] = "pending"
         else:
-            res["latitude"] = None
-            res["longitude"] = None
             res["location_resolved_via"] = "insufficient_lbs"
         return res
 
@@ -544,14 +595,9 @@ class HQFullDecoder:
         res["timestamp"] = format_time_date(time_raw, date_raw)
         res["status"] = status
         res["alarm_raw"] = alarm_raw
-        if alarm_raw:
-            alarm_value, alarm_bits = parse_flags_from_hex(alarm_raw, byteorder='little')
-            res["alarm_value"] = alarm_value
-            res["alarm_info"] = alarm_bits
-        else:
-            res["alarm_value"] = 0
-            res["alarm_info"] = {bit: {"bit": bit, "value": False, "name": FLAGS_MAP.get(bit, {}).get("name", f"bit_{bit}"),
-                                       "desc": FLAGS_MAP.get(bit, {}).get("desc",""), "notes": ""} for bit in range(32)}
+        alarm_info = HQFlags.from_hex(alarm_raw, byteorder='little') if alarm_raw else HQFlags(0)
+        res["alarm_value"] = alarm_info.value
+        res["alarm_info"] = alarm_info
         return res
     
     def _handle_v3(self, parts: list) -> dict:
@@ -655,6 +701,8 @@ class HQFullDecoder:
         def default(o):
             if isinstance(o, datetime):
                 return o.astimezone(timezone.utc).isoformat()
+            if isinstance(o, HQFlags):
+                return {str(bit): info for bit, info in o.items()}
             return str(o)
         return json.dumps(obj, indent=2, ensure_ascii=ensure_ascii, default=default)
 
@@ -1,8 +1,18 @@
 import struct
 import datetime
 from datetime import timezone
+from functools import reduce
+from operator import xor
 
-class JT808Decoder:
+from .batch import BatchDecodeMixin
+from .frame import DecodedFrame
+
+_HEADER = struct.Struct('>HH')  # MsgID(2) + Props(2)
+_U16 = struct.Struct('>H')
+# Location body: Alarm(4) + Status(4) + Lat(4) + Lon(4) + Alt(2) + Speed(2) + Heading(2) + Time(6, BCD)
+_LOCATION = struct.Struct('>IIIIHHH6s')
+
+class JT808Decoder(BatchDecodeMixin):
     """
     Decoder for JT808 Protocol (China National Standard)
     Start/End byte: 0x7E
@@ -14,8 +24,19 @@ class JT808Decoder:
         0x7d 0x02 -> 0x7e
         0x7d 0x01 -> 0x7d
         """
+        if b'\x7d' not in data:
+            return data
         return data.replace(b'\x7d\x02', b'\x7e').replace(b'\x7d\x01', b'\x7d')
 
+    def unescape_body(self, data):
+        """
+        Unescaped content between the 0x7E delimiters. Frames without escapes
+        (most of them) are returned as a memoryview of ``data``, not copied.
+        """
+        if data.find(b'\x7d', 1, -1) < 0:
+            return memoryview(data)[1:-1]
+        return self.unescape(data[1:-1])
+
     def escape(self, data):
         """
         Escape data for transmission:
@@ -28,10 +49,7 @@ class JT808Decoder:
         """
         XOR checksum of all bytes
         """
-        checksum = 0
-        for byte in data:
-            checksum ^= byte
-        return checksum
+        return reduce(xor, data, 0)
 
     def decode(self, data):
         """
@@ -53,72 +71,55 @@ class JT808Decoder:
                 return {"error": "Invalid start/end bytes"}
             
             # Unescape the body (everything between start and end 7E)
-            raw_body = data[1:-1]
-            unescaped_body = self.unescape(raw_body)
-            
+            unescaped_body = self.unescape_body(data)
+            total_length = len(unescaped_body)
+
             # Verify Checksum
             # The checksum is the last byte of the unescaped body
             received_checksum = unescaped_body[-1]
-            content_for_checksum = unescaped_body[:-1]
-            calculated_checksum = self.calculate_checksum(content_for_checksum)
-            
+            calculated_checksum = self.calculate_checksum(unescaped_body[:-1])
+
             if received_checksum != calculated_checksum:
                 return {"error": f"Checksum failed. Calc: {hex(calculated_checksum)}, Recv: {hex(received_checksum)}"}
-            
+
             # Parse Header - First 4 bytes are always: MsgID(2) + Props(2)
-            # Message ID (2 bytes)
-            msg_id = struct.unpack('>H', unescaped_body[0:2])[0]
-            
-            # Body Properties (2 bytes)
-            body_props = struct.unpack('>H', unescaped_body[2:4])[0]
+            msg_id, body_props = _HEADER.unpack_from(unescaped_body)
             body_length = body_props & 0x03FF # Lower 10 bits
-            has_sub_package = (body_props >> 13) & 1
-            
+
             # Dynamic Terminal ID Length Detection
             # Total unescaped length = Header + Body + Checksum(1)
             # Header = MsgID(2) + Props(2) + TermID(?) + Serial(2)
-            # So: len(unescaped_body) = Header + Body + 1
-            # Header = len(unescaped_body) - body_length - 1
-            # TermID_len = Header - 2 - 2 - 2 = Header - 6
-            
-            total_length = len(unescaped_body)
+            # So: TermID_len = len(unescaped_body) - body_length - 1 - 6
             header_length = total_length - body_length - 1  # -1 for checksum
             terminal_id_length = header_length - 6  # -6 for MsgID(2) + Props(2) + Serial(2)
-            
-            # Validate Terminal ID length
-            if terminal_id_length == 6:
-                # Standard JT808: 6-byte Terminal ID
-                terminal_id_bytes = unescaped_body[4:10]
-                msg_serial_offset = 10
-            elif terminal_id_length == 8:
-                # Legacy/Extended: 8-byte Terminal ID
-                terminal_id_bytes = unescaped_body[4:12]
-                msg_serial_offset = 12
-            else:
+
+            # Standard JT808: 6-byte Terminal ID; Legacy/Extended: 8 bytes
+            if terminal_id_length != 6 and terminal_id_length != 8:
                 return {"error": f"Invalid Terminal ID length: {terminal_id_length} bytes (expected 6 or 8)"}
-            
+            terminal_id_bytes = bytes(unescaped_body[4:4 + terminal_id_length])
+            msg_serial_offset = 4 + terminal_id_length
+
             # Decode BCD for the first 6 bytes to get IMEI
             imei = self.bcd_to_str(terminal_id_bytes[:6])
             # Strip leading zero if present
             if imei.startswith('0'):
                 imei = imei[1:]
-            
+
             # Message Serial Number (2 bytes)
-            msg_serial = struct.unpack('>H', unescaped_body[msg_serial_offset:msg_serial_offset+2])[0]
-            
+            msg_serial = _U16.unpack_from(unescaped_body, msg_serial_offset)[0]
+
             # Body content starts after header, ends before checksum
             body_start = msg_serial_offset + 2
-            body_content = unescaped_body[body_start:-1] # Exclude checksum at end
-            
-            result = {
-                "raw": data.hex(),
-                "protocol_num": hex(msg_id),
-                "type": "JT808",
-                "imei": imei,
-                "msg_serial": msg_serial,
-                "terminal_id_length": terminal_id_length  # For debugging
-            }
-            
+
+            result = DecodedFrame(
+                protocol_num=hex(msg_id),
+                type="JT808",
+                imei=imei,
+                msg_serial=msg_serial,
+                terminal_id_length=terminal_id_length,  # For debugging
+            )
+            result.source = data  # "raw" hex is built on first read
+
             # Terminal Registration (0x0100)
             if msg_id == 0x0100:
                 result["packet_type"] = "LOGIN"
@@ -131,37 +132,30 @@ class JT808Decoder:
                 result["packet_type"] = "V1" # Map to V1 for compatibility
                 # Parse Body
                 # Alarm Flag (4) + Status (4) + Lat (4) + Lon (4) + Alt (2) + Speed (2) + Heading (2) + Time (6)
-                if len(body_content) < 28:
+                if total_length - 1 - body_start < _LOCATION.size:
                      result["error"] = "Location body too short"
                      return result
-                     
-                lat_int = struct.unpack('>I', body_content[8:12])[0]
-                lon_int = struct.unpack('>I', body_content[12:16])[0]
-                speed_int = struct.unpack('>H', body_content[18:20])[0]
-                heading_int = struct.unpack('>H', body_content[20:22])[0]
-                time_bytes = body_content[22:28]
-                
+
+                _alarm, _status, lat_int, lon_int, _altitude, speed_int, heading_int, time_bytes = \
+                    _LOCATION.unpack_from(unescaped_body, body_start)
+
                 result["latitude"] = lat_int / 1000000.0
                 result["longitude"] = lon_int / 1000000.0
                 result["speed"] = speed_int / 10.0
                 result["heading"] = heading_int
-                
+
                 # Date Time BCD
                 try:
                     time_str = self.bcd_to_str(time_bytes)
                     # Format: YYMMDDHHmmSS
-                    year = int("20" + time_str[0:2])
-                    month = int(time_str[2:4])
-                    day = int(time_str[4:6])
-                    hour = int(time_str[6:8])
-                    minute = int(time_str[8:10])
-                    second = int(time_str[10:12])
-                    timestamp = datetime.datetime(year, month, day, hour, minute, second, tzinfo=timezone.utc)
+                    timestamp = datetime.datetime(
+                        2000 + int(time_str[0:2]), int(time_str[2:4]), int(time_str[4:6]),
+                        int(time_str[6:8]), int(time_str[8:10]), int(time_str[10:12]), tzinfo=timezone.utc)
                     result["timestamp"] = timestamp
                     result["gps_valid"] = True
-                except:
+                except ValueError:
                     result["gps_valid"] = False
-                    
+
                 # Send Platform General Response (0x8001) to acknowledge location
                 response_bytes = self.generate_general_response(msg_id, msg_serial, terminal_id_bytes)
                 result["response"] = response_bytes
@@ -189,8 +183,56 @@ class JT808Decoder:
         except Exception as e:
             return {"error": f"Decoding error: {str(e)}"}
 
+    def parse_header(self, data, verify_checksum=False):
+        """
+        Header of a frame without decoding its body: (msg_id, msg_serial, terminal_id_bytes),
+        or None if the frame is invalid (or fails the checksum when verify_checksum is set).
+        """
+        try:
+            if len(data) < 13 or data[0] != 0x7e or data[-1] != 0x7e:
+                return None
+            unescaped_body = self.unescape_body(data)
+            if verify_checksum and unescaped_body[-1] != self.calculate_checksum(unescaped_body[:-1]):
+                return None
+            msg_id, body_props = _HEADER.unpack_from(unescaped_body)
+            terminal_id_length = len(unescaped_body) - (body_props & 0x03FF) - 1 - 6
+            if terminal_id_length not in (6, 8):
+                return None
+            terminal_id_bytes = bytes(unescaped_body[4:4 + terminal_id_length])
+            msg_serial = _U16.unpack_from(unescaped_body, 4 + terminal_id_length)[0]
+            return msg_id, msg_serial, terminal_id_bytes
+        except Exception:
+            return None
+
+    def generate_ack(self, data):
+        """
+        The response decode() would attach (0x8100 for registration, 0x8001 for
+        location/heartbeat), built from the header of a checksum-valid frame.
+        Returns None for invalid frames and messages decode() does not acknowledge.
+        """
+        header = self.parse_header(data, verify_checksum=True)
+        if header is None:
+            return None
+        msg_id, msg_serial, terminal_id_bytes = header
+        if msg_id == 0x0100:
+            return self.generate_registration_response(msg_serial, terminal_id_bytes)
+        if msg_id in (0x0200, 0x0002, 0x0003):
+            return self.generate_general_response(msg_id, msg_serial, terminal_id_bytes)
+        return None
+
+    def generate_failure_response(self, data):
+        """
+        0x8001 with result 1 (Failure) for a frame that was not processed,
+        built from its header only. Returns None if the header is invalid.
+        """
+        header = self.parse_header(data)
+        if header is None:
+            return None
+        msg_id, msg_serial, terminal_id_bytes = header
+        return self.generate_general_response(msg_id, msg_serial, terminal_id_bytes, result=1)
+
     def bcd_to_str(self, bcd_data):
-        return ''.join('{:02X}'.format(b) for b in bcd_data)
+        return bytes(bcd_data).hex().upper()
 
     def generate_registration_response(self, msg_serial, terminal_id_bytes):
         """
@@ -236,10 +278,11 @@ class JT808Decoder:
         # Final Packet
         return b'\x7e' + escaped_content + b'\x7e'
 
-    def generate_general_response(self, ack_msg_id, ack_msg_serial, terminal_id_bytes):
+    def generate_general_response(self, ack_msg_id, ack_msg_serial, terminal_id_bytes, result=0):
         """
         Generate 0x8001 General Response
         Body: AckSerial(2) + AckMsgId(2) + Result(1)
+        Result: 0 = Success, 1 = Failure (terminal resends the message)
         Works with both 6-byte and 8-byte Terminal IDs
         """
         msg_id = b'\x80\x01'
@@ -247,7 +290,7 @@ class JT808Decoder:
         # Body
         resp_serial = struct.pack('>H', ack_msg_serial)
         resp_msg_id = struct.pack('>H', ack_msg_id)
-        result = b'\x00' # Success
+        result = bytes([result])
         
         body = resp_serial + resp_msg_id + result
         
@@ -0,0 +1,132 @@
+"""
+Batch decoding into columns
+
+``decode_many(frames)`` decodes a list of frames with one decoder and returns
+a ``DecodedColumns``: parallel lists with one entry per decoded record, ready
+for ``numpy.asarray(columns.latitude, dtype=float)`` (None becomes NaN) or
+for building ``LocationData`` rows for ``bulk_create`` from ``rows()``.
+
+``frame`` is the index of the source frame of each record: an HQ UPLOAD frame
+yields one record per embedded packet. Frames that fail to decode yield no
+record and are listed in ``errors`` as (index, message).
+
+With ``processes`` > 0 large inputs are split into chunks decoded by a
+process pool; each worker returns the columns of its chunk, so only the
+compact columns cross the process boundary.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
+
+COLUMNS = ('frame', 'imei', 'timestamp', 'latitude', 'longitude', 'speed', 'course', 'flags', 'packet_type')
+
+
+class DecodedColumns:
+    __slots__ = COLUMNS + ('errors', 'results')
+
+    def __init__(self, keep_results=False):
+        for name in COLUMNS:
+            setattr(self, name, [])
+        self.errors = []  # (frame index, error message)
+        # keep_results: the decoder's result for each frame, None for skipped frames
+        self.results = [] if keep_results else None
+
+    def __len__(self):
+        return len(self.frame)
+
+    def add(self, index, decoded):
+        """Append the record(s) of one decoder result."""
+        if 'error' in decoded:
+            self.errors.append((index, decoded['error']))
+            return
+        records = decoded.get('records')
+        if records is not None:
+            # HQ UPLOAD: one record per embedded packet
+            for record in records:
+                if 'raw_sub' not in record:
+                    self.add(index, record)
+            return
+        timestamp = decoded.get('timestamp')
+        if isinstance(timestamp, str):
+            try:
+                timestamp = datetime.fromisoformat(timestamp)
+            except ValueError:
+                timestamp = None
+        course = decoded.get('heading')
+        flags = decoded.get('flags_value')
+        self.frame.append(index)
+        self.imei.append(decoded.get('imei'))
+        self.timestamp.append(timestamp)
+        self.latitude.append(decoded.get('latitude'))
+        self.longitude.append(decoded.get('longitude'))
+        self.speed.append(decoded.get('speed'))
+        self.course.append(course if course is not None else decoded.get('course'))
+        self.flags.append(flags if flags is not None else decoded.get('alarm_value'))
+        self.packet_type.append(decoded.get('packet_type') or decoded.get('type'))
+
+    def extend(self, other):
+        for name in COLUMNS:
+            getattr(self, name).extend(getattr(other, name))
+        self.errors.extend(other.errors)
+        if self.results is not None and other.results is not None:
+            self.results.extend(other.results)
+
+    def rows(self):
+        """One dict per record, keyed by column name."""
+        for values in zip(*(getattr(self, name) for name in COLUMNS)):
+            yield dict(zip(COLUMNS, values))
+
+
+def decode_frames(decoder, frames, offset=0, keep_results=False):
+    columns = DecodedColumns(keep_results)
+    decode, prepare = decoder.decode, decoder.prepare_frame
+    for index, frame in enumerate(frames, offset):
+        try:
+            decoded = decode(prepare(frame))
+        except Exception as e:
+            decoded = {"error": f"Decoding error: {e}"}
+        columns.add(index, decoded)
+        if keep_results:
+            columns.results.append(decoded)
+    return columns
+
+
+_worker_decoders = {}
+
+
+def _decode_chunk(decoder_class, frames, offset, keep_results):
+    # One decoder per worker process, reused across chunks
+    decoder = _worker_decoders.get(decoder_class)
+    if decoder is None:
+        decoder = _worker_decoders[decoder_class] = decoder_class()
+    return decode_frames(decoder, frames, offset, keep_results)
+
+
+def decode_many(decoder, frames, processes=0, chunk_size=1000, keep_results=False):
+    frames = list(frames)
+    if not processes or len(frames) <= chunk_size:
+        return decode_frames(decoder, frames, keep_results=keep_results)
+    offsets = range(0, len(frames), chunk_size)
+    columns = DecodedColumns(keep_results)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for part in pool.map(_decode_chunk, repeat(type(decoder)),
+                             [frames[start:start + chunk_size] for start in offsets],
+                             offsets, repeat(keep_results)):
+            columns.extend(part)
+    return columns
+
+
+class BatchDecodeMixin:
+    """Adds ``decode_many`` to a decoder exposing ``decode(frame)``."""
+
+    def prepare_frame(self, frame):
+        """Convert a frame to what ``decode`` expects."""
+        return frame
+
+    def decode_many(self, frames, processes=0, chunk_size=1000, keep_results=False):
+        """
+        Decode ``frames`` into a DecodedColumns (see decoders.batch).
+        processes: worker processes for inputs longer than ``chunk_size`` (0: decode inline).
+        keep_results: also keep each frame's full decoder result in ``results``.
+        """
+        return decode_many(self, frames, processes=processes, chunk_size=chunk_size, keep_results=keep_results)
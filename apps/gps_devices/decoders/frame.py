@@ -0,0 +1,78 @@
+class DecodedFrame(dict):
+    """
+    Decoder result whose "raw" hex string is only built when it is read.
+
+    Most packets never look at "raw" (the receiver logs and stores the frame
+    itself), so hex-encoding every frame up front is wasted work. Reading the
+    key, or viewing the whole dict (iteration, items(), equality, json,
+    pickling), computes it once and stores it like any other field.
+
+    Built like a dict, then ``source`` is set to the frame bytes (no custom
+    __init__: constructing the result is on the per-packet path).
+    """
+    __slots__ = ('source',)
+
+    def _pending(self):
+        return getattr(self, 'source', None) is not None
+
+    def _materialize(self):
+        if self._pending():
+            dict.__setitem__(self, 'raw', bytes(self.source).hex())
+            self.source = None
+
+    def __missing__(self, key):
+        if key != 'raw' or not self._pending():
+            raise KeyError(key)
+        self._materialize()
+        return dict.__getitem__(self, 'raw')
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (key == 'raw' and self._pending())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __len__(self):
+        return dict.__len__(self) + self._pending()
+
+    def __iter__(self):
+        self._materialize()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self._materialize()
+        return dict.keys(self)
+
+    def values(self):
+        self._materialize()
+        return dict.values(self)
+
+    def items(self):
+        self._materialize()
+        return dict.items(self)
+
+    def copy(self):
+        self._materialize()
+        return dict(self)
+
+    def __eq__(self, other):
+        self._materialize()
+        if isinstance(other, DecodedFrame):
+            other._materialize()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        self._materialize()
+        if isinstance(other, DecodedFrame):
+            other._materialize()
+        return dict.__ne__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        self._materialize()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        # Unpickles as a plain dict (e.g. results returned by worker processes)
+        return dict, (self.copy(),)
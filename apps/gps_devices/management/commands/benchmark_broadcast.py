@@ -0,0 +1,67 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from apps.gps_devices.models import Device, LocationData
+
+
+class _CapturingBroadcaster:
+    def __init__(self):
+        self.published = 0
+
+    def publish(self, device_id, groups, data):
+        self.published += 1
+
+
+class Command(BaseCommand):
+    help = 'Measure database queries and time per WebSocket broadcast of the GPS receiver'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--imei', help='Device to broadcast (default: first active device)')
+        parser.add_argument('--iterations', type=int, default=1000, help='Steady-state broadcasts to run')
+
+    def handle(self, *args, **options):
+        from apps.gps_devices.management.commands.gps_receiver import GPSReceiver
+
+        devices = Device.objects.filter(status='active')
+        if options.get('imei'):
+            devices = Device.objects.filter(imei=options['imei'])
+        device = devices.first()
+        if device is None:
+            raise CommandError('No device to benchmark')
+
+        iterations = max(1, options['iterations'])
+        server = GPSReceiver()
+        capture = _CapturingBroadcaster()
+        real_broadcaster, server.broadcaster = server.broadcaster, capture
+        try:
+            cached = server.device_registry.get_device(device.imei)
+
+            def location(i):
+                # Unsaved row, as handed over by the write-behind writer after its insert
+                return LocationData(
+                    device_id=cached.id, latitude=35.7 + i * 1e-5, longitude=51.4, speed=30, heading=90,
+                    satellites=8, signal_strength=20, created_at=timezone.now(),
+                )
+
+            with CaptureQueriesContext(connection) as cold:
+                server.broadcast_device_update(cached, speed=30, heading=90, location_data=location(0))
+
+            with CaptureQueriesContext(connection) as warm:
+                started = time.perf_counter()
+                for i in range(iterations):
+                    server.broadcast_device_update(cached, speed=30, heading=90, location_data=location(i))
+                elapsed = time.perf_counter() - started
+        finally:
+            server.broadcaster = real_broadcaster
+            server.close()
+
+        self.stdout.write(f'Device {cached.imei}: {capture.published} broadcasts published')
+        self.stdout.write(f'  cold cache:   {len(cold.captured_queries)} queries')
+        self.stdout.write(
+            f'  steady state: {len(warm.captured_queries) / iterations:.2f} queries/broadcast, '
+            f'{elapsed / iterations * 1e6:.1f} us/broadcast ({iterations} broadcasts)'
+        )
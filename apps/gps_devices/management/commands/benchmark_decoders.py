@@ -0,0 +1,55 @@
+import struct
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.gps_devices.decoders.GT06_Decoder import GT06Decoder
+from apps.gps_devices.decoders.JT808_Decoder import JT808Decoder
+
+
+def _jt808_frame(decoder, msg_id, body, terminal_id=bytes.fromhex('012345678901'), serial=7):
+    content = struct.pack('>HH', msg_id, len(body)) + terminal_id + struct.pack('>H', serial) + body
+    content += bytes([decoder.calculate_checksum(content)])
+    return b'\x7e' + decoder.escape(content) + b'\x7e'
+
+
+def sample_frames():
+    """(name, decoder, frame) of typical packets of each binary protocol."""
+    gt06, jt808 = GT06Decoder(), JT808Decoder()
+    location = struct.pack('>IIIIHHH', 0, 3, 35700000, 51400000, 1200, 325, 90) + bytes.fromhex('240517123045')
+    return [
+        ('gt06 login', gt06, bytes.fromhex('78780d010123456789012345000199810d0a')),
+        ('gt06 location', gt06, bytes.fromhex('787822221805110c1e2d' + 'c8' + '03d3ec60' + '0898bd80' + '3c' + '1432' + '000100000d0a')),
+        ('gt06 heartbeat', gt06, bytes.fromhex('78780a13440604000201000d0a')),
+        ('jt808 location', jt808, _jt808_frame(jt808, 0x0200, location)),
+        ('jt808 location (escaped)', jt808, _jt808_frame(jt808, 0x0200, location, terminal_id=bytes.fromhex('01234567897e'))),
+        ('jt808 heartbeat', jt808, _jt808_frame(jt808, 0x0002, b'')),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Measure the per-frame decode cost of the GT06 and JT808 decoders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100000, help='Decodes per frame type')
+        parser.add_argument('--raw', action='store_true', help='Also read the "raw" hex of every result')
+
+    def handle(self, *args, **options):
+        iterations = max(1, options['iterations'])
+        read_raw = options['raw']
+        for name, decoder, frame in sample_frames():
+            decode = decoder.decode
+            result = decode(frame)
+            if 'error' in result:
+                self.stderr.write(f'{name}: {result["error"]}')
+                continue
+            started = time.perf_counter()
+            if read_raw:
+                for _ in range(iterations):
+                    decode(frame)['raw']
+            else:
+                for _ in range(iterations):
+                    decode(frame)
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'{name:<26} {len(frame):>4} bytes  {elapsed / iterations * 1e6:8.2f} us/frame  '
+                              f'{iterations / elapsed:10.0f} frames/s')
@@ -0,0 +1,121 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from apps.gps_devices.management.commands.benchmark_broadcast import _CapturingBroadcaster
+from apps.gps_devices.models import Device, Model, RawGpsData
+
+MODES = ('close', 'reuse')
+IMEI_PREFIX = '990000'
+
+
+def hq_frame(imei, when, index):
+    # Distinct coordinates per packet so every frame is a new position
+    return (
+        f'*HQ,{imei},V1,{when:%H%M%S},A,3541.{index % 10000:04d},N,05124.5678,E,0.00,0,{when:%d%m%y},'
+        f'fbfffbff,432,35,32645,31251#'
+    ).encode()
+
+
+class Command(BaseCommand):
+    help = ('Measure GPS receiver packets/s with a new database connection per packet (old behaviour) '
+            'and with reused connections (persistent per thread, or pooled when DATABASE_POOL is on). '
+            'Packets go through the decode stage for synthetic devices that are deleted afterwards, '
+            'with their rows; nothing is broadcast.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--packets', type=int, default=2000, help='Packets per mode')
+        parser.add_argument('--devices', type=int, default=8,
+                            help='Synthetic devices the packets are spread over (each is one decode lane)')
+        parser.add_argument('--mode', choices=MODES + ('both',), default='both')
+
+    def handle(self, *args, **options):
+        from apps.gps_devices.management.commands.gps_receiver import GPSReceiver
+
+        count = max(1, min(options['devices'], 9999))
+        imeis = [f'{IMEI_PREFIX}{index:04d}' for index in range(count)]
+        if Device.objects.filter(imei__in=imeis).exists():
+            raise CommandError(f'Devices with IMEI prefix {IMEI_PREFIX} already exist; remove them first')
+
+        database = settings.DATABASES['default']
+        pool = database.get('OPTIONS', {}).get('pool')
+        self.stdout.write(
+            f'Database: {database["ENGINE"]}, '
+            + (f'pool max_size={pool.get("max_size")}' if pool else f'CONN_MAX_AGE={database.get("CONN_MAX_AGE")}')
+        )
+
+        model, model_created = Model.objects.get_or_create(
+            model_name='Benchmark', manufacturer='Benchmark', defaults={'protocol_type': 'TCP'})
+        devices = [Device.objects.create(imei=imei, name=f'Benchmark {imei}', model=model, status='active')
+                   for imei in imeis]
+
+        opened = [0]
+        lock = threading.Lock()
+
+        def count_connection(sender, connection, **kwargs):
+            with lock:
+                opened[0] += 1
+
+        connection_created.connect(count_connection)
+        server = GPSReceiver()
+        server.dedup = None  # every benchmark packet must be processed
+        server.broadcaster = _CapturingBroadcaster()
+        try:
+            modes = MODES if options['mode'] == 'both' else (options['mode'],)
+            start = datetime.now(timezone.utc) - timedelta(days=1)
+            for mode in modes:
+                opened[0] = 0
+                elapsed, processed = self.run_mode(server, imeis, mode, start, max(1, options['packets']))
+                self.stdout.write(
+                    f'  {mode:5s}: {processed} packets in {elapsed:.2f}s = {processed / elapsed:.0f} packets/s, '
+                    f'{opened[0]} connections opened'
+                )
+                start += timedelta(seconds=options['packets'] + 1)
+        finally:
+            connection_created.disconnect(count_connection)
+            server.close()
+            # Locations and states cascade; raw frames would only lose their device
+            RawGpsData.objects.filter(device__in=devices).delete()
+            Device.objects.filter(id__in=[device.id for device in devices]).delete()
+            if model_created:
+                model.delete()
+
+    def run_mode(self, server, imeis, mode, start, packets):
+        frames = [hq_frame(imeis[i % len(imeis)], start + timedelta(seconds=i), i) for i in range(packets)]
+
+        def process_gps_data(*args, **kwargs):
+            try:
+                # Benchmark packets come from one address: skip the rate limits, like an ingest log replay
+                return type(server).process_gps_data(server, *args, from_log=True, **kwargs)
+            finally:
+                if mode == 'close':
+                    connections.close_all()  # what the listeners used to do around every packet
+
+        stage = server.decode_stage
+        before = stage.metrics()
+        # Keep every lane under its queue limit: dropped packets would not be measured
+        in_flight = max(1, before['max_queue'] // before.get('lanes', 1) // 2)
+        server.process_gps_data = process_gps_data
+        try:
+            started = time.perf_counter()
+            for frame in frames:
+                while len(stage) >= in_flight:
+                    time.sleep(0.001)
+                server.submit_packet(frame, '127.0.0.1', 'tcp')
+            while True:
+                metrics = stage.metrics()
+                done = sum(metrics[name] - before[name] for name in ('processed', 'failed', 'dropped', 'rejected'))
+                if done >= len(frames):
+                    break
+                time.sleep(0.01)
+            server.location_writer.join()
+            server.state_writer.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            del server.process_gps_data
+        return elapsed, metrics['processed'] - before['processed']
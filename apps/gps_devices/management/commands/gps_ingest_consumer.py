@@ -0,0 +1,152 @@
+import os
+import queue
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from apps.gps_devices.receiver.ingest_log import IngestLogReader, decode_frame
+from apps.gps_devices.receiver.session import DeviceSession
+
+
+class Command(BaseCommand):
+    help = 'Process frames from the GPS receiver ingest log (consumer mode) or replay a range of it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log-dir', default=getattr(settings, 'GPS_INGEST_LOG_DIR', None),
+                            help='Ingest log directory (default: GPS_INGEST_LOG_DIR)')
+        parser.add_argument('--worker', type=int, help='Log of receiver worker N (multi-process receiver)')
+        parser.add_argument('--group', default='processor', help='Consumer group whose offset is committed')
+        start = parser.add_mutually_exclusive_group()
+        start.add_argument('--from-offset', type=int, help='Start at this offset instead of the committed one')
+        start.add_argument('--from-time', help='Start at the first frame received at or after this time (ISO 8601)')
+        start.add_argument('--from-beginning', action='store_true', help='Start at the oldest retained frame')
+        parser.add_argument('--include-processed', action='store_true',
+                            help='Also process frames the receiver already processed itself (replay)')
+        parser.add_argument('--batch', type=int, default=500, help='Frames read (and committed) per batch')
+        parser.add_argument('--poll-interval', type=float, default=0.2, help='Seconds to wait for new frames')
+        parser.add_argument('--retry-interval', type=float, default=5.0,
+                            help='Seconds to wait before retrying frames that failed (e.g. database down)')
+        parser.add_argument('--max-sessions', type=int, default=10000, help='Connections remembered for IMEI binding')
+        parser.add_argument('--once', action='store_true', help='Stop at the end of the log instead of waiting')
+
+    def handle(self, *args, **options):
+        from apps.gps_devices.management.commands.gps_receiver import GPSReceiver
+
+        directory = options.get('log_dir')
+        if not directory:
+            raise CommandError('No ingest log directory (set GPS_INGEST_LOG_DIR or pass --log-dir)')
+        if options.get('worker') is not None:
+            directory = os.path.join(directory, f'worker-{options["worker"]}')
+        if not os.path.isdir(directory):
+            raise CommandError(f'Ingest log directory {directory} does not exist')
+
+        reader = IngestLogReader(directory, group=options['group'])
+        if options.get('from_offset') is not None:
+            offset = options['from_offset']
+        elif options.get('from_time'):
+            try:
+                since = datetime.fromisoformat(options['from_time'])
+            except ValueError:
+                raise CommandError(f'Invalid --from-time {options["from_time"]!r}')
+            offset = reader.offset_for_time(since.timestamp())
+        elif options.get('from_beginning'):
+            offset = reader.first_offset()
+        else:
+            offset = reader.committed()
+
+        include_processed = options['include_processed']
+        batch = max(1, options['batch'])
+        max_sessions = max(1, options['max_sessions'])
+        # Connection id -> DeviceSession, so frames without an IMEI (GT06) find their device
+        sessions = OrderedDict()
+
+        def session_for(frame):
+            if not frame.connection_id:
+                return None
+            session = sessions.get(frame.connection_id)
+            if session is None:
+                session = DeviceSession((frame.ip_address, 0), transport='log')
+                session.id = frame.connection_id
+                sessions[frame.connection_id] = session
+                if len(sessions) > max_sessions:
+                    sessions.popitem(last=False)
+            else:
+                sessions.move_to_end(frame.connection_id)
+            if frame.imei and not session.imei:
+                session.bind(frame.imei)
+            return session
+
+        self.stdout.write(f'Consuming {directory} as group {options["group"]} from offset {offset}')
+        server = GPSReceiver()
+        if server.silence_detector is not None and (
+                include_processed or getattr(settings, 'GPS_INGEST_LOG_MODE', 'tee') != 'consumer'):
+            # Idle/Offline timers run where every frame is seen live: here only when the
+            # receiver runs in consumer mode, not for a replay
+            server.silence_detector.close()
+            server.silence_detector = None
+        else:
+            # Silence transitions run on this thread, between frames, not concurrently with them
+            server.device_events = queue.SimpleQueue()
+        writers = (server.location_writer, server.state_writer)
+        processed = skipped = 0
+        failed = False
+        try:
+            while True:
+                if server.device_events is not None:
+                    server.run_device_events()
+                records = reader.read(offset, batch)
+                if not records:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+                close_old_connections()
+                rows_failed = sum(writer.rows_failed for writer in writers)
+                next_offset = offset
+                failed = False
+                for record in records:
+                    frame = decode_frame(record.payload)
+                    session = session_for(frame)
+                    if frame.processed and not include_processed:
+                        # The receiver processed it, but the device's silence timers run here
+                        server.mark_frame_seen(frame.data, session.imei if session is not None else frame.imei)
+                        skipped += 1
+                        next_offset = record.offset + 1
+                        continue
+                    # Frames forwarded by a sibling worker carry their connection's IMEI without a connection id
+                    if server.process_gps_data(frame.data, frame.ip_address, frame.protocol_type,
+                                               session=session, from_log=True,
+                                               forwarded_imei=frame.imei if session is None else None) is False:
+                        failed = True
+                        break
+                    processed += 1
+                    next_offset = record.offset + 1
+                # Rows of the batch must be durable before its offset is committed
+                for writer in writers:
+                    writer.join()
+                if sum(writer.rows_failed for writer in writers) > rows_failed:
+                    # Some row of the batch was not saved; it cannot be told which frame it came from
+                    failed = True
+                    next_offset = offset
+                if next_offset > offset:
+                    reader.commit(next_offset)
+                    offset = next_offset
+                if failed:
+                    if options['once']:
+                        break
+                    self.stderr.write(f'Processing failed at offset {offset}; retrying in {options["retry_interval"]}s')
+                    time.sleep(options['retry_interval'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            reader.close()
+            close_old_connections()
+
+        self.stdout.write(f'Processed {processed} frames, skipped {skipped}; next offset {offset}')
+        if failed:
+            raise CommandError(f'Processing failed at offset {offset} (not committed)')
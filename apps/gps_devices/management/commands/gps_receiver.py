@@ -1,3 +1,4 @@
+import select
 import socket
 import threading
 import logging
@@ -7,23 +8,38 @@ import json
 import sys
 import os
 import math
-from concurrent.futures import ThreadPoolExecutor
+import queue
+import time
 from datetime import datetime, timezone
 from django.core.management.base import BaseCommand
 from django.conf import settings
 from django.utils import timezone as django_timezone
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 from apps.gps_devices.models import RawGpsData, Device, LocationData
-from django.db import connections, close_old_connections
+from django.db import connections, close_old_connections, transaction
 from django.contrib.auth import get_user_model
 User = get_user_model()
-from apps.gps_devices.decoders.HQ_Decoder import HQFullDecoder
+from apps.gps_devices.decoders.HQ_Decoder import HQFullDecoder, LBSResolver
 from apps.gps_devices.decoders.GT06_Decoder import GT06Decoder
 from apps.gps_devices.decoders.JT808_Decoder import JT808Decoder
 from apps.gps_devices.models import DeviceState, State
-from apps.gps_devices.models import MaliciousPattern
 from apps.gps_devices.services.reverse_geocoding import ReverseGeocodingService
+from apps.gps_devices.receiver.framing import FrameBufferOverflow, detect_protocol, frame_device_key, is_heartbeat
+from apps.gps_devices.receiver.session import DeviceSession
+from apps.gps_devices.receiver.registry import DeviceRegistry
+from apps.gps_devices.receiver.hot_state import HotStateCache
+from apps.gps_devices.receiver.write_behind import WriteBehindWriter
+from apps.gps_devices.receiver.security import MaliciousPatternGuard
+from apps.gps_devices.receiver.rate_limit import RateLimiter
+from apps.gps_devices.receiver.broadcaster import DeviceBroadcaster
+from apps.gps_devices.receiver.payload import build_device_payload, state_code, status_display_info
+from apps.gps_devices.receiver.pipeline import KeyedStage, LatencyRecorder, Pipeline, Stage
+from apps.gps_devices.receiver.ingest_log import IngestLog, encode_frame
+from apps.gps_devices.receiver.dedup import DedupWindow, packet_key
+from apps.gps_devices.receiver.presence import PresenceTable, SilenceDetector
+from apps.gps_devices.receiver.udp import UdpSocketStats, set_receive_buffer
+from apps.gps_devices.receiver.lbs import CellLocator, cell_of
+from apps.gps_devices.receiver.cell_towers import CellTowerStore
+from apps.gps_devices.receiver import invalidation
 
 try:
     import paho.mqtt.client as mqtt
@@ -34,19 +50,88 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+HQ_ACK_RESPONSE = bytes.fromhex('2a48512c3030303030303030303030302c56312c3030303030302c412c302e3030303030302c4e2c302e3030303030302c452c302e30302c302c3030303030302c46464646464646462c3030302c30302c303030302c303030302c232a')
+
 class Command(BaseCommand):
     help = 'Start GPS data receiver on port 5000'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--engine',
+            choices=['threads', 'asyncio'],
+            default=getattr(settings, 'GPS_RECEIVER_ENGINE', 'threads'),
+            help='Network engine: "threads" (accept loop + worker pool) or "asyncio" (single event loop)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=getattr(settings, 'GPS_RECEIVER_WORKERS', 1),
+            help='Number of receiver processes sharing the port via SO_REUSEPORT (Linux); frames are '
+                 'forwarded to the process owning their device, which sends the ACK back after commit',
+        )
+
     def handle(self, *args, **options):
-        self.stdout.write('Starting GPS receiver on port 5000...')
+        engine = options.get('engine') or 'threads'
+        workers = max(1, options.get('workers') or 1)
+        self.stdout.write(f'Starting GPS receiver on port 5000 ({engine} engine, {workers} worker(s))...')
         logger.info('GPS receiver command started successfully')
+        database = settings.DATABASES['default']
+        pool = database.get('OPTIONS', {}).get('pool')
+        if pool:
+            logger.info(f'Database connections: pooled (max {pool.get("max_size")} per process)')
+        else:
+            logger.info(f'Database connections: one per thread (CONN_MAX_AGE={database.get("CONN_MAX_AGE")})')
         try:
-            server = GPSReceiver()
-            server.start()
+            if workers > 1:
+                from apps.gps_devices.receiver.supervisor import ReceiverSupervisor
+
+                # Children must not inherit open database connections
+                connections.close_all()
+                ReceiverSupervisor(
+                    workers,
+                    lambda index: self.run_worker(engine, options, index=index, workers=workers),
+                ).start()
+            else:
+                self.run_worker(engine, options)
         except Exception as e:
             logger.error(f'Failed to start GPS receiver: {e}')
             self.stdout.write('Failed to start GPS receiver')
 
+    def run_worker(self, engine, options, index=0, workers=1):
+        server = GPSReceiver(reuse_port=workers > 1)
+        if workers > 1:
+            from apps.gps_devices.receiver.sharding import ShardRouter
+
+            server.shard_router = ShardRouter(
+                index, workers,
+                socket_dir=getattr(settings, 'GPS_RECEIVER_SHARD_SOCKET_DIR', None),
+                name=f'gps_receiver_{server.port}',
+            )
+            server.shard_router.start(server.process_forwarded)
+            server.pipeline.add_stats('shard', server.shard_router.snapshot)
+            logger.info(f'GPS receiver worker {index}/{workers} starting (pid {os.getpid()})')
+        server.open_ingest_log(index if workers > 1 else None)
+
+        invalidation_listener = invalidation.InvalidationListener()
+        invalidation_listener.start()
+
+        try:
+            if engine == 'asyncio':
+                from apps.gps_devices.receiver.async_server import AsyncGPSReceiver
+                AsyncGPSReceiver(
+                    server,
+                    max_pending=getattr(settings, 'GPS_RECEIVER_MAX_PENDING', 2000),
+                    tcp_backlog=getattr(settings, 'GPS_RECEIVER_TCP_BACKLOG', 1024),
+                    idle_timeout=getattr(settings, 'GPS_RECEIVER_TCP_IDLE_TIMEOUT', 300.0),
+                ).start()
+            else:
+                server.start()
+        finally:
+            invalidation_listener.stop()
+            server.close()
+            if server.shard_router is not None:
+                server.shard_router.close()
+
 def haversine_distance(lat1, lon1, lat2, lon2):
     """
     Calculate the great circle distance between two points 
@@ -63,70 +148,220 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     r = 6371000 # Radius of earth in meters
     return c * r
     
+class UploadBatch:
+    """Work deferred to the end of a multi-record packet (see GPSReceiver.process_batch)."""
+
+    def __init__(self):
+        self.states = []  # (State, location PendingWrite or None, location id)
+        self.heartbeat = None  # fields of the newest HB record
+        self.last_location = None
+
+
+class DeviceEvent:
+    """Work for one device queued on the decode stage, in the lane of its packets (e.g. a silence timer)."""
+    __slots__ = ('lane', 'run')
+
+    def __init__(self, lane, run):
+        self.lane = lane
+        self.run = run
+
+
 class GPSReceiver:
-    def __init__(self, host='0.0.0.0', port=5000, mqtt_broker='localhost', mqtt_port=1883):
+    def __init__(self, host='0.0.0.0', port=5000, mqtt_broker='localhost', mqtt_port=1883, reuse_port=False):
         self.host = host
         self.port = port
+        # Multi-process mode: sibling workers share the port and route packets by IMEI
+        self.reuse_port = reuse_port
+        self.shard_router = None
         self.tcp_socket = None
         self.udp_socket = None
         self.mqtt_client = None
         self.mqtt_broker = mqtt_broker
         self.mqtt_port = mqtt_port
         self.mqtt_enabled = False
-        self.rate_limit_cache = {}  # For security: track IP addresses
-        self.hq_decoder = HQFullDecoder()
+        # For security: token buckets per IP / IMEI / protocol (optionally shared through Redis)
+        self.rate_limiter = RateLimiter(
+            {
+                'ip': (getattr(settings, 'GPS_RATE_LIMIT_IP_PER_MINUTE', 20), getattr(settings, 'GPS_RATE_LIMIT_IP_BURST', 20)),
+                'imei': (getattr(settings, 'GPS_RATE_LIMIT_IMEI_PER_MINUTE', 0), getattr(settings, 'GPS_RATE_LIMIT_IMEI_BURST', 0)),
+                'protocol': (getattr(settings, 'GPS_RATE_LIMIT_PROTOCOL_PER_MINUTE', 0), getattr(settings, 'GPS_RATE_LIMIT_PROTOCOL_BURST', 0)),
+            },
+            max_keys=getattr(settings, 'GPS_RATE_LIMIT_MAX_KEYS', 100000),
+            redis_url=getattr(settings, 'GPS_RATE_LIMIT_REDIS_URL', None),
+        )
+        # Compiled MaliciousPattern matcher; hit counts are written in batches
+        self.pattern_guard = MaliciousPatternGuard(
+            flush_interval=getattr(settings, 'GPS_MALICIOUS_HITS_FLUSH_INTERVAL', 30))
+        invalidation.subscribe('malicious_patterns', self.pattern_guard.invalidate)
+        self.pattern_guard.start()
+        # WebSocket updates are sent from a dedicated asyncio loop thread
+        self.broadcaster = DeviceBroadcaster(
+            window=getattr(settings, 'GPS_BROADCAST_WINDOW_MS', 250) / 1000,
+            max_batch=getattr(settings, 'GPS_BROADCAST_MAX_BATCH', 200),
+        ).start()
+        # Cells resolve from the local cell-tower store first (manage.py import_cell_towers)
+        self.cell_store = CellTowerStore.open(getattr(settings, 'GPS_CELL_DB_PATH', None))
+        self.hq_decoder = HQFullDecoder(lbs=LBSResolver(
+            cell_store=self.cell_store,
+            network=getattr(settings, 'GPS_LBS_NETWORK', True),
+            pseudo_fallback=getattr(settings, 'GPS_LBS_PSEUDO_FALLBACK', False),
+        ))
         self.gt06_decoder = GT06Decoder()
         self.jt808_decoder = JT808Decoder()
-        # Limit max threads to prevent resource exhaustion
-        self.thread_pool = ThreadPoolExecutor(max_workers=20, thread_name_prefix="GPS_Worker")
+        # Persistent TCP sessions (threads engine): one thread per open connection, capped
+        self.tcp_idle_timeout = getattr(settings, 'GPS_RECEIVER_TCP_IDLE_TIMEOUT', 300.0)
+        self.tcp_sessions = threading.BoundedSemaphore(getattr(settings, 'GPS_RECEIVER_MAX_TCP_SESSIONS', 1000))
+        # UDP (threads engine): receive threads drain the socket in batches into the decode stage.
+        # With more than one, datagrams of a device may reach the decode stage out of order.
+        self.udp_receive_workers = max(1, getattr(settings, 'GPS_UDP_RECEIVE_WORKERS', 1))
+        self.udp_batch_size = max(1, getattr(settings, 'GPS_UDP_BATCH_SIZE', 64))
+        self.udp_max_datagram = getattr(settings, 'GPS_UDP_MAX_DATAGRAM', 4096)
+        self.udp_stats = None
+        # IMEI -> device record cache, invalidated when Device rows change
+        self.device_registry = DeviceRegistry(
+            max_size=getattr(settings, 'GPS_DEVICE_REGISTRY_SIZE', 50000),
+            ttl=getattr(settings, 'GPS_DEVICE_REGISTRY_TTL', 300),
+        )
+        invalidation.subscribe('device', self.device_registry.handle_invalidation)
+        # Per-device last fix / recent points / state / counters, so a packet needs only its insert
+        self.hot_states = HotStateCache(
+            max_size=getattr(settings, 'GPS_DEVICE_HOT_STATE_SIZE', 50000),
+            ttl=getattr(settings, 'GPS_DEVICE_HOT_STATE_TTL', 3600),
+        )
+        self.counter_flush_interval = getattr(settings, 'GPS_DEVICE_COUNTER_FLUSH_INTERVAL', 60)
+        # Last heartbeat per device, upserted into DevicePresence in batches (no HB LocationData rows)
+        self.presence = PresenceTable(flush_interval=getattr(settings, 'GPS_PRESENCE_FLUSH_INTERVAL', 30)).start()
+        self._states_by_name = {}
+        # UploadBatch of the multi-record packet the current thread is processing
+        self._upload = threading.local()
+        # LocationData rows queued for the packet the current thread is processing
+        self._packet = threading.local()
+        # LocationData inserts are batched (bulk_create) by a write-behind thread
+        self.location_writer = WriteBehindWriter(
+            LocationData,
+            mode=getattr(settings, 'GPS_LOCATION_WRITE_MODE', 'before_ack'),
+            max_rows=getattr(settings, 'GPS_LOCATION_WRITE_BATCH_SIZE', 500),
+            max_delay=getattr(settings, 'GPS_LOCATION_WRITE_MAX_DELAY_MS', 50) / 1000,
+        )
+        # Every DeviceState row goes through one writer, in the order the states change
+        self.state_writer = WriteBehindWriter(
+            DeviceState,
+            mode='sync' if self.location_writer.mode == 'sync' else 'after_ack',
+            max_rows=getattr(settings, 'GPS_LOCATION_WRITE_BATCH_SIZE', 500),
+            max_delay=getattr(settings, 'GPS_LOCATION_WRITE_MAX_DELAY_MS', 50) / 1000,
+        )
+        # Listeners only enqueue; decode and enrich run on bounded stages
+        self.pipeline = Pipeline(metrics_interval=getattr(settings, 'GPS_PIPELINE_METRICS_INTERVAL', 60))
+        decode_options = dict(
+            max_queue=getattr(settings, 'GPS_PIPELINE_MAX_QUEUE', 10000),
+            policy=getattr(settings, 'GPS_PIPELINE_OVERFLOW_POLICY', 'drop_heartbeat'),
+            is_low_priority=lambda packet: not isinstance(packet, DeviceEvent) and is_heartbeat(packet[0]),
+            on_reject=self.reject_packet,
+            on_drop=self.drop_packet,
+            on_worker_exit=connections.close_all,
+        )
+        lanes = getattr(settings, 'GPS_PIPELINE_LANES', 16)
+        if lanes:
+            # One single-threaded lane per IMEI hash: a device's packets are processed in order, one at a time
+            self.decode_stage = self.pipeline.add_stage(KeyedStage(
+                'decode', self.process_queued_packet, key=self.packet_partition, lanes=lanes, **decode_options))
+        else:
+            self.decode_stage = self.pipeline.add_stage(Stage(
+                'decode', self.process_queued_packet,
+                min_workers=getattr(settings, 'GPS_PIPELINE_MIN_WORKERS', 2),
+                max_workers=getattr(settings, 'GPS_PIPELINE_MAX_WORKERS', 32),
+                target_wait=getattr(settings, 'GPS_PIPELINE_TARGET_WAIT_MS', 200) / 1000,
+                **decode_options,
+            ))
+        self.enrich_stage = self.pipeline.add_stage(Stage(
+            'enrich', lambda job: job(),
+            max_queue=getattr(settings, 'GPS_ENRICH_MAX_QUEUE', 5000),
+            max_workers=getattr(settings, 'GPS_ENRICH_MAX_WORKERS', 20),
+            on_worker_exit=connections.close_all,
+        ))
+        # Cell (LBS) lookups: cached, resolved on their own bounded stage, never during decode
+        self.cell_locator = CellLocator(
+            lambda mcc, mnc, lac, cid: self.hq_decoder.lbs.resolve(lac, cid, mcc=mcc, mnc=mnc),
+            local_resolver=self.cell_store.lookup if self.cell_store is not None else None,
+            ttl=getattr(settings, 'GPS_LBS_CACHE_TTL', 86400),
+            negative_ttl=getattr(settings, 'GPS_LBS_NEGATIVE_TTL', 900),
+            max_entries=getattr(settings, 'GPS_LBS_CACHE_SIZE', 100000),
+        )
+        self.lbs_stage = self.pipeline.add_stage(Stage(
+            'lbs', self.cell_locator.resolve_pending,
+            max_queue=getattr(settings, 'GPS_LBS_MAX_QUEUE', 1000),
+            max_workers=getattr(settings, 'GPS_LBS_MAX_WORKERS', 4),
+            on_worker_exit=connections.close_all,
+        ))
+        self.cell_locator.submit = self.lbs_stage.put
+        self.pipeline.add_stats('lbs', self.cell_locator.snapshot)
+        self.pipeline.add_gauge('persist', lambda: self.location_writer.depth)
+        self.pipeline.add_gauge('persist_states', lambda: self.state_writer.depth)
+        self.pipeline.add_gauge('broadcast', lambda: self.broadcaster.depth)
+        self.pipeline.add_gauge('presence', lambda: self.presence.pending)
+        # Ack-first: protocol ACK as soon as a valid frame is queued, before security checks and persistence
+        self.ack_first = getattr(settings, 'GPS_RECEIVER_ACK_FIRST', False)
+        self.ack_latency = self.pipeline.add_latency('ack', LatencyRecorder())
+        # Retransmitted frames within the window are ACKed but not processed again
+        self.dedup = None
+        dedup_window = getattr(settings, 'GPS_DEDUP_WINDOW_SECONDS', 600)
+        if dedup_window:
+            self.dedup = DedupWindow(window=dedup_window, max_entries=getattr(settings, 'GPS_DEDUP_MAX_ENTRIES', 100000))
+            self.pipeline.add_stats('dedup', self.dedup.snapshot)
+        self.pipeline.start()
+        # Timer wheel: Idle / Offline states for devices that went silent, without polling
+        self.silence_detector = None
+        # Set (a queue) when frames are not processed on the decode stage, see run_device_events
+        self.device_events = None
+        idle_after = getattr(settings, 'GPS_IDLE_AFTER_SECONDS', 300)
+        offline_after = getattr(settings, 'GPS_OFFLINE_AFTER_SECONDS', 600)
+        if idle_after or offline_after:
+            self.silence_detector = SilenceDetector(
+                self.on_device_silent, idle_after=idle_after, offline_after=offline_after).start()
+        # Durable log of received frames (see open_ingest_log)
+        self.ingest_log = None
+        self.ingest_log_consumer = False
 
     def start(self):
         self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.tcp_socket.bind((self.host, self.port))
-        self.tcp_socket.listen(5)
+        self.tcp_socket.listen(getattr(settings, 'GPS_RECEIVER_TCP_BACKLOG', 1024))
 
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.reuse_port:
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.udp_socket.bind((self.host, self.port))
-        # Set timeout for UDP socket to allow periodic cleanup
-        self.udp_socket.settimeout(5.0)
+        # Non-blocking: receive threads wait in select() and drain whatever is queued
+        self.udp_socket.setblocking(False)
+        self.watch_udp_socket(self.udp_socket)
 
         logger.info(f'GPS receiver listening on {self.host}:{self.port} for TCP and UDP')
 
-        # MQTT is optional; enable only if explicitly configured
-        mqtt_broker = getattr(settings, 'MQTT_BROKER', None) or os.environ.get('MQTT_BROKER')
-        mqtt_port_raw = getattr(settings, 'MQTT_PORT', None) or os.environ.get('MQTT_PORT')
-        if mqtt_broker:
-            self.mqtt_broker = mqtt_broker
-            try:
-                self.mqtt_port = int(mqtt_port_raw) if mqtt_port_raw else self.mqtt_port
-            except Exception:
-                logger.warning(f'Invalid MQTT_PORT value: {mqtt_port_raw}; using default {self.mqtt_port}')
-
-            self.mqtt_enabled = True
-            logger.info(f'MQTT listener enabled (broker={self.mqtt_broker}, port={self.mqtt_port})')
-        else:
-            self.mqtt_enabled = False
-            logger.info('MQTT listener disabled (no MQTT_BROKER configured)')
+        self.configure_mqtt()
 
         tcp_thread = threading.Thread(target=self.tcp_listen)
-        udp_thread = threading.Thread(target=self.udp_listen)
+        udp_threads = [threading.Thread(target=self.udp_listen, name=f'GPS_UDP-{index}')
+                       for index in range(self.udp_receive_workers)]
         mqtt_thread = threading.Thread(target=self.mqtt_listen)
 
         tcp_thread.start()
-        udp_thread.start()
+        for udp_thread in udp_threads:
+            udp_thread.start()
         if self.mqtt_enabled:
             mqtt_thread.start()
 
         try:
             tcp_thread.join()
-            udp_thread.join()
+            for udp_thread in udp_threads:
+                udp_thread.join()
             if self.mqtt_enabled:
                 mqtt_thread.join()
         except KeyboardInterrupt:
             logger.info('Shutting down GPS receiver')
         finally:
-            self.thread_pool.shutdown(wait=False)
             if self.tcp_socket:
                 self.tcp_socket.close()
             if self.udp_socket:
@@ -134,17 +369,91 @@ class GPSReceiver:
             if self.mqtt_client:
                 self.mqtt_client.disconnect()
 
+    def watch_udp_socket(self, sock):
+        """Size the UDP receive buffer and report the kernel's drop counters with the pipeline metrics."""
+        rcvbuf = set_receive_buffer(sock, getattr(settings, 'GPS_UDP_RCVBUF_BYTES', 4194304))
+        logger.info(f'UDP receive buffer: {rcvbuf} bytes')
+        self.udp_stats = UdpSocketStats(sock)
+        self.pipeline.add_stats('udp', self.udp_stats.snapshot)
+        return self.udp_stats
+
+    def close(self):
+        """Drain the pipeline and flush queued rows, hit counts and broadcasts."""
+        if self.silence_detector is not None:
+            self.silence_detector.close()
+        self.pipeline.close()
+        self.location_writer.close()
+        self.state_writer.close()
+        self.presence.close()
+        self.pattern_guard.close()
+        self.broadcaster.close()
+        if self.ingest_log is not None:
+            self.ingest_log.close()
+
+    def open_ingest_log(self, worker_index=None):
+        """
+        Open the ingest log configured by GPS_INGEST_LOG_DIR (one subdirectory per
+        worker process, since a log has a single writer).
+        """
+        directory = getattr(settings, 'GPS_INGEST_LOG_DIR', None)
+        if not directory:
+            return None
+        mode = getattr(settings, 'GPS_INGEST_LOG_MODE', 'tee')
+        if mode not in ('tee', 'consumer'):
+            raise ValueError(f'Unknown GPS_INGEST_LOG_MODE {mode!r} (expected tee or consumer)')
+        if worker_index is not None:
+            directory = os.path.join(directory, f'worker-{worker_index}')
+        self.ingest_log = IngestLog(
+            directory,
+            segment_size=getattr(settings, 'GPS_INGEST_LOG_SEGMENT_MB', 64) * 1024 * 1024,
+            flush_interval=getattr(settings, 'GPS_INGEST_LOG_FLUSH_INTERVAL_MS', 200) / 1000,
+            retention=getattr(settings, 'GPS_INGEST_LOG_RETENTION_HOURS', 72) * 3600,
+        )
+        self.ingest_log_consumer = mode == 'consumer'
+        if self.ingest_log_consumer and self.silence_detector is not None:
+            # gps_ingest_consumer sees every frame (including those processed here) and runs the detector
+            self.silence_detector.close()
+            self.silence_detector = None
+        logger.info(f'Ingest log at {directory} ({mode} mode, next offset {self.ingest_log.next_offset})')
+        return self.ingest_log
+
+    def configure_mqtt(self):
+        """MQTT is optional; enable only if explicitly configured"""
+        mqtt_broker = getattr(settings, 'MQTT_BROKER', None) or os.environ.get('MQTT_BROKER')
+        mqtt_port_raw = getattr(settings, 'MQTT_PORT', None) or os.environ.get('MQTT_PORT')
+        if mqtt_broker:
+            self.mqtt_broker = mqtt_broker
+            try:
+                self.mqtt_port = int(mqtt_port_raw) if mqtt_port_raw else self.mqtt_port
+            except Exception:
+                logger.warning(f'Invalid MQTT_PORT value: {mqtt_port_raw}; using default {self.mqtt_port}')
+
+            self.mqtt_enabled = True
+            logger.info(f'MQTT listener enabled (broker={self.mqtt_broker}, port={self.mqtt_port})')
+        else:
+            self.mqtt_enabled = False
+            logger.info('MQTT listener disabled (no MQTT_BROKER configured)')
+
     def tcp_listen(self):
         try:
             while True:
                 try:
                     client_socket, address = self.tcp_socket.accept()
                     logger.info(f'TCP connection from {address}')
-                    # Set timeout for client socket to prevent hanging connections
-                    client_socket.settimeout(10.0)
-                    
-                    # Submit task to thread pool instead of creating new thread
-                    self.thread_pool.submit(self.handle_client, client_socket, address)
+                    if not self.tcp_sessions.acquire(blocking=False):
+                        logger.warning(f'Rejecting TCP connection from {address}: session limit reached')
+                        client_socket.close()
+                        continue
+                    # Sessions stay open; close them only after a period without data
+                    client_socket.settimeout(self.tcp_idle_timeout)
+
+                    # Sessions are long-lived, so each one gets its own thread instead of a pool worker
+                    threading.Thread(
+                        target=self.handle_client,
+                        args=(client_socket, address),
+                        name='GPS_Session',
+                        daemon=True,
+                    ).start()
                 except OSError:
                     # Socket closed or error
                     break
@@ -152,32 +461,51 @@ class GPSReceiver:
             logger.error(f'TCP listen error: {e}')
 
     def handle_client(self, client_socket, address):
+        """Serve one persistent device connection until EOF or idle timeout."""
+        session = DeviceSession(address)
+
+        # Define callback for sending response
+        def send_response(response_data):
+            try:
+                client_socket.sendall(response_data)
+                logger.info(f'Sent response to {address}: {response_data.hex()}')
+            except Exception as e:
+                logger.error(f'Error sending response to {address}: {e}')
+
         try:
             # Ensure we start with clean connections in this thread
             close_old_connections()
-            
-            try:
-                # Receive raw bytes
-                data = client_socket.recv(1024)
-                if data:
-                    print("RAW TCP DATA:", data.hex())
 
-                    logger.info(f'Received TCP data from {address}: {data.hex()}')
-                    
-                    # Define callback for sending response
-                    def send_response(response_data):
-                        try:
-                            client_socket.send(response_data)
-                            logger.info(f'Sent response to {address}: {response_data.hex()}')
-                        except Exception as e:
-                            logger.error(f'Error sending response to {address}: {e}')
-
-                    self.process_gps_data(data, address[0], 'tcp', reply_callback=send_response)
-                    
-            except socket.timeout:
-                logger.warning(f'TCP connection timed out from {address}')
-            except Exception as e:
-                logger.error(f'Error reading from TCP client {address}: {e}')
+            while True:
+                try:
+                    data = client_socket.recv(4096)
+                    received_at = time.monotonic()
+                except socket.timeout:
+                    logger.info(f'TCP session idle timeout from {address} (imei={session.imei})')
+                    break
+                except (ConnectionResetError, BrokenPipeError):
+                    logger.info(f'TCP connection reset by {address}')
+                    break
+                if not data:
+                    break
+
+                logger.info(f'Received TCP data from {address}: {data.hex()}')
+                try:
+                    frames = session.feed(data)
+                except FrameBufferOverflow as e:
+                    logger.warning(f'Closing TCP session {address}: {e}')
+                    break
+
+                for frame in frames:
+                    reply = self.timed_reply(send_response, received_at)
+                    if self.accept_frame(frame, address[0], 'tcp', reply, session=session):
+                        continue
+                    # Processed in the device's decode lane, never on this thread; waiting for it
+                    # keeps the connection's frames in order and sends its reply before the next one
+                    done = threading.Event()
+                    if self.submit_packet(frame, address[0], 'tcp', reply_callback=reply, session=session,
+                                          done=done.set):
+                        done.wait()
         except Exception as e:
             logger.error(f'Error handling TCP client {address}: {e}')
         finally:
@@ -185,38 +513,66 @@ class GPSReceiver:
                 client_socket.close()
             except Exception:
                 pass
+            self.tcp_sessions.release()
             # Explicitly close DB connection for this thread to prevent leaks
             connections.close_all()
 
     def udp_listen(self):
+        """
+        Receive thread: wait until the socket is readable, then drain up to
+        ``udp_batch_size`` queued datagrams without blocking. Several threads
+        may share the socket; the kernel hands each datagram to one of them, so
+        a device's datagrams are then no longer guaranteed to be processed in
+        the order they arrived (one thread, the default, keeps it).
+        """
+        sock = self.udp_socket
         try:
             while True:
                 try:
-                    # Ensure old connections are closed before blocking on recv
-                    connections.close_all()
-                    
-                    data, addr = self.udp_socket.recvfrom(1024)
-                    if data:
-                        logger.info(f'Received UDP data from {addr}: {data.hex()}')
-                        
-                        # Define callback for sending response
-                        def send_response(response_data):
-                            try:
-                                self.udp_socket.sendto(response_data, addr)
-                                logger.info(f'Sent UDP response to {addr}: {response_data.hex()}')
-                            except Exception as e:
-                                logger.error(f'Error sending UDP response to {addr}: {e}')
-                                
-                        self.process_gps_data(data, addr[0], 'udp', reply_callback=send_response)
-                except socket.timeout:
-                    # Timeout allows loop to continue and clean up connections
+                    readable, _, _ = select.select([sock], [], [], 5.0)
+                except (OSError, ValueError):
+                    break  # socket closed
+                if not readable:
                     continue
+                batch = []
+                try:
+                    while len(batch) < self.udp_batch_size:
+                        batch.append(sock.recvfrom(self.udp_max_datagram))
+                except (BlockingIOError, InterruptedError):
+                    pass
                 except OSError:
-                    break
+                    if not batch:
+                        break
+                if not batch:
+                    continue  # another receive thread took it
+                received_at = time.monotonic()
+                self.udp_stats.count(len(batch))
+                for data, addr in batch:
+                    if data:
+                        self.handle_datagram(data, addr, received_at)
         except Exception as e:
             logger.error(f'UDP listen error: {e}')
 
-    def mqtt_listen(self):
+    def handle_datagram(self, data, addr, received_at):
+        logger.info(f'Received UDP data from {addr}: {data.hex()}')
+
+        # Define callback for sending response
+        def send_response(response_data):
+            try:
+                self.udp_socket.sendto(response_data, addr)
+                logger.info(f'Sent UDP response to {addr}: {response_data.hex()}')
+            except Exception as e:
+                logger.error(f'Error sending UDP response to {addr}: {e}')
+
+        reply = self.timed_reply(send_response, received_at)
+        if not self.accept_frame(data, addr[0], 'udp', reply):
+            self.submit_packet(data, addr[0], 'udp', reply_callback=reply)
+
+    def mqtt_listen(self, dispatch=None):
+        """
+        dispatch: optional function(bytes) -> None; when given, messages are
+        handed to it instead of being processed on the MQTT network thread.
+        """
         if not getattr(self, 'mqtt_enabled', False):
             return
 
@@ -229,17 +585,18 @@ class GPSReceiver:
             client.subscribe('gps/data')
 
         def on_message(client, userdata, msg):
-            # Ensure old connections are closed before processing
-            connections.close_all()
-            
+            if dispatch is not None:
+                if msg.payload:
+                    logger.info(f'Received MQTT data on topic {msg.topic}: {msg.payload.hex()}')
+                    dispatch(msg.payload)
+                return
+
             # MQTT payload is bytes
             data = msg.payload
             if data:
                 logger.info(f'Received MQTT data on topic {msg.topic}: {data.hex()}')
-                self.process_gps_data(data, None, 'mqtt')
-            
-            # Clean up after processing
-            connections.close_all()
+                if not self.accept_frame(data, None, 'mqtt'):
+                    self.submit_packet(data, None, 'mqtt')
 
         self.mqtt_client = mqtt.Client()
         self.mqtt_client.on_connect = on_connect
@@ -271,12 +628,89 @@ class GPSReceiver:
         
         return device.consecutive_count[key] >= threshold
 
+    def save_device_counters(self, device, force=False):
+        """
+        Persist consecutive_count only, so cached device fields never overwrite admin changes.
+        The live counters are in the hot state; they are written at most every
+        GPS_DEVICE_COUNTER_FLUSH_INTERVAL seconds unless forced (state transitions).
+        """
+        if self.current_batch() is not None:
+            return  # written once at the end of the batch
+        hot = self.hot_states.peek(device.id)
+        if hot is not None and not force and not hot.counters_due(self.counter_flush_interval):
+            return
+        device.save(update_fields=['consecutive_count', 'updated_at'])
+        self.device_registry.update_counters(device.imei, device.consecutive_count)
+        if hot is not None:
+            hot.mark_counters_saved()
 
-    def process_parsed_packet(self, device, parsed_data, ip_address, decoder_type, raw_data_hex, reply_callback=None):
-        """Process a single parsed packet (V1, V0, SOS, V2, HB, JT808)"""
-        packet_type = parsed_data.get('packet_type') or parsed_data.get('type')
+    def save_location(self, hot, **fields):
+        """
+        Queue a LocationData row on the write-behind writer and apply it to the hot state.
+        Returns (location, pending); work that needs the row's id goes in pending.add_callback().
+        """
+        location = LocationData(**fields)
+        location.created_at = django_timezone.now()
+        point = hot.record_location(location)
+        pending = self.location_writer.add(location)
+        rows = getattr(self._packet, 'rows', None)
+        if rows is not None:
+            rows.append(pending)
+        if point is not None:
+            pending.add_callback(lambda loc: setattr(point, 'id', loc.id))
+        batch = self.current_batch()
+        if batch is not None:
+            batch.last_location = location
+        return location, pending
+
+    def create_device_state(self, device, hot, state_name, location_pending=None, location_id=None):
+        """
+        Record a state change. All DeviceState rows are queued on the state writer, so they
+        are written in the order the states changed; a row pointing at a queued location
+        waits for that row's id on the writer thread.
+        """
+        hot.state_name = state_name
+        state = self.get_state(state_name)
+        batch = self.current_batch()
+        if batch is not None:
+            batch.states.append((state, location_pending, location_id))
+        else:
+            self.queue_device_state(device, state, location_pending, location_id)
+
+    def queue_device_state(self, device, state, location_pending=None, location_id=None):
+        before_write = None
+        if location_pending is not None:
+            timeout = self.location_writer.ack_timeout
+
+            def before_write(row):
+                if location_pending.wait(timeout) and location_pending.error is None:
+                    row.location_data_id = location_pending.instance.id
+
+        self.state_writer.add(DeviceState(device=device, state=state, location_data_id=location_id),
+                              before_write=before_write)
+
+    def get_state(self, name):
+        """State row by name, cached for the life of the process."""
+        state = self._states_by_name.get(name)
+        if state is None:
+            state, _ = State.objects.get_or_create(name=name)
+            self._states_by_name[name] = state
+        return state
+
+    def current_batch(self):
+        """UploadBatch of the multi-record packet being processed by this thread, if any."""
+        return getattr(self._upload, 'batch', None)
+
+    def save_heartbeat(self, device, hb_fields):
+        """Record the latest HB in the presence table (once per batch for UPLOAD)."""
+        batch = self.current_batch()
+        if batch is not None:
+            batch.heartbeat = hb_fields
+            return
+        self.presence.record(device.id, django_timezone.now(), **hb_fields)
 
-        # Extract Timestamp
+    def get_packet_timestamp(self, parsed_data):
+        """Device timestamp of a parsed packet (aware datetime), or now if missing/invalid."""
         packet_timestamp = parsed_data.get('timestamp')
         if isinstance(packet_timestamp, str):
             try:
@@ -289,18 +723,88 @@ class GPSReceiver:
         # Ensure timezone awareness
         if django_timezone.is_naive(packet_timestamp):
             packet_timestamp = django_timezone.make_aware(packet_timestamp)
-        
+        return packet_timestamp
+
+    def process_batch(self, device, records, ip_address, decoder_type, data, reply_callback=None):
+        """
+        Multi-record packets (HQ UPLOAD backlog after an offline period).
+        Records are applied in device-time order with the state logic running on the
+        hot state only; the latest HB and the counters are written in one transaction,
+        then the LocationData rows in one bulk_create once it committed (so their
+        callbacks, e.g. LBS backfill, see committed rows), then the state changes.
+        Map matching and per-record broadcasts are skipped; one broadcast is sent for
+        the newest location.
+        """
+        valid = []
+        for record in records:
+            # Filter out invalid records
+            rec_type = record.get('type')
+            if rec_type in ['V1', 'V0', 'SOS', 'V2', 'HB', 'JT808']:
+                # Ensure packet_type is set
+                if not record.get('packet_type'):
+                    record['packet_type'] = rec_type
+                valid.append(record)
+        valid.sort(key=self.get_packet_timestamp)
+
+        hot = self.hot_states.get(device)
+        batch = self._upload.batch = UploadBatch()
+        try:
+            # Rows are written when the transaction has committed; none if it fails
+            with self.location_writer.batch(), transaction.atomic():
+                for record in valid:
+                    # Get raw data for this record if available
+                    rec_raw = record.get('raw') or record.get('raw_sub') or data.hex()
+                    self.process_parsed_packet(device, record, ip_address, decoder_type, rec_raw, reply_callback)
+                self._upload.batch = None
+                if batch.heartbeat is not None:
+                    self.save_heartbeat(device, batch.heartbeat)
+                self.save_device_counters(device, force=True)
+        finally:
+            self._upload.batch = None
+        # Queued once the records' rows are committed (the writer must not see uncommitted ids)
+        for state, pending, location_id in batch.states:
+            self.queue_device_state(device, state, location_id=pending.instance.id if pending is not None else location_id)
+
+        logger.info(f'UPLOAD from {device.imei}: {len(valid)} records, {len(batch.states)} state changes')
+        location = batch.last_location
+        if location is not None and location.pk:
+            self.broadcast_device_update(device, speed=location.speed, heading=location.heading, location_data=location)
+            if location.latitude is not None:
+                self.enrich_stage.put(lambda: self.update_address(device, location, location.latitude, location.longitude,
+                                                                  location.speed, location.heading))
+
+
+    def process_parsed_packet(self, device, parsed_data, ip_address, decoder_type, raw_data_hex, reply_callback=None):
+        """Process a single parsed packet (V1, V0, SOS, V2, HB, JT808)"""
+        packet_type = parsed_data.get('packet_type') or parsed_data.get('type')
+        packet_timestamp = self.get_packet_timestamp(parsed_data)
+
+        hot = self.hot_states.get(device)
+        device.consecutive_count = hot.counters
+
         if packet_type == 'V0':
             # V0 (LBS Only) Packet
             logger.info(f'V0 (LBS) packet received for device {device.imei}')
-            
+
+            # Coordinates of cells resolved before come from the cache; others are looked up later
+            cell = cell_of(parsed_data) if parsed_data.get('location_resolved_via') == 'pending' else None
+            cell_known = False
+            if cell is not None:
+                cell_known, cell_location = self.cell_locator.get(cell)
+                if cell_location is not None:
+                    parsed_data['latitude'] = cell_location['lat']
+                    parsed_data['longitude'] = cell_location['lon']
+                    parsed_data['accuracy_m'] = cell_location.get('accuracy')
+                    parsed_data['location_resolved_via'] = cell_location.get('provider')
+
             # Check if we have resolved coordinates
             if parsed_data.get('latitude') is not None and parsed_data.get('longitude') is not None:
                 current_lat = float(parsed_data['latitude'])
                 current_lon = float(parsed_data['longitude'])
                 
                 # Create LocationData with source='LBS'
-                location_data = LocationData.objects.create(
+                location_data, location_pending = self.save_location(
+                    hot,
                     device=device,
                     timestamp=packet_timestamp,
                     latitude=current_lat,
@@ -327,10 +831,11 @@ class GPSReceiver:
                 
                 # Reset HB counter when other packet types received
                 self.increment_consecutive_count(device, 'v0')
-                device.save()
+                self.save_device_counters(device)
 
-                # Broadcast update
-                self.broadcast_device_update(device, speed=0, heading=0, location_data=location_data)
+                # Broadcast update once the row is committed
+                location_pending.add_callback(
+                    lambda loc: self.broadcast_device_update(device, speed=0, heading=0, location_data=loc))
                 
                 # Delete RawGpsData
                 # COMMENTED OUT: Keep RawGpsData for debugging
@@ -339,6 +844,33 @@ class GPSReceiver:
                 #     raw_data=raw_data_hex
                 # ).delete()
                 logger.info(f'Kept RawGpsData for V0 packet from {device.imei} (commented out for debugging)')
+            elif cell is not None and not cell_known:
+                # Saved now without coordinates; back-filled and broadcast once the lbs stage resolves the cell
+                location_data, location_pending = self.save_location(
+                    hot,
+                    device=device,
+                    timestamp=packet_timestamp,
+                    speed=0,
+                    heading=0,
+                    location_source='LBS',
+                    mcc=parsed_data.get('mcc'),
+                    mnc=parsed_data.get('mnc'),
+                    lac=parsed_data.get('lac'),
+                    cid=parsed_data.get('cid'),
+                    raw_data={
+                        'protocol': decoder_type,
+                        'ip_address': ip_address,
+                        'raw_hex': raw_data_hex,
+                        'packet_type': 'V0',
+                        'resolved_via': 'pending'
+                    }
+                )
+                self.increment_consecutive_count(device, 'v0')
+                self.save_device_counters(device)
+                location_pending.add_callback(
+                    lambda loc: self.cell_locator.request(
+                        cell, lambda cell_location: self.backfill_lbs_location(device, loc, cell_location)))
+                logger.info(f'Saved LBS LocationData for device {device.imei}; cell {cell} queued for resolution')
             else:
                 logger.warning(f'V0 packet from {device.imei} could not be resolved to coordinates. Keeping RawGpsData.')
 
@@ -352,7 +884,8 @@ class GPSReceiver:
                 current_lat = float(parsed_data['latitude'])
                 current_lon = float(parsed_data['longitude'])
                 
-                location_data = LocationData.objects.create(
+                location_data, location_pending = self.save_location(
+                    hot,
                     device=device,
                     timestamp=packet_timestamp,
                     latitude=current_lat,
@@ -379,10 +912,11 @@ class GPSReceiver:
                 
                 # Reset HB counter when other packet types received
                 self.increment_consecutive_count(device, 'sos')
-                device.save()
+                self.save_device_counters(device)
                 
-                # Broadcast update
-                self.broadcast_device_update(device, speed=current_speed, heading=parsed_data.get('course'), location_data=location_data)
+                # Broadcast update once the row is committed
+                location_pending.add_callback(
+                    lambda loc: self.broadcast_device_update(device, speed=current_speed, heading=parsed_data.get('course'), location_data=loc))
                 
                 # Delete RawGpsData
                 # COMMENTED OUT: Keep RawGpsData for debugging
@@ -399,20 +933,17 @@ class GPSReceiver:
             logger.info(f'V2 (Alarm) packet received for device {device.imei}')
             
             # 1. Get last known location
-            last_location = LocationData.objects.filter(device=device).order_by('-created_at').first()
+            last_location = hot.last_fix
             
             if last_location:
                 # 2. Extract alarms
-                alarm_info = parsed_data.get('alarm_info', {})
-                active_alarms = [
-                    info['name'] 
-                    for key, info in alarm_info.items() 
-                    if info.get('value')
-                ]
+                alarm_info = parsed_data.get('alarm_info')
+                active_alarms = alarm_info.active_names() if alarm_info is not None else []
                 alarm_type_str = ', '.join(active_alarms) if active_alarms else 'Unknown Alarm'
                 
                 # 3. Create new LocationData with previous coordinates
-                location_data = LocationData.objects.create(
+                location_data, location_pending = self.save_location(
+                    hot,
                     device=device,
                     timestamp=packet_timestamp,
                     latitude=last_location.latitude,
@@ -439,10 +970,11 @@ class GPSReceiver:
                 
                 # Reset HB counter when other packet types received
                 self.increment_consecutive_count(device, 'v2')
-                device.save()
+                self.save_device_counters(device)
                 
-                # Broadcast update
-                self.broadcast_device_update(device, speed=last_location.speed, heading=last_location.heading, location_data=location_data)
+                # Broadcast update once the row is committed
+                location_pending.add_callback(
+                    lambda loc: self.broadcast_device_update(device, speed=last_location.speed, heading=last_location.heading, location_data=loc))
                 
                 # Delete RawGpsData
                 # COMMENTED OUT: Keep RawGpsData for debugging
@@ -455,55 +987,34 @@ class GPSReceiver:
                 logger.warning(f'Received V2 packet for {device.imei} but no previous location found. Cannot save alarm.')
 
         elif packet_type == 'HB':
-            # Heartbeat - delete old HBs, save new one without coordinates
+            # Heartbeat - only the latest HB is kept (presence table, not LocationData)
             logger.info(f'Heartbeat received for device {device.imei}')
-            # Delete all previous HB records for this device
-            LocationData.objects.filter(device=device, packet_type='HB').delete()
-            
+
             # Extract HB data
             voltage = parsed_data.get('voltage_v')
             signal = parsed_data.get('signal_strength')
-            # Save new HB without coordinates
-            LocationData.objects.create(
-                device=device,
-                timestamp=packet_timestamp,
-                latitude=None,
-                longitude=None,
-                packet_type='HB',
-                speed=0,
-                battery_level=int(voltage * 1000) if voltage else None,
-                signal_strength=signal or 0,
-                raw_data={
-                    'protocol': decoder_type,
-                    'ip_address': ip_address,
-                    'raw_hex': raw_data_hex,
-                    'packet_type': 'HB'
-                }
-            )
+            hb_fields = {
+                'device_time': packet_timestamp,
+                'voltage': voltage or None,
+                'signal_strength': signal or 0,
+            }
+            self.save_heartbeat(device, hb_fields)
+            hot.record_heartbeat(signal, packet_timestamp)
 
             # ایجاد state اولیه اگر وجود ندارد
-            if not DeviceState.objects.filter(device=device).exists():
-                idle_state, _ = State.objects.get_or_create(name='Idle')
-                DeviceState.objects.create(
-                    device=device,
-                    state=idle_state,
-                    location_data=None
-                )
+            if hot.state_name is None:
+                self.create_device_state(device, hot, 'Idle')
                 logger.info(f'Created initial Idle state for device {device.imei}')
 
 
             # Update counter and check for Idle state
-            if self.increment_consecutive_count(device, 'HB'):
-                idle_state, _ = State.objects.get_or_create(name='Idle')
-                DeviceState.objects.create(
-                    device=device,
-                    state=idle_state,
-                    location_data=None
-                )
+            transitioned = self.increment_consecutive_count(device, 'HB')
+            if transitioned:
+                self.create_device_state(device, hot, 'Idle')
                 device.consecutive_count['HB'] = 0
                 logger.info(f'Device {device.imei} transitioned to Idle state (3 consecutive HBs)')
-            
-            device.save()
+
+            self.save_device_counters(device, force=transitioned)
             # Delete RawGpsData
             # COMMENTED OUT: Keep RawGpsData for debugging
             # RawGpsData.objects.filter(
@@ -517,16 +1028,14 @@ class GPSReceiver:
             if parsed_data.get('gps_valid'):
                 
                 # --- NEW LOGIC START ---
-                from apps.gps_devices.models import DeviceState, State
-                
                 # Get speed - HQ decoder returns speed_kph, but fallback to 'speed' field
                 current_speed = float(parsed_data.get('speed_kph') or parsed_data.get('speed', 0))
                 current_lat = float(parsed_data['latitude'])
                 current_lon = float(parsed_data['longitude'])
                 
-                # Get last DeviceState and LocationData
-                last_device_state = DeviceState.objects.filter(device=device).order_by('-timestamp').first()
-                last_location = LocationData.objects.filter(device=device).order_by('-created_at').first()
+                # Last state and last fix come from the hot state (no queries)
+                last_state_name = hot.state_name
+                last_location = hot.last_fix
                 # Determine if we should save LocationData
                 should_save_location = True
                 
@@ -534,9 +1043,7 @@ class GPSReceiver:
                 # 1. Calculate distance from last location
                 distance = 0.0
                 if last_location:
-                    last_lat = float(last_location.latitude)
-                    last_lon = float(last_location.longitude)
-                    distance = haversine_distance(current_lat, current_lon, last_lat, last_lon)
+                    distance = haversine_distance(current_lat, current_lon, last_location.latitude, last_location.longitude)
 
                 # 2. Check ACC status (if available)
                 acc_on = parsed_data.get('acc_on')
@@ -558,7 +1065,7 @@ class GPSReceiver:
                     self.increment_consecutive_count(device, 'stopped')
                 else:
                     self.increment_consecutive_count(device, 'moving')
-                device.save()
+                self.save_device_counters(device)
 
                                 # جلوگیری از ذخیره داده‌های تکراری با سرعت صفر
                 if current_speed == 0 and distance < 5.0:
@@ -571,20 +1078,16 @@ class GPSReceiver:
                 should_save_state = False
                 state_name = None
 
-                if not last_device_state:
+                if not last_state_name:
                     # First time - save state
                     should_save_state = True
                     state_name = 'Moving' if current_speed > 0 else 'Stopped'
                     logger.info(f"First state for device {device.imei}: {state_name}")
                 else:
-                    last_state_name = last_device_state.state.name
-                    
                     # Check for Moving -> Stopped transition
                     if last_state_name == 'Moving' and current_speed == 0:
-                        # Get 2 most recent locations (not including current)
-                        recent_locations = LocationData.objects.filter(
-                            device=device
-                        ).order_by('-created_at')[:2]
+                        # 2 most recent locations (not including current)
+                        recent_locations = hot.recent(2)
                         
                         # Count zero speeds in previous 2 records
                         previous_zero_count = sum(1 for loc in recent_locations if loc.speed == 0)
@@ -599,9 +1102,7 @@ class GPSReceiver:
                     # Check for Stopped -> Moving transition
                     elif last_state_name == 'Stopped' and current_speed > 0:
                         if last_location:
-                            last_lat = float(last_location.latitude)
-                            last_lon = float(last_location.longitude)
-                            distance = haversine_distance(current_lat, current_lon, last_lat, last_lon)
+                            distance = haversine_distance(current_lat, current_lon, last_location.latitude, last_location.longitude)
                             
                             if distance > 5.0:  # Moved more than 5 meters
                                 should_save_state = True
@@ -631,15 +1132,11 @@ class GPSReceiver:
                         logger.info(f"Device {device.imei}: Found GSM signal in field '{field_name}' = {signal_strength_val}")
                         break
 
-                # Fallback to last HB packet only if decoder didn't provide signal
+                # Fallback to last known signal (normally from the last HB) only if decoder didn't provide signal
                 if signal_strength_val is None:
-                    last_hb = LocationData.objects.filter(
-                        device=device, 
-                        packet_type='HB'
-                    ).order_by('-created_at').first()
-                    if last_hb and last_hb.signal_strength:
-                        signal_strength_val = last_hb.signal_strength
-                        logger.info(f"Device {device.imei}: Using GSM signal from last HB = {signal_strength_val}")
+                    if hot.last_signal:
+                        signal_strength_val = hot.last_signal
+                        logger.info(f"Device {device.imei}: Using last known GSM signal = {signal_strength_val}")
                     else:
                         signal_strength_val = None
                         logger.info(f"Device {device.imei}: No GSM signal available (decoder or HB)")
@@ -655,6 +1152,7 @@ class GPSReceiver:
 
                 # Save LocationData if needed
                 location_data = None
+                location_pending = None
                 if should_save_location:
                     # ذخیره مختصات اصلی
                     original_lat = current_lat
@@ -670,16 +1168,12 @@ class GPSReceiver:
                         from apps.gps_devices.services import MapMatchingService
                         
                         # فقط برای دستگاه‌های در حال حرکت Map Matching اعمال می‌شود
-                        if current_speed > 0:
-                            # دریافت 9 نقطه آخر برای Map Matching
-                            recent_locations = LocationData.objects.filter(
-                                device=device
-                            ).order_by('-created_at')[:9]  # 9 نقطه قبلی + نقطه فعلی = 10
-                            
-                            # ساخت لیست نقاط
-                            points = [(float(original_lat), float(original_lon))]
-                            for loc in reversed(list(recent_locations)):
-                                points.insert(0, (float(loc.latitude), float(loc.longitude)))
+                        if self.current_batch() is not None:
+                            logger.info(f"Skipping map matching for {device.imei}: UPLOAD backlog record")
+                        elif current_speed > 0:
+                            # 9 نقطه آخر برای Map Matching از حافظه (9 نقطه قبلی + نقطه فعلی = 10)
+                            points = [(loc.latitude, loc.longitude) for loc in hot.points]
+                            points.append((float(original_lat), float(original_lon)))
                             
                             # فراخوانی Map Matching اگر حداقل 2 نقطه داریم
                             if len(points) >= 2:
@@ -711,7 +1205,8 @@ class GPSReceiver:
                         # در صورت خطا، از مختصات اصلی استفاده می‌شود
 
                     # Create LocationData with extracted signal values
-                    location_data = LocationData.objects.create(
+                    location_data, location_pending = self.save_location(
+                        hot,
                         device=device,
                         timestamp=packet_timestamp,
                         latitude=matched_lat,  # مختصات تصحیح شده
@@ -741,72 +1236,44 @@ class GPSReceiver:
                 
                 # Save DeviceState if state changed
                 # Save DeviceState if state changed (Standard logic)
+                # DeviceState rows point at this packet's location (written after it commits) or the last fix
+                last_location_id = getattr(last_location, 'id', None)
                 if should_save_state and state_name:
-                    state_obj, _ = State.objects.get_or_create(name=state_name)
-                    DeviceState.objects.create(
-                        device=device,
-                        state=state_obj,
-                        location_data=location_data or last_location
-                    )
+                    self.create_device_state(device, hot, state_name, location_pending, last_location_id)
                     logger.info(f'Saved DeviceState for device {device.imei}: {state_name}')
                 
                 # Check for counter-based state changes (Stopped/Moving)
                 # This logic runs AFTER location_data is created
                 if current_speed == 0 and distance < 5.0:
                     if device.consecutive_count.get('stopped', 0) >= 3:
-                        stopped_state, _ = State.objects.get_or_create(name='Stopped')
                         # Check if we are already in Stopped state to avoid duplicate entries if logic overlaps
-                        current_state_record = DeviceState.objects.filter(device=device).order_by('-timestamp').first()
-                        if not current_state_record or current_state_record.state.name != 'Stopped':
-                            DeviceState.objects.create(
-                                device=device, 
-                                state=stopped_state, 
-                                location_data=location_data or last_location
-                            )
+                        if hot.state_name != 'Stopped':
+                            self.create_device_state(device, hot, 'Stopped', location_pending, last_location_id)
                             logger.info(f"Counter-based state change for {device.imei}: -> Stopped")
                         
                         device.consecutive_count['stopped'] = 0
-                        device.save()
+                        self.save_device_counters(device, force=True)
                 else:
                     if device.consecutive_count.get('moving', 0) >= 3:
-                        moving_state, _ = State.objects.get_or_create(name='Moving')
                         # Check if we are already in Moving state
-                        current_state_record = DeviceState.objects.filter(device=device).order_by('-timestamp').first()
-                        if not current_state_record or current_state_record.state.name != 'Moving':
-                            DeviceState.objects.create(
-                                device=device, 
-                                state=moving_state, 
-                                location_data=location_data or last_location
-                            )
+                        if hot.state_name != 'Moving':
+                            self.create_device_state(device, hot, 'Moving', location_pending, last_location_id)
                             logger.info(f"Counter-based state change for {device.imei}: -> Moving")
                         
                         device.consecutive_count['moving'] = 0
-                        device.save()
+                        self.save_device_counters(device, force=True)
                 
-                # Broadcast update if we saved location data
-                if should_save_location and location_data:
-                    # Async Reverse Geocoding
-                    def fetch_address_and_update(loc_id, lat, lon):
-                        try:
-                            # Re-fetch to ensure we have the latest object (though unnecessary if we just update fields)
-                            service = ReverseGeocodingService()
-                            address = service.get_address(lat, lon)
-                            if address:
-                                # Use filter().update() for atomic update or just save
-                                LocationData.objects.filter(id=loc_id).update(address=address)
-                                logger.info(f"Updated address for LocationData {loc_id}: {address[:30]}...")
-                                
-                                # Re-broadcast to show address on map immediately
-                                # We need to get the fresh location_data object
-                                updated_loc = LocationData.objects.get(id=loc_id)
-                                self.broadcast_device_update(device, speed=current_speed, heading=parsed_data.get('course'), location_data=updated_loc)
-                        except Exception as e:
-                            logger.error(f"Error in async reverse geocoding for {loc_id}: {e}")
+                # Broadcast update if we saved location data (UPLOAD batches broadcast once at the end)
+                if should_save_location and location_data and self.current_batch() is None:
+                    heading = parsed_data.get('course')
 
-                    # Submit to thread pool
-                    self.thread_pool.submit(fetch_address_and_update, location_data.id, matched_lat, matched_lon)
+                    def on_location_saved(loc):
+                        # Async Reverse Geocoding on the enrich stage
+                        self.enrich_stage.put(
+                            lambda: self.update_address(device, loc, matched_lat, matched_lon, current_speed, heading))
+                        self.broadcast_device_update(device, speed=current_speed, heading=heading, location_data=loc)
 
-                    self.broadcast_device_update(device, speed=current_speed, heading=parsed_data.get('course'), location_data=location_data)
+                    location_pending.add_callback(on_location_saved)
 
                 # فقط اگر LocationData ذخیره شد، RawGpsData را حذف کن
                 # COMMENTED OUT: Keep RawGpsData for debugging
@@ -839,7 +1306,8 @@ class GPSReceiver:
                 current_lon = float(parsed_data.get('longitude'))
     
                 # ذخیره LocationData
-                location_data = LocationData.objects.create(
+                location_data, location_pending = self.save_location(
+                    hot,
                     device=device,
                     timestamp=packet_timestamp,
                     latitude=current_lat,
@@ -868,15 +1336,15 @@ class GPSReceiver:
     
                 # Reset HB counter when other packet types received
                 self.increment_consecutive_count(device, 'jt808')
-                device.save()
+                self.save_device_counters(device)
                 
-                # Broadcast به WebSocket
-                self.broadcast_device_update(
+                # Broadcast به WebSocket (بعد از ثبت در دیتابیس)
+                location_pending.add_callback(lambda loc: self.broadcast_device_update(
                     device, 
                     speed=current_speed, 
                     heading=parsed_data.get('course') or parsed_data.get('heading', 0),
-                    location_data=location_data
-                )
+                    location_data=loc
+                ))
     
                 # حذف RawGpsData بعد از ذخیره موفق
                 # COMMENTED OUT: Keep RawGpsData for debugging
@@ -890,15 +1358,30 @@ class GPSReceiver:
 
 
 
-    def process_gps_data(self, data, ip_address, protocol_type, reply_callback=None):
+    def process_gps_data(self, data, ip_address, protocol_type, reply_callback=None, session=None, forwarded_imei=None,
+                         from_log=False):
         """
         Process GPS data: parse, validate, check device, save to LocationData
-        Data is expected to be bytes.
+        Data is expected to be bytes (one complete frame).
         reply_callback: function(bytes) -> None, used to send response back to device
+        session: DeviceSession of the TCP connection the frame arrived on, if any
+        forwarded_imei: set when a sibling worker forwarded the frame to this one
+            (the receiving worker already sent the ACK); the IMEI of the frame's
+            connection there, used for frames that carry none (GT06)
+        from_log: frame read back from the ingest log (no rate limits: a backlog
+            is processed much faster than it was received)
+        Returns False if processing failed with an error (e.g. the database is
+        down), so the caller can retry the frame; None otherwise.
         """
+        # Protocol response of the decoded frame; sent once its rows are committed
+        response = None
         try:
+            # Frames with a routing key were already routed to their owner by accept_frame
+            route_after_decode = (self.shard_router is not None and not forwarded_imei
+                                  and self.shard_key(data, session) is None)
+
             # Security check
-            security_result = self.check_security(ip_address, data)
+            security_result = self.check_security(ip_address, data, protocol_type, rate_limit=not from_log)
             if security_result != 'safe':
                 # اگر داده مخرب بود، کلاً نادیده بگیر و ذخیره نکن
                 if security_result == 'malicious':
@@ -947,11 +1430,20 @@ class GPSReceiver:
 
             # Common processing logic
             parsed_data = decoded # Decoders should return compatible dicts
+
+            # Persistent TCP sessions: remember the IMEI announced at login and use it
+            # for packets that carry none (GT06 location/heartbeat)
+            if session is not None:
+                if parsed_data.get('imei'):
+                    session.bind(parsed_data['imei'])
+                elif session.imei:
+                    parsed_data['imei'] = session.imei
+            if forwarded_imei and not parsed_data.get('imei'):
+                parsed_data['imei'] = forwarded_imei
             
-            # Handle Response (e.g. JT808 Registration Handshake)
+            # Handle Response (e.g. JT808 Registration Handshake): sent at the end, after the rows commit
             if "response" in parsed_data and reply_callback:
-                logger.info(f'Sending response for {decoder_type} packet')
-                reply_callback(parsed_data["response"])
+                response = parsed_data["response"]
             
             # Find device by device_id (IMEI)
             device_id = parsed_data.get('imei') or parsed_data.get('device_id')
@@ -959,8 +1451,19 @@ class GPSReceiver:
                 self.save_raw_data(data, ip_address, protocol_type, error_message='No Device ID found')
                 return
 
+            # Multi-process mode: a frame whose device was only known after decoding it
+            # (GT06 login) goes to the worker owning the IMEI now
+            if route_after_decode and not self.shard_router.owns(device_id):
+                if self.shard_router.forward(device_id, data, ip_address, protocol_type, reply_callback):
+                    return
+
+            # Per-device rate limit (checked by the worker owning the IMEI)
+            if not from_log and not self.rate_limiter.allow('imei', device_id):
+                self.save_raw_data(data, ip_address, protocol_type, status='rejected', error_message='Security check failed: rate_limited')
+                return
+
             try:
-                device = Device.objects.get(imei=device_id)
+                device = self.device_registry.get_device(device_id)
             except Device.DoesNotExist:
                 # Device not registered - automatically create it and assign to admin
                 try:
@@ -1023,6 +1526,7 @@ class GPSReceiver:
                         model=default_model,  
                         status='active'
                     )
+                    self.device_registry.remember(device)
                     logger.info(f'Automatically created device {device.imei} with model {default_model.model_name} and assigned to admin')
 
                 except Exception as e:
@@ -1036,31 +1540,21 @@ class GPSReceiver:
                 return
 
             packet_type = parsed_data.get('packet_type') or parsed_data.get('type')
+            self.mark_seen(device, packet_type, data,
+                           lane=self.packet_lane(data, ip_address, protocol_type, session, forwarded_imei))
+
+            dedup_key = self.dedup_key(device, parsed_data, data, packet_type)
+            if dedup_key is not None and self.dedup.contains(dedup_key, protocol=decoder_type):
+                logger.info(f'Duplicate {decoder_type} {packet_type} packet from {device.imei}; acknowledged, not stored')
+                if decoder_type == 'HQ' and packet_type != 'UPLOAD':
+                    self.send_hq_ack(reply_callback)
+                return
+            self._packet.rows = []
 
             # Handle UPLOAD packets (batch upload)
             if packet_type == 'UPLOAD':
                 logger.info(f'UPLOAD packet received from {device.imei} with {len(parsed_data.get("records", []))} records')
-                
-                records = parsed_data.get('records', [])
-                for record in records:
-                    # Filter out invalid records
-                    rec_type = record.get('type')
-                    if rec_type in ['V1', 'V0', 'SOS', 'V2', 'HB', 'JT808']:
-                        # Ensure packet_type is set
-                        if not record.get('packet_type'):
-                            record['packet_type'] = rec_type
-                        
-                        # Get raw data for this record if available
-                        rec_raw = record.get('raw') or record.get('raw_sub') or data.hex()
-                        
-                        self.process_parsed_packet(
-                            device, 
-                            record, 
-                            ip_address, 
-                            decoder_type, 
-                            rec_raw, 
-                            reply_callback
-                        )
+                self.process_batch(device, parsed_data.get('records', []), ip_address, decoder_type, data, reply_callback)
                 
             else:
                 # حالت عادی (تک پکت)
@@ -1073,16 +1567,14 @@ class GPSReceiver:
                     reply_callback
                 )
 
+            # A retransmission is only dropped once this copy's rows are saved
+            if dedup_key is not None:
+                self.remember_packet(dedup_key, self._packet.rows)
 
+            if decoder_type == 'HQ' and packet_type != 'UPLOAD':
                 # After processing all records, send reply if needed
-                if reply_callback and decoder_type == 'HQ':
-                    try:
-                        response = bytes.fromhex('2a48512c3030303030303030303030302c56312c3030303030302c412c302e3030303030302c4e2c302e3030303030302c452c302e30302c302c3030303030302c46464646464646462c3030302c30302c303030302c303030302c232a')
-                        reply_callback(response)
-                    except Exception as e:
-                        logger.error(f'Error sending UPLOAD response: {e}')
-                
-                return
+                self.send_hq_ack(reply_callback)
+            return
 
 
 # *****************************************
@@ -1098,99 +1590,330 @@ class GPSReceiver:
 
 
         except Exception as e:
+            response = None  # not processed: no ACK, so the device retransmits
             logger.error(f'Error processing GPS data: {e}')
             self.save_raw_data(data, ip_address, protocol_type, error_message=str(e))
+            return False
+        finally:
+            if response is not None:
+                logger.info(f'Sending response for {decoder_type} packet')
+                self.send_ack(reply_callback, response)
+            self.location_writer.forget_pending()
+            self._packet.rows = None
 
-    def check_security(self, ip_address, data):
+    def mark_seen(self, device, packet_type, data, lane=None):
         """
-        Security checks: rate limiting and malicious/suspicious data detection
-        Returns: 'safe' | 'suspicious' | 'malicious' | 'rate_limited'
+        Presence and silence timers for a packet from ``device`` (O(1)); ends an Offline
+        state. ``lane`` is the decode lane of the device's packets, where its silence
+        events run.
         """
-        from datetime import datetime, timedelta
+        self.presence.seen(device.id, django_timezone.now())
+        if self.silence_detector is None:
+            if self.ingest_log_consumer:
+                # Idle/Offline states belong to gps_ingest_consumer, which runs the detector
+                return
+        else:
+            heartbeat = packet_type in ('HB', 'HEARTBEAT') or is_heartbeat(data)
+            self.silence_detector.touch(device.id, (device.imei, lane or device.imei), location=not heartbeat)
+        hot = self.hot_states.get(device)
+        if hot.state_name == 'Offline':
+            self.create_device_state(device, hot, 'Idle')
+            logger.info(f'Device {device.imei} is back online')
+
+    def mark_frame_seen(self, data, imei):
+        """A frame of ``imei`` that another process handled (the receiver, in ingest log consumer mode)."""
+        if self.silence_detector is None or not imei:
+            return
+        try:
+            device = self.device_registry.get_device(imei)
+        except Device.DoesNotExist:
+            return
+        self.mark_seen(device, None, data, lane=imei)
 
-        current_time = datetime.now()
+    def on_device_silent(self, device_id, payload, kind):
+        """
+        SilenceDetector callback (wheel thread): queue the state change in the device's
+        decode lane, or for the thread processing the frames when ``device_events`` is set.
+        """
+        imei, lane = payload
+        event = DeviceEvent(lane, lambda: self.mark_silent(device_id, imei, kind))
+        if self.device_events is not None:
+            self.device_events.put(event)
+        else:
+            self.decode_stage.put(event)
 
-        # بررسی الگوهای مخرب از دیتابیس
-        
-        
+    def run_device_events(self):
+        """Run the queued ``device_events`` (on the thread that processes the frames)."""
+        while True:
+            try:
+                event = self.device_events.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                event.run()
+            except Exception as e:
+                logger.error(f'Device event for {event.lane} failed: {e}')
+
+    def mark_silent(self, device_id, imei, kind):
+        """Record an Idle (no location) or Offline (no packet at all) state and broadcast it."""
+        detector = self.silence_detector
+        if detector is None or not detector.is_silent(device_id, kind):
+            # A packet arrived after the timer fired (it restarted the timer)
+            return
         try:
-            # تبدیل data به رشته برای بررسی
+            device = self.device_registry.get_device(imei)
+        except Device.DoesNotExist:
+            logger.info(f'Device {imei} went silent but no longer exists')
+            return
+        hot = self.hot_states.get(device)
+        state_name = 'Offline' if kind == 'offline' else 'Idle'
+        if kind == 'offline':
+            self.presence.set_offline(device.id)
+        if hot.state_name in (state_name, 'Offline'):
+            return
+        last_fix = hot.last_fix
+        self.create_device_state(device, hot, state_name, location_id=last_fix.id if last_fix is not None else None)
+        logger.info(f'Device {device.imei} transitioned to {state_name} state (silent)')
+        self.broadcast_device_update(device)
+
+    def dedup_key(self, device, parsed_data, data, packet_type):
+        """
+        Dedup key of a packet (IMEI + device timestamp + payload + JT808 serial), or None
+        if it is not deduplicated. Only packets with a device timestamp (or UPLOAD
+        batches, whose records carry them) are checked, never heartbeats.
+        """
+        if self.dedup is None or packet_type in ('HB', 'HEARTBEAT') or is_heartbeat(data):
+            return None
+        timestamp = parsed_data.get('timestamp')
+        if timestamp is None and packet_type != 'UPLOAD':
+            return None
+        return packet_key(device.imei, timestamp, data, parsed_data.get('msg_serial'))
+
+    def remember_packet(self, key, rows):
+        """
+        Add a processed packet to the dedup window once all its LocationData rows are
+        committed. If one fails the key is never added, so the retransmission is stored.
+        """
+        if not rows:
+            self.dedup.add(key)
+            return
+        remaining = [len(rows)]
+        lock = threading.Lock()
+
+        def on_saved(_):
+            with lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                self.dedup.add(key)
+
+        for pending in rows:
+            pending.add_callback(on_saved)
+
+    def submit_packet(self, data, ip_address, protocol_type, reply_callback=None, session=None, forwarded_imei=None,
+                      done=None):
+        """
+        Queue a packet for the decode stage. Returns False if it was rejected;
+        otherwise ``done()`` is called once it was processed or dropped.
+        """
+        return self.decode_stage.put((data, ip_address, protocol_type, reply_callback, session, forwarded_imei, done))
+
+    def packet_partition(self, packet):
+        """
+        Decode lane key of a queued packet: the device id in the frame, else its
+        connection's IMEI or the connection itself.
+        """
+        if isinstance(packet, DeviceEvent):
+            return packet.lane
+        data, ip_address, protocol_type, _, session, forwarded_imei, _ = packet
+        return self.packet_lane(data, ip_address, protocol_type, session, forwarded_imei)
+
+    def packet_lane(self, data, ip_address, protocol_type, session=None, forwarded_imei=None):
+        key = frame_device_key(data)
+        if key:
+            return key
+        if session is not None:
+            # Once the login bound the IMEI the device keeps its lane across reconnects, and
+            # shares it with its silence events. Safe: a session waits for each of its frames.
+            return session.imei or f'session:{session.id}'
+        if forwarded_imei:
+            return forwarded_imei
+        return f'{protocol_type}:{ip_address}'
+
+    def process_queued_packet(self, packet):
+        if isinstance(packet, DeviceEvent):
+            close_old_connections()
             try:
-                data_str = data.decode('utf-8', errors='ignore')
-            except:
-                data_str = data.hex()
-            
-            # بررسی تمام الگوهای فعال
-            active_patterns = MaliciousPattern.objects.filter(is_active=True)
-            for pattern in active_patterns:
-                matched = False
-                ip_matched = False
-                content_matched = False
-
-                # بررسی IP (اگر در الگو تعریف شده باشد)
-                if pattern.ip_address:
-                    ip_matched = (ip_address == pattern.ip_address)
-                
-                # بررسی محتوا (اگر الگو تعریف شده باشد)
-                if pattern.pattern:
-                    if pattern.pattern_type == 'exact':
-                        content_matched = data_str == pattern.pattern or data.hex() == pattern.pattern
-                    elif pattern.pattern_type == 'startswith':
-                        content_matched = data_str.startswith(pattern.pattern) or data.hex().startswith(pattern.pattern)
-                    elif pattern.pattern_type == 'contains':
-                        content_matched = pattern.pattern in data_str or pattern.pattern in data.hex()
-                    elif pattern.pattern_type == 'regex':
-                        try:
-                            content_matched = re.search(pattern.pattern, data_str) is not None or re.search(pattern.pattern, data.hex()) is not None
-                        except:
-                            pass
-                
-                # تعیین نتیجه نهایی بر اساس سناریوهای مختلف
-                # Scenario 1: هم pattern و هم IP تعریف شده → بلاک اگر یکی مطابقت داشت (OR logic)
-                # Scenario 2: فقط pattern تعریف شده → بلاک اگر pattern مطابقت داشت
-                # Scenario 3: فقط IP تعریف شده → بلاک اگر IP مطابقت داشت
-                if pattern.pattern and pattern.ip_address:
-                    # هر دو تعریف شده: OR logic
-                    matched = ip_matched or content_matched
-                elif pattern.pattern:
-                    # فقط pattern: بررسی محتوا
-                    matched = content_matched
-                elif pattern.ip_address:
-                    # فقط IP: بررسی IP
-                    matched = ip_matched
-                else:
-                    # هیچکدام تعریف نشده: الگوی نامعتبر
-                    matched = False
-                
+                packet.run()
+            finally:
+                close_old_connections()
+            return
+        data, ip_address, protocol_type, reply_callback, session, forwarded_imei, done = packet
+        close_old_connections()
+        try:
+            self.process_gps_data(data, ip_address, protocol_type, reply_callback=reply_callback, session=session,
+                                  forwarded_imei=forwarded_imei)
+        finally:
+            close_old_connections()
+            if done is not None:
+                done()
 
-                if matched:
-                    # به‌روزرسانی آمار
-                    from django.utils import timezone
-                    pattern.hit_count += 1
-                    pattern.last_hit = timezone.now()
-                    pattern.save(update_fields=['hit_count', 'last_hit'])
-                    
-                    logger.warning(f'Malicious pattern matched from {ip_address}: {pattern.description or pattern.pattern[:50]}')
-                    return 'malicious'
+    def drop_packet(self, packet):
+        """Overflow policies 'drop_*': the evicted packet is not ACKed (the device resends)."""
+        if isinstance(packet, DeviceEvent):
+            logger.warning(f'Dropped device event for lane {packet.lane}: decode queue full')
+            return
+        logger.warning(f'Dropped {packet[2]} packet from {packet[1]}: decode queue full')
+        done = packet[6]
+        if done is not None:
+            done()
+
+    def reject_packet(self, packet):
+        """Overflow policy 'reject': no ACK (the device resends), explicit failure reply for JT808."""
+        if isinstance(packet, DeviceEvent):
+            logger.warning(f'Dropping device event for lane {packet.lane}: decode queue full')
+            return
+        data, ip_address, protocol_type, reply_callback = packet[:4]
+        logger.warning(f'Rejecting {protocol_type} packet from {ip_address}: decode queue full')
+        if reply_callback and data[:1] == b'\x7e':
+            nak = self.jt808_decoder.generate_failure_response(data)
+            if nak:
+                reply_callback(nak)
+
+    def timed_reply(self, send_response, received_at):
+        """Wrap a reply callback so its first reply records last-byte-received -> ACK-sent latency."""
+        sent = []
+
+        def reply(response_data):
+            send_response(response_data)
+            if not sent:
+                sent.append(True)
+                self.ack_latency.record(time.monotonic() - received_at)
+
+        return reply
+
+    def early_ack(self, data):
+        """Protocol ACK for a well-formed frame, built without decoding it (None if there is none)."""
+        protocol = detect_protocol(data)
+        if protocol == 'JT808':
+            return self.jt808_decoder.generate_ack(data)
+        if protocol == 'HQ' and data.startswith(b'*HQ,') and data.rstrip().endswith(b'#'):
+            fields = data.split(b',', 3)
+            # UPLOAD batches are not acknowledged (same as the normal path)
+            if len(fields) > 2 and fields[2] != b'UPLOAD':
+                return HQ_ACK_RESPONSE
+        return None
+
+    def ack_first_packet(self, data, ip_address, protocol_type, reply_callback, session=None):
+        """
+        Ack-first mode: queue a frame that can be acknowledged without decoding and
+        ACK it right away; processing continues on the decode stage without a reply
+        callback. Returns False when the frame takes the normal path (TCP sessions
+        then queue it in the same lane, see handle_client).
+        """
+        if not self.ack_first or reply_callback is None:
+            return False
+        ack = self.early_ack(data)
+        if ack is None:
+            return False
+        if self.submit_packet(data, ip_address, protocol_type, session=session):
+            reply_callback(ack)
+        return True
+
+    def accept_frame(self, data, ip_address, protocol_type, reply_callback=None, session=None, forwarded_imei=None):
+        """
+        First step for every received frame. In multi-process mode a frame of a device
+        owned by a sibling worker is forwarded to it. With the ingest log enabled the
+        frame is appended to it; in consumer mode a frame that needs no decoded reply (it
+        can be ACKed without decoding, or nothing is replied) is only ACKed and left to
+        gps_ingest_consumer. Returns True when the frame needs no further handling here.
+        """
+        if forwarded_imei is None and self.route_frame(data, ip_address, protocol_type, reply_callback, session):
+            return True
+        if self.ingest_log is None:
+            return self.ack_first_packet(data, ip_address, protocol_type, reply_callback, session=session)
+
+        ack = self.early_ack(data) if reply_callback is not None else None
+        deferred = self.ingest_log_consumer and (reply_callback is None or ack is not None)
+        try:
+            self.ingest_log.append(encode_frame(
+                data, ip_address, protocol_type,
+                connection_id=session.id if session is not None else 0,
+                imei=session.imei if session is not None else forwarded_imei,
+                processed=not deferred,
+            ))
         except Exception as e:
-            logger.error(f'Error checking malicious patterns: {e}')
-            
+            # Never lose a frame to the log: process it here instead
+            logger.error(f'Ingest log append failed: {e}')
+            deferred = False
+        if deferred:
+            if ack is not None:
+                reply_callback(ack)
+            return True
+        return self.ack_first_packet(data, ip_address, protocol_type, reply_callback, session=session)
+
+    def send_hq_ack(self, reply_callback):
+        """Send the fixed HQ acknowledgement frame."""
+        self.send_ack(reply_callback, HQ_ACK_RESPONSE)
+
+    def send_ack(self, reply_callback, response):
+        """Send a protocol response once the packet's rows are committed (before_ack mode)."""
+        if not reply_callback:
+            return
+        # before_ack durability: only acknowledge once this packet's rows are committed
+        if not self.location_writer.wait_pending():
+            logger.warning('LocationData not committed in time; not acknowledging so the device retransmits')
+            return
+        try:
+            reply_callback(response)
+        except Exception as e:
+            logger.error(f'Error sending response: {e}')
 
-        # Rate limiting: max 20 requests per minute per IP
-        if ip_address not in self.rate_limit_cache:
-            self.rate_limit_cache[ip_address] = []
+    def shard_key(self, data, session=None):
+        """Routing key of a frame between workers: the device id in its header, else its connection's IMEI."""
+        return frame_device_key(data) or (session.imei if session is not None else None)
 
-        # Clean old entries
-        self.rate_limit_cache[ip_address] = [
-            t for t in self.rate_limit_cache[ip_address]
-            if current_time - t < timedelta(minutes=1)
-        ]
+    def route_frame(self, data, ip_address, protocol_type, reply_callback=None, session=None):
+        """
+        Multi-process mode: forward a frame of a device owned by a sibling worker
+        before decoding it. Its reply comes back from the owner (once the frame is
+        committed there) and goes to ``reply_callback``. Returns True if the frame
+        was forwarded.
+        """
+        if self.shard_router is None:
+            return False
+        key = self.shard_key(data, session)
+        if key is None or self.shard_router.owns(key):
+            return False
+        return self.shard_router.forward(key, data, ip_address, protocol_type, reply_callback)
+
+    def process_forwarded(self, imei, data, ip_address, protocol_type, reply_callback=None):
+        """
+        Handler for frames forwarded by sibling workers (router thread): queued in the
+        device's decode lane; ``reply_callback`` sends the reply back to the sender.
+        """
+        if not self.accept_frame(data, ip_address, protocol_type, reply_callback, forwarded_imei=imei):
+            self.submit_packet(data, ip_address, protocol_type, reply_callback=reply_callback, forwarded_imei=imei)
 
-        # Check rate limit
-        if len(self.rate_limit_cache[ip_address]) >= 20:
-            return 'rate_limited'
+    def check_security(self, ip_address, data, protocol_type=None, rate_limit=True):
+        """
+        Security checks: rate limiting and malicious/suspicious data detection
+        Returns: 'safe' | 'suspicious' | 'malicious' | 'rate_limited'
+        """
+        # بررسی الگوهای مخرب (compiled once, rebuilt when MaliciousPattern changes)
+        try:
+            matched = self.pattern_guard.check(ip_address, data)
+            if matched is not None:
+                logger.warning(f'Malicious pattern matched from {ip_address}: {matched.label}')
+                return 'malicious'
+        except Exception as e:
+            logger.error(f'Error checking malicious patterns: {e}')
 
-        self.rate_limit_cache[ip_address].append(current_time)
+        # Rate limiting: token bucket per IP (default 20 per minute) and per protocol
+        if rate_limit and not self.rate_limiter.allow('ip', ip_address):
+            return 'rate_limited'
+        if rate_limit and protocol_type and not self.rate_limiter.allow('protocol', protocol_type):
+            return 'rate_limited'
 
         # Enhanced malicious data detection
         if len(data) > 2000:  # Too long
@@ -1230,133 +1953,66 @@ class GPSReceiver:
         return 'suspicious'
 
     
+    def backfill_lbs_location(self, device, loc, cell_location):
+        """Store the coordinates of a resolved cell on its LBS location and broadcast it (lbs stage)."""
+        if cell_location is None:
+            logger.info(f'Cell of LocationData {loc.id} ({device.imei}) could not be resolved')
+            return
+        loc.latitude = loc.original_latitude = cell_location['lat']
+        loc.longitude = loc.original_longitude = cell_location['lon']
+        loc.accuracy = cell_location.get('accuracy') or 0
+        if isinstance(loc.raw_data, dict):
+            loc.raw_data['resolved_via'] = cell_location.get('provider')
+        LocationData.objects.filter(id=loc.id).update(
+            latitude=loc.latitude, longitude=loc.longitude,
+            original_latitude=loc.latitude, original_longitude=loc.longitude,
+            accuracy=loc.accuracy, raw_data=loc.raw_data,
+        )
+        logger.info(f'Back-filled LBS LocationData {loc.id} for {device.imei} ({cell_location.get("provider")})')
+        self.broadcast_device_update(device, speed=0, heading=0, location_data=loc)
+
+    def update_address(self, device, loc, lat, lon, speed, heading):
+        """Reverse-geocode a saved location and re-broadcast it with its address."""
+        try:
+            service = ReverseGeocodingService()
+            address = service.get_address(lat, lon)
+            if address:
+                # Use filter().update() for atomic update or just save
+                LocationData.objects.filter(id=loc.id).update(address=address)
+                logger.info(f"Updated address for LocationData {loc.id}: {address[:30]}...")
+
+                # Re-broadcast to show address on map immediately (the row we hold is current)
+                loc.address = address
+                self.broadcast_device_update(device, speed=speed, heading=heading, location_data=loc)
+        except Exception as e:
+            logger.error(f"Error in async reverse geocoding for {loc.id}: {e}")
+
     def broadcast_device_update(self, device, speed=0, heading=0, location_data=None):
         """
         Broadcast device location update to WebSocket clients
+        The payload is built from the cached device and its hot state (no queries once warm).
         """
+        if self.current_batch() is not None:
+            return  # UPLOAD batches send one update when they are done
         try:
-            channel_layer = get_channel_layer()
+            # Owner ids come from the registry (kept current by invalidations), not another query
+            record = self.device_registry.peek(device.imei) or device
+            owner_id = getattr(record, 'owner_id', None)
+            assigned_subuser_id = getattr(record, 'assigned_subuser_id', None)
 
-            ids_row = Device.objects.filter(id=device.id).values('owner_id', 'assigned_subuser_id').first()
-            if ids_row:
-                owner_id = ids_row.get('owner_id')
-                assigned_subuser_id = ids_row.get('assigned_subuser_id')
-            else:
-                owner_id = getattr(device, 'owner_id', None)
-                assigned_subuser_id = getattr(device, 'assigned_subuser_id', None)
-            
-            last_update = None
-            lat = None
-            lng = None
-            latest_loc = None
-            
-            # 1. Try to get data from the provided location_data
-            if location_data:
-                lat = float(location_data.latitude)
-                lng = float(location_data.longitude)
-                if location_data.created_at:
-                    last_update = location_data.created_at.isoformat()
-            
-            # 2. Fallback: Query the latest LocationData from DB if not provided
-            if lat is None or lng is None:
-                latest_loc = LocationData.objects.filter(device=device).order_by('-created_at').first()
-                if latest_loc:
-                    lat = float(latest_loc.latitude)
-                    lng = float(latest_loc.longitude)
-                    if latest_loc.created_at:
-                        last_update = latest_loc.created_at.isoformat()
-
-            # 3. Default time if still missing
-            if not last_update:
-                from datetime import datetime, timezone
-                last_update = datetime.now(timezone.utc).isoformat()
-
-            device_state = self.get_device_state(device)
-
-            # تعیین مقادیر GPS/GSM با حفظ آخرین مقدار معتبر
-            latest_loc = latest_loc or LocationData.objects.filter(device=device).order_by('-created_at').first()
-            satellites_val = getattr(location_data, 'satellites', None) if location_data else None
-            gps_from_cache = False
-            # Only use cache if satellites_val is None (not if it's 0, as 0 is a valid value)
-            if satellites_val is None and latest_loc:
-                satellites_val = getattr(latest_loc, 'satellites', 0)
-                gps_from_cache = True
-            elif satellites_val is None:
-                satellites_val = 0
-
-            signal_val = getattr(location_data, 'signal_strength', None) if location_data else None
-            gsm_from_cache = False
-            # Only use cache if signal_val is None (not if it's 0, as 0 is a valid value)
-            if signal_val is None and latest_loc:
-                signal_val = getattr(latest_loc, 'signal_strength', 0)
-                gsm_from_cache = True
-            elif signal_val is None:
-                signal_val = 0
-
-            gps_ts = getattr(location_data, 'created_at', None)
-            if gps_from_cache and latest_loc and not gps_ts:
-                gps_ts = getattr(latest_loc, 'created_at', None)
-
-            gsm_ts = getattr(location_data, 'created_at', None)
-            if gsm_from_cache and latest_loc and not gsm_ts:
-                gsm_ts = getattr(latest_loc, 'created_at', None)
-            
-            # تعیین آیکون، رنگ و متن بر اساس device_state
-            status_info = self.get_status_display_info(device_state, getattr(location_data, 'is_alarm', False) if location_data else False)
-
-            device_data = {
-                'id': device.id,
-                'name': device.name,
-                'imei': device.imei,
-                'device_id': device.imei,
-                'lat': lat,
-                'lng': lng,
-                'last_update': last_update,
-                'status': device.status,
-                'battery_level': getattr(location_data, 'battery_level', 0) if location_data else 0,
-                'speed': float(speed) if speed is not None else 0,
-                'heading': float(heading) if heading is not None else 0,
-                'accuracy': getattr(location_data, 'accuracy', 0) if location_data else 0,
-                'satellites': satellites_val if satellites_val is not None else 0,
-                'signal_strength': signal_val if signal_val is not None else 0,
-                'matched_geometry': getattr(location_data, 'matched_geometry', None) if location_data else None,
-                'is_alarm': getattr(location_data, 'is_alarm', False) if location_data else False,
-                'alarm_type': getattr(location_data, 'alarm_type', '') if location_data else '',           
-                'device_state': device_state,  # وضعیت دستگاه (P, M, S, I)
-                'status_icon': status_info['icon'],  # آیکون برای نمایش
-                'status_color': status_info['color'],  # رنگ وضعیت
-                'status_text': status_info['text'],  # متن فارسی وضعیت
-                'gps_valid': (satellites_val or 0) > 0,  # آیا GPS معتبر است
-                'gsm_valid': (signal_val or 0) > 0,  # آیا سیگنال GSM معتبر است
-                'gps_timestamp': gps_ts.isoformat() if gps_ts else None,
-                'gsm_timestamp': gsm_ts.isoformat() if gsm_ts else None,
-                'gps_from_cache': gps_from_cache,
-                'gsm_from_cache': gsm_from_cache,
-                'address': getattr(location_data, 'address', '') if location_data else '', # Add address
-            }
+            # Only a cold device (e.g. evicted between packets) warms its hot state from the DB
+            hot = self.hot_states.peek(device.id) or self.hot_states.get(device)
+            device_data = build_device_payload(device, hot, location_data, speed=speed, heading=heading)
 
-            # Send to admins group (they see all devices)
-            async_to_sync(channel_layer.group_send)(
-                'admins_group',
-                {
-                    'type': 'device_update',
-                    'data': device_data
-                }
-            )
-            
-            # Send to device owner's personal group
+            # Admins group (they see all devices), the owner's personal group and the assigned subuser's group
+            groups = ['admins_group']
             if owner_id:
-                async_to_sync(channel_layer.group_send)(
-                    f'user_group_{owner_id}',
-                    {'type': 'device_update', 'data': device_data}
-                )
-
-            # Send to assigned subuser group (if any)
+                groups.append(f'user_group_{owner_id}')
             if assigned_subuser_id:
-                async_to_sync(channel_layer.group_send)(
-                    f'user_group_{assigned_subuser_id}',
-                    {'type': 'device_update', 'data': device_data}
-                )
+                groups.append(f'user_group_{assigned_subuser_id}')
+
+            # Queued on the broadcaster loop: coalesced per device and sent in per-group batches
+            self.broadcaster.publish(device.id, groups, device_data)
         except Exception as e:
             logger.error(f'Error broadcasting device update: {e}')
 
@@ -1395,18 +2051,7 @@ class GPSReceiver:
         Returns: 'P' (Parked), 'M' (Moving), 'S' (Stopped), 'I' (Idle), یا None
         """
         try:
-            last_state = DeviceState.objects.filter(device=device).order_by('-timestamp').first()
-            if last_state:
-                state_name = last_state.state.name
-                if state_name == 'Moving':
-                    return 'M'
-                elif state_name == 'Stopped':
-                    return 'S'
-                elif state_name == 'Idle':
-                    return 'I'
-                # اگر وضعیت دیگری بود
-                return state_name[0].upper()
-            return None
+            return state_code(self.hot_states.get(device).state_name)
         except Exception as e:
             logger.error(f'Error getting device state: {e}')
             return None
@@ -1416,40 +2061,4 @@ class GPSReceiver:
         تعیین آیکون، رنگ و متن برای نمایش در Frontend
         Returns: dict با کلیدهای 'icon', 'color', 'text'
         """
-        if is_alarm:
-            return {
-                'icon': 'fa-exclamation-triangle',
-                'color': '#ef4444',
-                'text': 'هشدار'
-            }
-    
-        if device_state == 'M':  # Moving
-            return {
-                'icon': 'fa-car',
-                'color': '#22c55e',
-                'text': 'در حرکت'
-            }
-        elif device_state == 'P':  # Parked
-            return {
-                'icon': 'P',  # حرف P
-                'color': '#f59e0b',
-                'text': 'پارک شده'
-            }
-        elif device_state == 'S':  # Stopped
-            return {
-                'icon': 'S',  # حرف S
-                'color': '#ef4444',
-                'text': 'متوقف شده'
-            }
-        elif device_state == 'I':  # Idle
-            return {
-                'icon': 'fa-pause',
-                'color': '#64748b',
-                'text': 'بی‌حرکت'
-            }
-        else:  # Unknown
-            return {
-                'icon': 'fa-circle',
-                'color': '#f8fafc',
-                'text': 'نامشخص'
-            }
\ No newline at end of file
+        return status_display_info(device_state, is_alarm)
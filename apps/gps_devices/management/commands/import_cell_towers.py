@@ -0,0 +1,30 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.gps_devices.receiver.cell_towers import build_cell_store, read_opencellid_csv
+
+
+class Command(BaseCommand):
+    help = 'Import an OpenCellID CSV dump into the local cell-tower database used for LBS resolution'
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_path', help='OpenCellID dump (cell_towers.csv or .csv.gz, or a per-MCC file like 432.csv.gz)')
+        parser.add_argument('--mcc', type=int, action='append', help='Only import these MCCs (repeatable; default 432)')
+        parser.add_argument('--db', default=None, help='Output database (default GPS_CELL_DB_PATH)')
+
+    def handle(self, *args, **options):
+        db_path = options['db'] or getattr(settings, 'GPS_CELL_DB_PATH', None)
+        if not db_path:
+            raise CommandError('No output database: pass --db or set GPS_CELL_DB_PATH')
+        mccs = set(options['mcc'] or [432])
+        started = time.perf_counter()
+        try:
+            cells, areas = build_cell_store(db_path, read_opencellid_csv(options['csv_path'], mccs))
+        except OSError as e:
+            raise CommandError(f'Import failed: {e}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {cells} cells in {areas} location areas (MCC {", ".join(map(str, sorted(mccs)))}) '
+            f'into {db_path} in {time.perf_counter() - started:.1f}s'))
+        self.stdout.write('Restart gps_receiver to use the new database')
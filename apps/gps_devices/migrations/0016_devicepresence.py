@@ -0,0 +1,43 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def copy_last_heartbeats(apps, schema_editor):
+    """Seed presence rows from the HB LocationData rows the receiver used to keep."""
+    LocationData = apps.get_model('gps_devices', 'LocationData')
+    DevicePresence = apps.get_model('gps_devices', 'DevicePresence')
+    rows = {}
+    for hb in LocationData.objects.filter(packet_type='HB').order_by('created_at').iterator():
+        rows[hb.device_id] = DevicePresence(
+            device_id=hb.device_id,
+            last_hb_at=hb.created_at,
+            device_time=hb.timestamp,
+            voltage=hb.battery_level / 1000 if hb.battery_level else None,
+            signal_strength=hb.signal_strength,
+        )
+    DevicePresence.objects.bulk_create(rows.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gps_devices', '0015_add_assigned_by_to_device'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DevicePresence',
+            fields=[
+                ('device', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='presence', serialize=False, to='gps_devices.device')),
+                ('last_hb_at', models.DateTimeField(db_index=True, help_text='زمان دریافت آخرین HB')),
+                ('device_time', models.DateTimeField(blank=True, help_text='زمان گزارش شده توسط دستگاه در آخرین HB', null=True)),
+                ('voltage', models.FloatField(blank=True, null=True)),
+                ('signal_strength', models.IntegerField(blank=True, null=True)),
+            ],
+            options={
+                'verbose_name': 'حضور دستگاه',
+                'verbose_name_plural': 'حضور دستگاه‌ها',
+            },
+        ),
+        migrations.RunPython(copy_last_heartbeats, migrations.RunPython.noop),
+    ]
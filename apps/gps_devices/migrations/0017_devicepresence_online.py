@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gps_devices', '0016_devicepresence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicepresence',
+            name='last_seen_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='زمان دریافت آخرین بسته', null=True),
+        ),
+        migrations.AddField(
+            model_name='devicepresence',
+            name='online',
+            field=models.BooleanField(db_index=True, default=False, help_text='آنلاین (تا زمانی که گیرنده سکوت دستگاه را تشخیص دهد)'),
+        ),
+        migrations.AlterField(
+            model_name='devicepresence',
+            name='last_hb_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='زمان دریافت آخرین HB', null=True),
+        ),
+    ]
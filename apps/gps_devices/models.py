@@ -35,6 +35,18 @@ class Model(models.Model):
         return f"{self.manufacturer} {self.model_name}"
 
 
+class DeviceQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        # Bulk updates skip post_save, so tell receiver caches which devices changed
+        from apps.gps_devices.receiver.invalidation import invalidate_device
+
+        changed = list(self.values_list('id', 'imei'))
+        rows = super().update(**kwargs)
+        for device_id, imei in changed:
+            invalidate_device(device_id=device_id, imei=imei)
+        return rows
+
+
 class Device(models.Model):
     STATUS_CHOICES = [
         ('active', 'فعال'),
@@ -78,6 +90,8 @@ class Device(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = DeviceQuerySet.as_manager()
+
     class Meta:
         constraints = [
             models.CheckConstraint(
@@ -102,7 +116,7 @@ class Device(models.Model):
 
 
 def get_visible_devices_queryset(user, only_active=False):
-    qs = Device.objects.all().select_related('model')
+    qs = Device.objects.all().select_related('model', 'presence')
     if only_active:
         qs = qs.filter(status='active')
 
@@ -180,6 +194,24 @@ class DeviceState(models.Model):
         return f"{self.device.name} - {self.state.name} - {self.timestamp}"
 
 
+class DevicePresence(models.Model):
+    """Last packet / heartbeat of a device (one row per device, written in batches by the receiver)."""
+    device = models.OneToOneField(Device, on_delete=models.CASCADE, primary_key=True, related_name='presence')
+    last_seen_at = models.DateTimeField(null=True, blank=True, db_index=True, help_text='زمان دریافت آخرین بسته')
+    online = models.BooleanField(default=False, db_index=True, help_text='آنلاین (تا زمانی که گیرنده سکوت دستگاه را تشخیص دهد)')
+    last_hb_at = models.DateTimeField(null=True, blank=True, db_index=True, help_text='زمان دریافت آخرین HB')
+    device_time = models.DateTimeField(null=True, blank=True, help_text='زمان گزارش شده توسط دستگاه در آخرین HB')
+    voltage = models.FloatField(null=True, blank=True)
+    signal_strength = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'حضور دستگاه'
+        verbose_name_plural = 'حضور دستگاه‌ها'
+
+    def __str__(self):
+        return f"{self.device_id} - {self.last_hb_at}"
+
+
 class RawGpsData(models.Model):
     STATUS_CHOICES = [
         ('pending', 'در انتظار'),
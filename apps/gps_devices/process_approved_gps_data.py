@@ -1,18 +1,17 @@
 import logging
-import sys
-import os
 from datetime import datetime, timezone
 from django.core.management.base import BaseCommand
 from apps.gps_devices.models import RawGpsData, Device, LocationData
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 
-# Add project root to path for importing HQ_Decoder
-sys.path.append(os.path.join(os.path.dirname(__file__), '../../../..'))
-from HQ_Decoder import HQFullDecoder
+from apps.gps_devices.decoders.HQ_Decoder import HQFullDecoder
 
 logger = logging.getLogger(__name__)
 
+# Raw rows decoded per decode_many call
+DECODE_BATCH_SIZE = 500
+
 class Command(BaseCommand):
     help = 'Process approved GPS data that requires admin confirmation'
 
@@ -26,22 +25,39 @@ class Command(BaseCommand):
         approved_data = RawGpsData.objects.filter(status__in=['approved', 'registered'], processed=False)
 
         processed_count = 0
-        for raw_data in approved_data:
+        batch = []
+        for raw_data in approved_data.iterator(chunk_size=DECODE_BATCH_SIZE):
+            batch.append(raw_data)
+            if len(batch) >= DECODE_BATCH_SIZE:
+                processed_count += self.process_batch(batch)
+                batch = []
+        if batch:
+            processed_count += self.process_batch(batch)
+
+        self.stdout.write(f'Successfully processed {processed_count} approved GPS data entries.')
+
+    def process_batch(self, batch):
+        """
+        Decode a batch of raw entries in one decode_many call, then process them
+        """
+        decoded_rows = self.decoder.decode_many([raw_data.raw_data for raw_data in batch], keep_results=True).results
+        processed_count = 0
+        for raw_data, decoded in zip(batch, decoded_rows):
             try:
-                self.process_raw_data(raw_data)
+                self.process_raw_data(raw_data, decoded)
                 processed_count += 1
             except Exception as e:
                 logger.error(f'Error processing approved data {raw_data.id}: {e}')
                 raw_data.mark_error(str(e))
+        return processed_count
 
-        self.stdout.write(f'Successfully processed {processed_count} approved GPS data entries.')
-
-    def process_raw_data(self, raw_data):
+    def process_raw_data(self, raw_data, decoded=None):
         """
         Process a single raw GPS data entry
         """
-        # Decode the data using HQDecoder
-        decoded = self.decoder.decode(raw_data.raw_data)
+        # Decode the data using HQDecoder (unless already decoded by process_batch)
+        if decoded is None:
+            decoded = self.decoder.decode(raw_data.raw_data)
         parsed_data = self.convert_decoded_to_parsed(decoded)
         if not parsed_data:
             raw_data.mark_error('Failed to decode GPS data')
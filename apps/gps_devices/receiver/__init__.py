@@ -0,0 +1,7 @@
+"""
+GPS Receiver infrastructure
+
+Building blocks used by the ``gps_receiver`` management command (network
+engines, framing, caches, ...). Modules in this package keep their Django
+imports local so the pure parts can be imported and tested on their own.
+"""
@@ -0,0 +1,190 @@
+"""
+asyncio receiver engine
+
+A single event loop accepts TCP connections and receives UDP datagrams. TCP
+frames, UDP datagrams and MQTT messages all go to the receiver's decode stage
+(see ``pipeline.py``), where the ORM work of a device runs in its lane; a TCP
+connection awaits each frame before handling the next, so its frames stay in
+order. Idle device sockets cost a few KB each instead of a worker thread, so
+one process can hold tens of thousands.
+
+Usage:
+    receiver = GPSReceiver()
+    AsyncGPSReceiver(receiver).start()
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from .framing import FrameBufferOverflow
+from .session import DeviceSession
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncGPSReceiver:
+    """
+    Event-loop front-end for an existing ``GPSReceiver``.
+
+    The wrapped receiver keeps owning decoding, security checks and
+    persistence; this class only replaces the socket handling.
+    """
+
+    def __init__(self, receiver, max_pending=2000, tcp_backlog=1024, idle_timeout=300.0, read_size=4096):
+        self.receiver = receiver
+        self.max_pending = max_pending
+        self.tcp_backlog = tcp_backlog
+        self.idle_timeout = idle_timeout
+        self.read_size = read_size
+        self.loop = None
+        self._pending = None
+        self._mqtt_thread = None
+
+    def start(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info('Shutting down asyncio GPS receiver')
+        finally:
+            if self.receiver.mqtt_client:
+                try:
+                    self.receiver.mqtt_client.disconnect()
+                except Exception:
+                    pass
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        # Limits TCP frames queued for / running on the decode stage
+        self._pending = asyncio.Semaphore(self.max_pending)
+
+        host, port = self.receiver.host, self.receiver.port
+        tcp_server = await asyncio.start_server(
+            self.handle_tcp, host, port,
+            backlog=self.tcp_backlog,
+            reuse_address=True,
+            reuse_port=self.receiver.reuse_port or None,
+        )
+        udp_transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: _UDPProtocol(self),
+            local_addr=(host, port),
+            reuse_port=self.receiver.reuse_port or None,
+        )
+        self.receiver.watch_udp_socket(udp_transport.get_extra_info('socket'))
+        logger.info(f'asyncio GPS receiver listening on {host}:{port} for TCP and UDP '
+                    f'(max_pending={self.max_pending})')
+
+        self.receiver.configure_mqtt()
+        if self.receiver.mqtt_enabled:
+            self._mqtt_thread = threading.Thread(target=self.mqtt_listen, name='GPS_MQTT', daemon=True)
+            self._mqtt_thread.start()
+
+        async with tcp_server:
+            await tcp_server.serve_forever()
+
+    async def dispatch(self, data, ip_address, protocol_type, reply_callback=None, session=None):
+        """Queue a frame in its device's decode lane and wait until it is processed, bounded by ``max_pending``."""
+        async with self._pending:
+            done = self.loop.create_future()
+
+            def finished():
+                self.loop.call_soon_threadsafe(_resolve, done)
+
+            if self.receiver.submit_packet(data, ip_address, protocol_type, reply_callback=reply_callback,
+                                           session=session, done=finished):
+                await done
+
+    async def handle_tcp(self, reader, writer):
+        address = writer.get_extra_info('peername') or ('unknown', 0)
+        logger.info(f'TCP connection from {address}')
+        session = DeviceSession(address)
+
+        def send_response(response_data):
+            # Called from decode stage threads; writes must happen on the loop
+            self.loop.call_soon_threadsafe(self._write, writer, response_data, address)
+
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(self.read_size), timeout=self.idle_timeout)
+                    received_at = time.monotonic()
+                except asyncio.TimeoutError:
+                    logger.info(f'TCP session idle timeout from {address} (imei={session.imei})')
+                    break
+                if not data:
+                    break
+                logger.info(f'Received TCP data from {address}: {data.hex()}')
+                try:
+                    frames = session.feed(data)
+                except FrameBufferOverflow as e:
+                    logger.warning(f'Closing TCP session {address}: {e}')
+                    break
+                for frame in frames:
+                    reply = self.receiver.timed_reply(send_response, received_at)
+                    if self.receiver.accept_frame(frame, address[0], 'tcp', reply, session=session):
+                        continue
+                    # Awaiting keeps packets of one connection in order
+                    await self.dispatch(frame, address[0], 'tcp', reply_callback=reply, session=session)
+        except (ConnectionResetError, BrokenPipeError):
+            logger.info(f'TCP connection reset by {address}')
+        except Exception as e:
+            logger.error(f'Error handling TCP client {address}: {e}')
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _write(writer, response_data, address):
+        if writer.is_closing():
+            return
+        try:
+            writer.write(response_data)
+            logger.info(f'Sent response to {address}: {response_data.hex()}')
+        except Exception as e:
+            logger.error(f'Error sending response to {address}: {e}')
+
+    def mqtt_listen(self):
+        def dispatch(data):
+            if not self.receiver.accept_frame(data, None, 'mqtt'):
+                self.receiver.submit_packet(data, None, 'mqtt')
+
+        self.receiver.mqtt_listen(dispatch=dispatch)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        received_at = time.monotonic()
+        if not data:
+            return
+        self.server.receiver.udp_stats.count(1, batches=0)
+        logger.info(f'Received UDP data from {addr}: {data.hex()}')
+
+        loop = self.server.loop
+        transport = self.transport
+
+        def send_response(response_data):
+            loop.call_soon_threadsafe(transport.sendto, response_data, addr)
+
+        # Bounded decode stage; its overflow policy sheds load when it is full
+        receiver = self.server.receiver
+        reply = receiver.timed_reply(send_response, received_at)
+        if not receiver.accept_frame(data, addr[0], 'udp', reply):
+            receiver.submit_packet(data, addr[0], 'udp', reply_callback=reply)
+
+    def error_received(self, exc):
+        logger.error(f'UDP receive error: {exc}')
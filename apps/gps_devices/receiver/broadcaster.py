@@ -0,0 +1,120 @@
+"""
+Coalescing WebSocket broadcaster
+
+``broadcast_device_update`` used to call ``async_to_sync(group_send)`` up to
+three times per packet from the ingest thread. ``DeviceBroadcaster`` instead
+takes the payload and returns immediately; a dedicated thread running its own
+asyncio loop collects updates for ``window`` seconds, keeps only the latest
+update per device, and sends one ``device_updates`` message per group with
+all of that group's devices (see ``DeviceUpdateConsumer.device_updates``).
+"""
+import asyncio
+import logging
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceBroadcaster:
+    def __init__(self, channel_layer=None, window=0.25, max_batch=200):
+        self.channel_layer = channel_layer
+        self.window = window
+        self.max_batch = max_batch
+        self.published = 0
+        self.sent_messages = 0
+        self._pending = {}  # device id -> (groups, data); latest wins
+        self._lock = threading.Lock()
+        self._armed = False
+        self._loop = None
+        self._wakeup = None
+        self._stop = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run_loop, name='GPS_Broadcaster', daemon=True)
+        self._thread.start()
+        self._ready.wait(5)
+        return self
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def publish(self, device_id, groups, data):
+        """Queue an update for the given groups; never blocks on the channel layer."""
+        with self._lock:
+            self._pending[device_id] = (tuple(groups), data)
+            self.published += 1
+            arm = not self._armed
+            self._armed = True
+        if arm and self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                pass  # loop closed during shutdown
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._wakeup = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._ready.set()
+        try:
+            self._loop.run_until_complete(self._run())
+        finally:
+            self._loop.close()
+
+    async def _run(self):
+        if self.channel_layer is None:
+            from channels.layers import get_channel_layer
+            self.channel_layer = get_channel_layer()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self._stop.is_set():
+                # Let updates accumulate so repeated packets of a device collapse into one
+                try:
+                    await asyncio.wait_for(self._stop.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._armed = False
+            if pending:
+                await self._send(pending)
+            if self._stop.is_set():
+                return
+
+    async def _send(self, pending):
+        by_group = {}
+        for groups, data in pending.values():
+            for group in groups:
+                by_group.setdefault(group, []).append(data)
+        timestamp = datetime.now(timezone.utc).isoformat()
+        for group, updates in by_group.items():
+            for start in range(0, len(updates), self.max_batch):
+                try:
+                    await self.channel_layer.group_send(group, {
+                        'type': 'device_updates',
+                        'data': updates[start:start + self.max_batch],
+                        'timestamp': timestamp,
+                    })
+                    self.sent_messages += 1
+                except Exception as e:
+                    logger.error(f'Error broadcasting {len(updates)} device updates to {group}: {e}')
+
+    def close(self, timeout=5.0):
+        """Send whatever is queued and stop the loop thread."""
+        if self._loop is None or self._thread is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._stop_now)
+        except RuntimeError:
+            return
+        self._thread.join(timeout)
+
+    def _stop_now(self):
+        self._stop.set()
+        self._wakeup.set()
@@ -0,0 +1,158 @@
+"""
+Local cell-tower database for offline LBS resolution
+
+``import_cell_towers`` loads an OpenCellID CSV dump (filtered by MCC, 432 for
+Iran) into a SQLite file; ``CellTowerStore`` resolves (mcc, mnc, lac, cid)
+from it without any network request:
+
+    cells  (mcc, mnc, lac, cid) -> lat, lon, range      exact cell
+    areas  (mcc, mnc, lac)      -> centroid, radius     LAC centroid
+
+Both tables are WITHOUT ROWID, clustered on their key, so a lookup is one
+B-tree descent. A cell that is not in the dump falls back to its nearest
+neighbour by cell id within the same LAC (sectors of a site have adjacent
+ids: LTE ECI = eNB * 256 + sector) and then to the LAC centroid.
+"""
+import csv
+import gzip
+import logging
+import math
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE cells (
+    mcc INTEGER NOT NULL, mnc INTEGER NOT NULL, lac INTEGER NOT NULL, cid INTEGER NOT NULL,
+    lat REAL NOT NULL, lon REAL NOT NULL, range INTEGER, samples INTEGER, radio TEXT,
+    PRIMARY KEY (mcc, mnc, lac, cid)
+) WITHOUT ROWID;
+CREATE TABLE areas (
+    mcc INTEGER NOT NULL, mnc INTEGER NOT NULL, lac INTEGER NOT NULL,
+    lat REAL NOT NULL, lon REAL NOT NULL, range INTEGER, cells INTEGER,
+    PRIMARY KEY (mcc, mnc, lac)
+) WITHOUT ROWID;
+"""
+
+
+def _distance_m(lat1, lon1, lat2, lon2):
+    # Equirectangular approximation; plenty for cell radii
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return 6371000 * math.hypot(x, y)
+
+
+def read_opencellid_csv(path, mccs=None):
+    """(mcc, mnc, lac, cid, lat, lon, range, samples, radio) rows of an OpenCellID CSV (.csv or .csv.gz)."""
+    # Columns: radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='') as f:
+        reader = csv.reader(f)
+        for row in reader:
+            if not row or row[0] == 'radio':
+                continue  # header
+            try:
+                mcc = int(row[1])
+                if mccs and mcc not in mccs:
+                    continue
+                yield (mcc, int(row[2]), int(row[3]), int(row[4]), float(row[7]), float(row[6]),
+                       int(row[8] or 0), int(row[9] or 0), row[0])
+            except (IndexError, ValueError):
+                continue
+
+
+def build_cell_store(path, rows, batch_size=10000):
+    """Write a new store at ``path`` (replaced atomically); returns (cells, areas)."""
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript('PRAGMA journal_mode=OFF; PRAGMA synchronous=OFF;' + SCHEMA)
+        insert = 'INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                conn.executemany(insert, batch)
+                batch = []
+        if batch:
+            conn.executemany(insert, batch)
+
+        # LAC centroids; radius covers the farthest cell of the area plus its own range
+        centroids = {
+            (mcc, mnc, lac): (lat, lon, count) for mcc, mnc, lac, lat, lon, count in conn.execute(
+                'SELECT mcc, mnc, lac, avg(lat), avg(lon), count(*) FROM cells GROUP BY mcc, mnc, lac')
+        }
+        radius = dict.fromkeys(centroids, 0)
+        for mcc, mnc, lac, lat, lon, cell_range in conn.execute('SELECT mcc, mnc, lac, lat, lon, range FROM cells'):
+            key = (mcc, mnc, lac)
+            c_lat, c_lon, _ = centroids[key]
+            radius[key] = max(radius[key], _distance_m(c_lat, c_lon, lat, lon) + (cell_range or 0))
+        conn.executemany('INSERT INTO areas VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         [(*key, lat, lon, int(radius[key]), count) for key, (lat, lon, count) in centroids.items()])
+        conn.commit()
+        cells = conn.execute('SELECT count(*) FROM cells').fetchone()[0]
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    return cells, len(centroids)
+
+
+class CellTowerStore:
+    """Read-only lookups; one SQLite connection per thread."""
+
+    def __init__(self, path, neighbour_span=256):
+        self.path = path
+        self.neighbour_span = neighbour_span
+        self._local = threading.local()
+
+    @classmethod
+    def open(cls, path, **options):
+        """The store at ``path``, or None if it is not configured / not imported yet."""
+        if not path:
+            return None
+        if not os.path.exists(path):
+            logger.warning(f'Cell tower database {path} not found; run import_cell_towers')
+            return None
+        return cls(path, **options)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True)
+        return conn
+
+    def lookup(self, mcc, mnc, lac, cid):
+        """{lat, lon, accuracy, provider} of the cell, its nearest neighbour or its LAC; None if the LAC is unknown."""
+        conn = self._connection()
+        row = conn.execute('SELECT lat, lon, range FROM cells WHERE mcc = ? AND mnc = ? AND lac = ? AND cid = ?',
+                           (mcc, mnc, lac, cid)).fetchone()
+        if row is not None:
+            return {'lat': row[0], 'lon': row[1], 'accuracy': row[2], 'provider': 'local'}
+
+        if self.neighbour_span:
+            below = conn.execute(
+                'SELECT cid, lat, lon, range FROM cells WHERE mcc = ? AND mnc = ? AND lac = ? AND cid < ? '
+                'ORDER BY cid DESC LIMIT 1', (mcc, mnc, lac, cid)).fetchone()
+            above = conn.execute(
+                'SELECT cid, lat, lon, range FROM cells WHERE mcc = ? AND mnc = ? AND lac = ? AND cid > ? '
+                'ORDER BY cid LIMIT 1', (mcc, mnc, lac, cid)).fetchone()
+            candidates = [c for c in (below, above) if c is not None and abs(c[0] - cid) <= self.neighbour_span]
+            if candidates:
+                nearest = min(candidates, key=lambda c: abs(c[0] - cid))
+                return {'lat': nearest[1], 'lon': nearest[2], 'accuracy': nearest[3], 'provider': 'local_neighbour'}
+
+        row = conn.execute('SELECT lat, lon, range FROM areas WHERE mcc = ? AND mnc = ? AND lac = ?',
+                           (mcc, mnc, lac)).fetchone()
+        if row is not None:
+            return {'lat': row[0], 'lon': row[1], 'accuracy': row[2], 'provider': 'local_lac'}
+        return None
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,104 @@
+"""
+Deduplication window for retransmitted frames
+
+Trackers resend frames they did not see acknowledged: JT808 with the same
+``msg_serial``, HQ the same V1 string after a reconnect. The receiver keys
+every timestamped packet on a hash of IMEI + device timestamp + payload
+(+ JT808 serial); a key seen again within ``window`` seconds is a duplicate,
+which is ACKed but not persisted, enriched or broadcast again.
+
+The receiver checks a packet with ``contains`` and only ``add``s its key once
+the packet's rows are committed: a copy that failed to save must not make
+its retransmission look like a duplicate.
+
+Keys are 64-bit hashes in an insertion-ordered dict, oldest first, so expiry
+and eviction are O(1) per packet and memory is bounded by ``max_entries``
+(roughly 100 bytes per entry). Heartbeats carry no device timestamp and are
+never deduplicated.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+def packet_key(imei, timestamp, data, msg_serial=None):
+    """64-bit key of a packet: IMEI, device timestamp, raw frame and JT808 serial."""
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(str(imei).encode())
+    digest.update(b'\x00')
+    digest.update(str(timestamp).encode())
+    digest.update(b'\x00')
+    if msg_serial is not None:
+        digest.update(msg_serial.to_bytes(2, 'big'))
+    digest.update(data)
+    return int.from_bytes(digest.digest(), 'big')
+
+
+class DedupWindow:
+    def __init__(self, window=600.0, max_entries=100000):
+        self.window = window
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.hits_by_protocol = {}
+        self._keys = OrderedDict()  # key -> first seen (monotonic), oldest first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def seen(self, key, protocol=None, now=None):
+        """Record ``key``; True if it was already seen within the window (a duplicate)."""
+        if self.contains(key, protocol, now):
+            return True
+        self.add(key, now)
+        return False
+
+    def contains(self, key, protocol=None, now=None):
+        """True if ``key`` was added within the window (a duplicate); counted in the hit rate."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            if key in self._keys:
+                self.hits += 1
+                if protocol:
+                    self.hits_by_protocol[protocol] = self.hits_by_protocol.get(protocol, 0) + 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key, now=None):
+        """Record ``key``. The window runs from the first copy: adding it again does not extend it."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            keys = self._keys
+            if key in keys:
+                return
+            keys[key] = now
+            if len(keys) > self.max_entries:
+                keys.popitem(last=False)
+                self.evicted += 1
+
+    def _expire(self, now):
+        keys = self._keys
+        cutoff = now - self.window
+        while keys:
+            oldest = next(iter(keys))
+            if keys[oldest] > cutoff:
+                break
+            del keys[oldest]
+
+    def snapshot(self):
+        with self._lock:
+            checked = self.hits + self.misses
+            return {
+                'entries': len(self._keys),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / checked, 4) if checked else 0.0,
+                'evicted': self.evicted,
+                'hits_by_protocol': dict(self.hits_by_protocol),
+            }
@@ -0,0 +1,244 @@
+"""
+Stream framing for TCP device connections
+
+TCP delivers a byte stream, not packets: one ``recv`` can hold half a frame
+or several frames. Framers keep a per-connection buffer and return only
+complete frames:
+
+    HQ     ``*...#`` text frames
+    GT06   ``0x78 0x78`` + 1 length byte, or ``0x79 0x79`` + 2 length bytes,
+           terminated by ``0x0D 0x0A``
+    JT808  frames delimited by ``0x7E``
+
+Usage:
+    framer = StreamFramer()
+    for frame in framer.feed(chunk):
+        process(frame)
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BUFFER = 16 * 1024
+
+
+class FrameBufferOverflow(Exception):
+    """Raised when a connection buffers more than ``max_buffer`` bytes without a complete frame."""
+
+
+class BaseFramer:
+    protocol = None
+
+    def __init__(self, max_buffer=DEFAULT_MAX_BUFFER):
+        self.buffer = bytearray()
+        self.max_buffer = max_buffer
+
+    def feed(self, data):
+        """Append received bytes and return the list of complete frames."""
+        self.buffer += data
+        frames = self._extract()
+        if len(self.buffer) > self.max_buffer:
+            size = len(self.buffer)
+            self.buffer.clear()
+            raise FrameBufferOverflow(f'{self.protocol} buffer exceeded {self.max_buffer} bytes ({size})')
+        return frames
+
+    def _extract(self):
+        raise NotImplementedError
+
+    def _discard(self, count):
+        if count > 0:
+            logger.debug(f'{self.protocol} framer discarding {count} bytes of garbage')
+            del self.buffer[:count]
+
+
+class HQFramer(BaseFramer):
+    protocol = 'HQ'
+
+    def _extract(self):
+        frames = []
+        buf = self.buffer
+        while True:
+            start = buf.find(b'*')
+            if start < 0:
+                self._discard(len(buf))
+                break
+            self._discard(start)
+            end = buf.find(b'#', 1)
+            if end < 0:
+                break
+            # A new '*' before the terminator means the previous frame was truncated
+            restart = buf.find(b'*', 1, end)
+            if restart > 0:
+                self._discard(restart)
+                continue
+            frames.append(bytes(buf[:end + 1]))
+            del buf[:end + 1]
+        return frames
+
+
+class GT06Framer(BaseFramer):
+    protocol = 'GT06'
+    STOP = b'\x0d\x0a'
+
+    def _extract(self):
+        frames = []
+        buf = self.buffer
+        while len(buf) >= 2:
+            if buf[0] == 0x78 and buf[1] == 0x78:
+                if len(buf) < 3:
+                    break
+                total = buf[2] + 5  # start(2) + len(1) + stop(2)
+            elif buf[0] == 0x79 and buf[1] == 0x79:
+                if len(buf) < 4:
+                    break
+                total = ((buf[2] << 8) | buf[3]) + 6  # start(2) + len(2) + stop(2)
+            else:
+                self._resync()
+                continue
+
+            if len(buf) < total:
+                break
+            if buf[total - 2:total] != self.STOP:
+                # Bad length byte: skip this start marker and look for the next one
+                self._discard(1)
+                self._resync()
+                continue
+            frames.append(bytes(buf[:total]))
+            del buf[:total]
+        return frames
+
+    def _resync(self):
+        buf = self.buffer
+        positions = [p for p in (buf.find(b'\x78\x78'), buf.find(b'\x79\x79')) if p >= 0]
+        if positions:
+            self._discard(min(positions))
+        else:
+            # keep a trailing half start marker
+            self._discard(len(buf) - 1 if buf[-1:] in (b'\x78', b'\x79') else len(buf))
+
+
+class JT808Framer(BaseFramer):
+    protocol = 'JT808'
+
+    def _extract(self):
+        frames = []
+        buf = self.buffer
+        while True:
+            start = buf.find(b'\x7e')
+            if start < 0:
+                self._discard(len(buf))
+                break
+            self._discard(start)
+            end = buf.find(b'\x7e', 1)
+            if end < 0:
+                break
+            if end == 1:
+                # "7E 7E": end of a lost frame followed by a new start
+                self._discard(1)
+                continue
+            frames.append(bytes(buf[:end + 1]))
+            del buf[:end + 1]
+        return frames
+
+
+FRAMERS = {
+    'HQ': HQFramer,
+    'GT06': GT06Framer,
+    'JT808': JT808Framer,
+}
+
+
+def detect_protocol(data):
+    """Guess the protocol from the first bytes of a stream (same rules as process_gps_data)."""
+    if len(data) >= 2 and data[0] == 0x7E:
+        return 'JT808'
+    if len(data) >= 2 and ((data[0] == 0x78 and data[1] == 0x78) or (data[0] == 0x79 and data[1] == 0x79)):
+        return 'GT06'
+    if len(data) >= 1 and data[0] == 0x2A:
+        return 'HQ'
+    return None
+
+
+def is_heartbeat(data):
+    """True for a heartbeat frame (HQ ``HB``, GT06 0x13, JT808 0x0002/0x0003), without decoding it."""
+    protocol = detect_protocol(data)
+    if protocol == 'HQ':
+        fields = data.split(b',', 3)
+        return len(fields) > 2 and fields[2].startswith(b'HB')
+    if protocol == 'GT06':
+        offset = 3 if data[0] == 0x78 else 4
+        return len(data) > offset and data[offset] == 0x13
+    if protocol == 'JT808':
+        return data[1:3] in (b'\x00\x02', b'\x00\x03')
+    return False
+
+
+def frame_device_key(data):
+    """
+    Device identifier carried in a frame's header, without decoding it: the HQ
+    IMEI field or the JT808 terminal id bytes (hex). None for GT06 and others.
+    Only meant as a stable routing key, not as the device's IMEI.
+    """
+    protocol = detect_protocol(data)
+    if protocol == 'HQ':
+        fields = data.split(b',', 2)
+        return fields[1].decode('ascii', 'replace') if len(fields) > 2 else None
+    if protocol == 'JT808':
+        header = _jt808_unescape_head(data, 10)
+        return header[4:10].hex() if len(header) == 10 else None
+    return None
+
+
+def _jt808_unescape_head(data, size):
+    """The first ``size`` unescaped bytes after a JT808 frame's leading 0x7E (fewer if it is shorter)."""
+    head = bytearray()
+    index = 1
+    end = len(data) - 1 if data[-1:] == b'\x7e' and len(data) > 1 else len(data)
+    while index < end and len(head) < size:
+        byte = data[index]
+        if byte == 0x7d and index + 1 < end:
+            index += 1
+            byte = {0x01: 0x7d, 0x02: 0x7e}.get(data[index], data[index])
+        head.append(byte)
+        index += 1
+    return bytes(head)
+
+
+class StreamFramer:
+    """
+    Protocol-sniffing framer for one connection.
+
+    The protocol is detected from the first bytes and then fixed for the
+    lifetime of the connection. Streams of unknown protocol are passed
+    through chunk by chunk, as the receiver did before framing existed.
+    """
+
+    def __init__(self, max_buffer=DEFAULT_MAX_BUFFER):
+        self.max_buffer = max_buffer
+        self.protocol = None
+        self._framer = None
+        self._pending = bytearray()
+
+    def feed(self, data):
+        if self._framer is not None:
+            return self._framer.feed(data)
+
+        self._pending += data
+        if len(self._pending) < 2 and self._pending[:1] != b'*':
+            return []
+        protocol = detect_protocol(self._pending)
+        pending = bytes(self._pending)
+        self._pending.clear()
+        if protocol is None:
+            return [pending]
+
+        self.protocol = protocol
+        self._framer = FRAMERS[protocol](max_buffer=self.max_buffer)
+        return self._framer.feed(pending)
+
+    @property
+    def buffered(self):
+        if self._framer is not None:
+            return len(self._framer.buffer)
+        return len(self._pending)
@@ -0,0 +1,178 @@
+"""
+Per-device hot state for the ingest hot path
+
+Processing a V1/GT06 packet needs the device's last fix, a few recent points
+(stop detection, map matching), its current state name, the consecutive
+counters and the last known GSM/satellite values. ``DeviceHotState`` keeps
+these in memory; it is warmed from the database on the first packet of a
+device and then updated by the receiver as it writes rows, so a packet
+normally needs only its own insert.
+
+The receiver is the only writer of these rows. Changes made elsewhere (e.g.
+deleting a device's history) are picked up when the state expires (``ttl``).
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+
+RECENT_POINTS = 9
+
+
+class LocationPoint:
+    """Compact copy of a LocationData row that has coordinates."""
+    __slots__ = ('id', 'latitude', 'longitude', 'speed', 'heading', 'accuracy', 'satellites', 'signal_strength', 'created_at')
+
+    def __init__(self, id, latitude, longitude, speed=0, heading=0, accuracy=0, satellites=None, signal_strength=None,
+                 created_at=None):
+        self.id = id
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self.speed = speed or 0
+        self.heading = heading or 0
+        self.accuracy = accuracy or 0
+        self.satellites = satellites
+        self.signal_strength = signal_strength
+        self.created_at = created_at
+
+    @classmethod
+    def from_location(cls, location):
+        return cls(
+            location.id, location.latitude, location.longitude,
+            speed=location.speed, heading=location.heading, accuracy=location.accuracy,
+            satellites=location.satellites, signal_strength=location.signal_strength,
+            created_at=location.created_at,
+        )
+
+    def __repr__(self):
+        return f'<LocationPoint {self.id} ({self.latitude}, {self.longitude}) speed={self.speed}>'
+
+
+class DeviceHotState:
+    def __init__(self, device_id, points=(), state_name=None, counters=None, last_signal=None, last_signal_at=None,
+                 last_satellites=None, last_satellites_at=None):
+        self.device_id = device_id
+        self.points = deque(points, maxlen=RECENT_POINTS)  # oldest first
+        self.state_name = state_name
+        self.counters = dict(counters or {})
+        self.last_signal = last_signal
+        self.last_signal_at = last_signal_at
+        self.last_satellites = last_satellites
+        self.last_satellites_at = last_satellites_at
+        self.counters_saved_at = time.monotonic()
+        self.loaded_at = time.monotonic()
+
+    @property
+    def last_fix(self):
+        return self.points[-1] if self.points else None
+
+    def recent(self, count):
+        """Last ``count`` points, newest first."""
+        return list(self.points)[-count:][::-1] if count else []
+
+    def record_location(self, location):
+        """Apply a LocationData row the receiver has just created (or queued). Returns the new point, if any."""
+        point = None
+        if location.latitude is not None and location.longitude is not None:
+            point = LocationPoint.from_location(location)
+            self.points.append(point)
+        if location.satellites is not None:
+            self.last_satellites = location.satellites
+            self.last_satellites_at = location.created_at
+        if location.signal_strength is not None:
+            self.last_signal = location.signal_strength
+            self.last_signal_at = location.created_at
+        return point
+
+    def record_heartbeat(self, signal_strength, timestamp):
+        if signal_strength:
+            self.last_signal = signal_strength
+            self.last_signal_at = timestamp
+
+    def counters_due(self, interval):
+        return time.monotonic() - self.counters_saved_at >= interval
+
+    def mark_counters_saved(self):
+        self.counters_saved_at = time.monotonic()
+
+    def __repr__(self):
+        return f'<DeviceHotState {self.device_id} state={self.state_name} points={len(self.points)}>'
+
+
+def load_hot_state(device):
+    """Warm a device's hot state from the database (three queries)."""
+    from apps.gps_devices.models import DevicePresence, DeviceState, LocationData
+
+    last_state = DeviceState.objects.filter(device=device).select_related('state').order_by('-timestamp', '-id').first()
+    fixes = list(
+        LocationData.objects.filter(device=device, latitude__isnull=False, longitude__isnull=False)
+        .only('id', 'latitude', 'longitude', 'speed', 'heading', 'accuracy', 'satellites', 'signal_strength', 'created_at')
+        .order_by('-created_at')[:RECENT_POINTS]
+    )
+    presence = DevicePresence.objects.filter(device_id=device.id).only('signal_strength', 'last_hb_at').first()
+
+    state = DeviceHotState(
+        device.id,
+        points=[LocationPoint.from_location(loc) for loc in reversed(fixes)],
+        state_name=last_state.state.name if last_state else None,
+        counters=getattr(device, 'consecutive_count', None),
+    )
+    for loc in fixes:
+        if loc.satellites is not None:
+            state.last_satellites, state.last_satellites_at = loc.satellites, loc.created_at
+            break
+    readings = [(loc.signal_strength, loc.created_at) for loc in fixes]
+    if presence is not None:
+        readings.insert(0, (presence.signal_strength, presence.last_hb_at))
+    for signal, at in readings:
+        if signal:
+            state.last_signal, state.last_signal_at = signal, at
+            break
+    return state
+
+
+class HotStateCache:
+    """
+    Bounded LRU of DeviceHotState keyed by device id.
+
+    loader: function(device) -> DeviceHotState, called on a miss or expiry.
+    In-memory counters survive a reload since the receiver is their only writer.
+    """
+
+    def __init__(self, max_size=50000, ttl=3600.0, loader=load_hot_state):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.loader = loader
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def peek(self, device_id):
+        return self._states.get(device_id)
+
+    def get(self, device):
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.get(device.id)
+            if state is not None and (not self.ttl or now - state.loaded_at < self.ttl):
+                self._states.move_to_end(device.id)
+                return state
+        fresh = self.loader(device)
+        if state is not None:
+            fresh.counters = state.counters
+            fresh.counters_saved_at = state.counters_saved_at
+        with self._lock:
+            self._states[device.id] = fresh
+            self._states.move_to_end(device.id)
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+        return fresh
+
+    def discard(self, device_id):
+        with self._lock:
+            self._states.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
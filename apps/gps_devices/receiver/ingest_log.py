@@ -0,0 +1,426 @@
+"""
+Durable local ingest log
+
+An append-only log of received frames, split into memory-mapped segment
+files, so packets survive a stalled database or Redis and can be processed
+(or reprocessed) later by independent consumers:
+
+    <dir>/00000000000000000000.log     records, preallocated and mmap'ed
+    <dir>/00000000000000000000.index   per record: position (u32) + timestamp (f64)
+    <dir>/consumers/<group>.offset     next offset to read, per consumer group
+
+Every record gets an offset (its sequence number in the log); a segment file
+is named after the offset of its first record. Records are
+``length (u32) | crc32 (u32) | timestamp (f64) | payload``; the header is
+written after the payload, so a reader never sees a half-written record, and
+a zero length marks the end of the data written so far. On open the writer
+re-validates the tail of the last segment (CRC) and rebuilds missing index
+entries, so a crash loses at most the records written since the last flush.
+
+The receiver stores frames with ``encode_frame`` (connection id, IMEI bound to
+the connection, processed flag); ``gps_ingest_consumer`` processes the ones the
+receiver only acknowledged, and can replay any retained range.
+
+Usage:
+    log = IngestLog('/var/lib/gps/ingest')
+    offset = log.append(payload)
+
+    reader = IngestLogReader('/var/lib/gps/ingest', group='processor')
+    for record in reader.tail(reader.committed()):
+        handle(record.payload)
+        reader.commit(record.offset + 1)
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+_RECORD_HEADER = struct.Struct('<IId')  # payload length, crc32(timestamp + payload), timestamp
+_INDEX_ENTRY = struct.Struct('<Id')  # position in segment, timestamp
+_TIMESTAMP = struct.Struct('<d')
+
+LogRecord = namedtuple('LogRecord', 'offset timestamp payload')
+
+
+def _segment_name(base_offset, suffix):
+    return f'{base_offset:020d}{suffix}'
+
+
+def _list_segments(directory):
+    bases = []
+    for name in os.listdir(directory):
+        if name.endswith('.log') and name[:-4].isdigit():
+            bases.append(int(name[:-4]))
+    return sorted(bases)
+
+
+def _record_crc(timestamp_bytes, payload):
+    return zlib.crc32(payload, zlib.crc32(timestamp_bytes))
+
+
+def _read_record(buf, pos):
+    """(payload, timestamp, next position), or None if no valid record starts at pos."""
+    if pos + _RECORD_HEADER.size > len(buf):
+        return None
+    length, crc, timestamp = _RECORD_HEADER.unpack_from(buf, pos)
+    end = pos + _RECORD_HEADER.size + length
+    if length == 0 or end > len(buf):
+        return None
+    payload = bytes(buf[pos + _RECORD_HEADER.size:end])
+    if _record_crc(buf[pos + 4 + 4:pos + _RECORD_HEADER.size], payload) != crc:
+        return None
+    return payload, timestamp, end
+
+
+class _Segment:
+    """One segment: the mmap'ed record file and its index (positions and timestamps)."""
+
+    def __init__(self, directory, base_offset, size=None, writable=False):
+        self.base_offset = base_offset
+        self.path = os.path.join(directory, _segment_name(base_offset, '.log'))
+        self.index_path = os.path.join(directory, _segment_name(base_offset, '.index'))
+        mode = 'r+b' if writable else 'rb'
+        if writable and not os.path.exists(self.path):
+            # Preallocate under a temporary name so readers never map a half-created file
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'wb') as f:
+                f.truncate(size)
+            os.replace(tmp, self.path)
+        self._file = open(self.path, mode)
+        file_size = os.fstat(self._file.fileno()).st_size
+        self.mmap = mmap.mmap(self._file.fileno(), file_size,
+                              access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.positions = []
+        self.timestamps = []
+        self._load_index()
+
+    @property
+    def size(self):
+        return len(self.mmap)
+
+    @property
+    def next_offset(self):
+        return self.base_offset + len(self.positions)
+
+    @property
+    def end_position(self):
+        if not self.positions:
+            return 0
+        length = _RECORD_HEADER.unpack_from(self.mmap, self.positions[-1])[0]
+        return self.positions[-1] + _RECORD_HEADER.size + length
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        for pos in range(0, len(data) - len(data) % _INDEX_ENTRY.size, _INDEX_ENTRY.size):
+            position, timestamp = _INDEX_ENTRY.unpack_from(data, pos)
+            self.positions.append(position)
+            self.timestamps.append(timestamp)
+
+    def refresh(self):
+        """Pick up records written since the index was loaded (readers; writer recovery)."""
+        # Drop index entries whose record is not (or no longer) valid, e.g. after a crash
+        while self.positions and _read_record(self.mmap, self.positions[-1]) is None:
+            self.positions.pop()
+            self.timestamps.pop()
+        pos = self.end_position
+        added = 0
+        while True:
+            record = _read_record(self.mmap, pos)
+            if record is None:
+                break
+            self.positions.append(pos)
+            self.timestamps.append(record[1])
+            pos = record[2]
+            added += 1
+        return added
+
+    def read(self, offset):
+        position = self.positions[offset - self.base_offset]
+        payload, timestamp, _ = _read_record(self.mmap, position)
+        return LogRecord(offset, timestamp, payload)
+
+    def offset_for_time(self, timestamp):
+        return self.base_offset + bisect_left(self.timestamps, timestamp)
+
+    def close(self):
+        self.mmap.close()
+        self._file.close()
+
+
+class IngestLog:
+    """Single-writer segmented log (one per receiver process)."""
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, flush_interval=0.2, retention=72 * 3600):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.appended = 0
+        self._lock = threading.Lock()
+        self._index_file = None
+        self._dirty = False
+        self._last_timestamp = 0.0
+        os.makedirs(directory, exist_ok=True)
+        bases = _list_segments(directory)
+        self._segment = None
+        self._open_segment(bases[-1] if bases else 0, recover=bool(bases))
+        self._stopped = threading.Event()
+        self._flusher = None
+        if flush_interval:
+            self._flusher = threading.Thread(target=self._run, name='GPS_IngestLogFlush', daemon=True)
+            self._flusher.start()
+
+    @property
+    def next_offset(self):
+        return self._segment.next_offset
+
+    def _open_segment(self, base_offset, recover=False):
+        segment = _Segment(self.directory, base_offset, size=self.segment_size, writable=True)
+        if recover:
+            indexed = len(segment.positions)
+            segment.refresh()
+            if len(segment.positions) != indexed:
+                logger.info(f'Ingest log {self.directory}: recovered segment {base_offset} '
+                            f'({indexed} -> {len(segment.positions)} indexed records)')
+            # Rewrite the index so it matches the valid records exactly
+            with open(segment.index_path, 'wb') as f:
+                for position, timestamp in zip(segment.positions, segment.timestamps):
+                    f.write(_INDEX_ENTRY.pack(position, timestamp))
+            # Clear anything after the last valid record (torn write)
+            end = segment.end_position
+            if end + _RECORD_HEADER.size <= segment.size:
+                segment.mmap[end:end + _RECORD_HEADER.size] = bytes(_RECORD_HEADER.size)
+            if segment.timestamps:
+                self._last_timestamp = segment.timestamps[-1]
+        self._segment = segment
+        self._index_file = open(segment.index_path, 'ab')
+
+    def append(self, payload, timestamp=None):
+        """Append one record and return its offset."""
+        payload = bytes(payload)
+        needed = _RECORD_HEADER.size + len(payload)
+        if needed + _RECORD_HEADER.size > self.segment_size:
+            raise ValueError(f'Record of {len(payload)} bytes does not fit in a segment')
+        with self._lock:
+            # Timestamps never go backwards within the log (time lookups use bisect)
+            timestamp = max(timestamp if timestamp is not None else time.time(), self._last_timestamp)
+            segment = self._segment
+            position = segment.end_position
+            if position + needed + _RECORD_HEADER.size > segment.size:
+                self._roll()
+                segment = self._segment
+                position = 0
+            timestamp_bytes = _TIMESTAMP.pack(timestamp)
+            buf = segment.mmap
+            buf[position + _RECORD_HEADER.size:position + needed] = payload
+            buf[position:position + _RECORD_HEADER.size] = _RECORD_HEADER.pack(
+                len(payload), _record_crc(timestamp_bytes, payload), timestamp)
+            segment.positions.append(position)
+            segment.timestamps.append(timestamp)
+            self._index_file.write(_INDEX_ENTRY.pack(position, timestamp))
+            self._last_timestamp = timestamp
+            self._dirty = True
+            self.appended += 1
+            return segment.next_offset - 1
+
+    def _roll(self):
+        old = self._segment
+        self._flush_locked()
+        self._index_file.close()
+        old.close()
+        self._open_segment(old.next_offset)
+        self._apply_retention()
+
+    def _apply_retention(self):
+        if not self.retention:
+            return
+        cutoff = time.time() - self.retention
+        bases = _list_segments(self.directory)
+        # Never the active segment; a segment goes once its newest record is older than the cutoff
+        for base, next_base in zip(bases, bases[1:]):
+            if next_base > self._segment.base_offset:
+                break
+            segment = _Segment(self.directory, base)
+            try:
+                newest = segment.timestamps[-1] if segment.timestamps else 0
+            finally:
+                segment.close()
+            if newest >= cutoff:
+                break
+            for suffix in ('.log', '.index'):
+                try:
+                    os.remove(os.path.join(self.directory, _segment_name(base, suffix)))
+                except FileNotFoundError:
+                    pass
+            logger.info(f'Ingest log {self.directory}: removed segment {base} (older than retention)')
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self._dirty:
+            return
+        self._segment.mmap.flush()
+        self._index_file.flush()
+        os.fsync(self._index_file.fileno())
+        self._dirty = False
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'Ingest log flush failed: {e}')
+
+    def close(self):
+        self._stopped.set()
+        with self._lock:
+            self._flush_locked()
+            self._index_file.close()
+            self._segment.close()
+
+
+class IngestLogReader:
+    """
+    Reads a log written by ``IngestLog`` (possibly from another process) and
+    keeps the committed offset of a consumer group.
+    """
+
+    def __init__(self, directory, group=None):
+        self.directory = directory
+        self.group = group
+        self._segments = {}  # base offset -> _Segment (opened lazily)
+
+    def _offset_path(self):
+        return os.path.join(self.directory, 'consumers', f'{self.group}.offset')
+
+    def first_offset(self):
+        bases = _list_segments(self.directory)
+        return bases[0] if bases else 0
+
+    def committed(self):
+        """Next offset the group should read (the oldest retained offset if it never committed)."""
+        try:
+            with open(self._offset_path()) as f:
+                return max(int(f.read().strip() or 0), self.first_offset())
+        except (FileNotFoundError, ValueError):
+            return self.first_offset()
+
+    def commit(self, next_offset):
+        path = self._offset_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(next_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _segment_for(self, offset):
+        bases = _list_segments(self.directory)
+        base = None
+        for candidate in bases:
+            if candidate > offset:
+                break
+            base = candidate
+        if base is None:
+            return None, bases
+        segment = self._segments.get(base)
+        if segment is None:
+            for old in [b for b in self._segments if b not in bases]:
+                self._segments.pop(old).close()
+            segment = self._segments[base] = _Segment(self.directory, base)
+        return segment, bases
+
+    def offset_for_time(self, timestamp):
+        """First offset whose record was appended at or after ``timestamp`` (epoch seconds)."""
+        bases = _list_segments(self.directory)
+        for base in bases:
+            segment, _ = self._segment_for(base)
+            segment.refresh()
+            if segment.timestamps and segment.timestamps[-1] >= timestamp:
+                return segment.offset_for_time(timestamp)
+        return self._segment_for(bases[-1])[0].next_offset if bases else 0
+
+    def read(self, offset, max_records=1000):
+        """Up to max_records records starting at ``offset`` (fewer at the end of the log)."""
+        records = []
+        while len(records) < max_records:
+            segment, bases = self._segment_for(offset)
+            if segment is None:
+                if bases and offset < bases[0]:
+                    logger.warning(f'Ingest log offset {offset} was removed by retention; skipping to {bases[0]}')
+                    offset = bases[0]
+                    continue
+                break
+            if offset >= segment.next_offset:
+                segment.refresh()
+            if offset < segment.next_offset:
+                count = min(max_records - len(records), segment.next_offset - offset)
+                records.extend(segment.read(o) for o in range(offset, offset + count))
+                offset += count
+                continue
+            # End of this segment: move on only once the writer has rolled to the next one
+            later = [b for b in bases if b > segment.base_offset]
+            if later and later[0] == offset:
+                continue
+            break
+        return records
+
+    def tail(self, offset, poll_interval=0.2, stop=None, batch=1000):
+        """Yield records from ``offset`` on, waiting for new ones (until ``stop`` is set)."""
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            records = self.read(offset, batch)
+            if not records:
+                stop.wait(poll_interval)
+                continue
+            for record in records:
+                yield record
+            offset = records[-1].offset + 1
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments.clear()
+
+
+# Frame records: connection id, flags, lengths of protocol / ip / imei, then the raw frame
+_FRAME_HEADER = struct.Struct('!QBBBB')
+FRAME_PROCESSED = 0x01  # the receiver processed the frame itself (consumers skip it unless replaying)
+
+LoggedFrame = namedtuple('LoggedFrame', 'data ip_address protocol_type connection_id imei processed')
+
+
+def encode_frame(data, ip_address, protocol_type, connection_id=0, imei=None, processed=False):
+    protocol_b = (protocol_type or '').encode('ascii')
+    ip_b = (ip_address or '').encode('ascii')
+    imei_b = (imei or '').encode('utf-8')
+    flags = FRAME_PROCESSED if processed else 0
+    return (_FRAME_HEADER.pack(connection_id, flags, len(protocol_b), len(ip_b), len(imei_b))
+            + protocol_b + ip_b + imei_b + bytes(data))
+
+
+def decode_frame(payload):
+    """LoggedFrame of a record written with ``encode_frame``."""
+    connection_id, flags, protocol_len, ip_len, imei_len = _FRAME_HEADER.unpack_from(payload)
+    pos = _FRAME_HEADER.size
+    protocol_type = payload[pos:pos + protocol_len].decode('ascii')
+    pos += protocol_len
+    ip_address = payload[pos:pos + ip_len].decode('ascii') or None
+    pos += ip_len
+    imei = payload[pos:pos + imei_len].decode('utf-8') or None
+    pos += imei_len
+    return LoggedFrame(payload[pos:], ip_address, protocol_type, connection_id, imei, bool(flags & FRAME_PROCESSED))
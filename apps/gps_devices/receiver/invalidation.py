@@ -0,0 +1,160 @@
+"""
+Cache invalidation bus for receiver-side caches
+
+Web processes change ``Device`` (and other) rows while the receiver keeps
+process-local caches of them. Invalidations are dispatched to subscribers in
+the current process and published on a Redis pub/sub channel so every
+receiver worker drops its copy. Without Redis only local subscribers are
+notified and the caches fall back to their TTLs.
+
+Usage:
+    subscribe('device', registry.handle_invalidation)   # receiver
+    invalidate_device(device_id=device.id, imei=device.imei)   # anywhere
+"""
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'gps_devices:invalidate'
+
+_subscribers = defaultdict(list)
+_redis_client = None
+_redis_retry_at = 0.0
+_redis_lock = threading.Lock()
+
+
+def subscribe(kind, callback):
+    """
+    Register callback(payload) for invalidations of ``kind``.
+    payload is a dict, or None meaning "drop everything" (e.g. after a
+    missed-message window when the Redis subscription reconnects).
+    """
+    _subscribers[kind].append(callback)
+
+
+def unsubscribe(kind, callback):
+    try:
+        _subscribers[kind].remove(callback)
+    except ValueError:
+        pass
+
+
+def dispatch(kind, payload):
+    for callback in list(_subscribers.get(kind, ())):
+        try:
+            callback(payload)
+        except Exception as e:
+            logger.error(f'Invalidation callback for {kind} failed: {e}')
+
+
+def dispatch_all():
+    for kind in list(_subscribers):
+        dispatch(kind, None)
+
+
+def _redis_url():
+    try:
+        from django.conf import settings
+        return getattr(settings, 'GPS_CACHE_INVALIDATION_REDIS_URL', None)
+    except Exception:
+        return None
+
+
+def _get_redis():
+    """Shared publisher client; after a failure Redis is skipped for 30s instead of stalling callers."""
+    global _redis_client, _redis_retry_at
+    url = _redis_url()
+    if not (REDIS_AVAILABLE and url):
+        return None
+    with _redis_lock:
+        if _redis_client is None and time.monotonic() >= _redis_retry_at:
+            _redis_client = redis.Redis.from_url(url, socket_connect_timeout=0.5, socket_timeout=0.5)
+        return _redis_client
+
+
+def publish(kind, **payload):
+    """Invalidate locally and broadcast to other processes (best effort)."""
+    global _redis_client, _redis_retry_at
+    dispatch(kind, payload)
+    client = _get_redis()
+    if client is None:
+        return
+    try:
+        client.publish(CHANNEL, json.dumps({'kind': kind, 'payload': payload}))
+    except Exception as e:
+        logger.warning(f'Could not publish {kind} invalidation: {e}')
+        with _redis_lock:
+            _redis_client = None
+            _redis_retry_at = time.monotonic() + 30
+
+
+def publish_on_commit(kind, **payload):
+    """Publish after the current transaction commits, so readers never reload the old row."""
+    try:
+        from django.db import transaction
+        transaction.on_commit(lambda: publish(kind, **payload))
+    except Exception:
+        publish(kind, **payload)
+
+
+def invalidate_device(device_id=None, imei=None):
+    """Call after changing a Device row without save() (e.g. queryset.update())."""
+    publish_on_commit('device', id=device_id, imei=imei)
+
+
+class InvalidationListener:
+    """Background thread applying invalidations published by other processes."""
+
+    def __init__(self, url=None, reconnect_delay=5.0):
+        self.url = url or _redis_url()
+        self.reconnect_delay = reconnect_delay
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if not (REDIS_AVAILABLE and self.url):
+            logger.info('Cache invalidation listener disabled (no Redis configured); caches rely on TTLs')
+            return False
+        self._thread = threading.Thread(target=self._run, name='GPS_Invalidation', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        first = True
+        while not self._stopped.is_set():
+            try:
+                client = redis.Redis.from_url(self.url, socket_connect_timeout=5)
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                if not first:
+                    # Messages may have been missed while disconnected
+                    dispatch_all()
+                first = False
+                logger.info(f'Listening for cache invalidations on {CHANNEL}')
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message:
+                        continue
+                    try:
+                        body = json.loads(message['data'])
+                        dispatch(body['kind'], body.get('payload') or {})
+                    except Exception as e:
+                        logger.error(f'Invalid invalidation message: {e}')
+            except Exception as e:
+                logger.warning(f'Invalidation listener error: {e}; reconnecting in {self.reconnect_delay}s')
+                first = False
+                self._stopped.wait(self.reconnect_delay)
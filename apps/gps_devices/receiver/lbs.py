@@ -0,0 +1,150 @@
+"""
+Asynchronous cell-tower (LBS) resolution
+
+Resolving a cell (mcc, mnc, lac, cid) to coordinates can take several HTTP
+requests, so it never runs on the decode path. ``CellLocator`` answers from
+its cache when it can; otherwise the caller registers a callback and the
+cell is resolved on the pipeline's 'lbs' stage (its own bounded worker pool),
+after which the callbacks back-fill the LocationData row and broadcast it.
+
+- positive results are cached for ``ttl`` seconds, failures (None) for
+  ``negative_ttl`` so an unknown cell is not looked up again on every packet
+- concurrent requests for a cell in flight share one lookup
+- the cache is bounded by ``max_entries`` (least recently used evicted)
+- with a ``local_resolver`` (the local cell-tower store) a cache miss is
+  first resolved inline; only cells it does not know go to the stage
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Defaults of HQ packets that only carry LAC/CID (Iran, MCI)
+DEFAULT_MCC = 432
+DEFAULT_MNC = 1
+
+
+def cell_of(parsed_data):
+    """(mcc, mnc, lac, cid) of a parsed packet, or None without LAC/CID."""
+    lac, cid = parsed_data.get('lac'), parsed_data.get('cid')
+    if lac is None or cid is None:
+        return None
+    mcc, mnc = parsed_data.get('mcc'), parsed_data.get('mnc')
+    return (DEFAULT_MCC if mcc is None else mcc, DEFAULT_MNC if mnc is None else mnc, lac, cid)
+
+
+class CellLocator:
+    """
+    resolver(mcc, mnc, lac, cid) -> {lat, lon, accuracy, provider} or None; blocking.
+    submit(cell) -> bool queues a lookup (e.g. Stage.put); the stage handler is ``resolve_pending``.
+    local_resolver(mcc, mnc, lac, cid) -> location or None; fast, called inline on a cache miss.
+    """
+
+    def __init__(self, resolver, submit=None, ttl=86400.0, negative_ttl=900.0, max_entries=100000,
+                 clock=time.monotonic, local_resolver=None):
+        self.resolver = resolver
+        self.local_resolver = local_resolver
+        self.submit = submit
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.local_hits = 0
+        self.lookups = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self._cache = OrderedDict()  # cell -> (expires at, location or None), least recently used first
+        self._waiting = {}  # cell in flight -> [callback]
+        self._lock = threading.Lock()
+
+    def get(self, cell):
+        """(found, location): found is False when the cell is not cached; location None is a cached failure."""
+        now = self.clock()
+        with self._lock:
+            entry = self._cache.get(cell)
+            if entry is not None and entry[0] > now:
+                self._cache.move_to_end(cell)
+                if entry[1] is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+        if self.local_resolver is not None:
+            try:
+                location = self.local_resolver(*cell)
+            except Exception as e:
+                logger.warning(f'Local cell lookup failed for cell {cell}: {e}')
+                location = None
+            if location is not None:
+                with self._lock:
+                    self.local_hits += 1
+                self.store(cell, location)
+                return True, location
+        return False, None
+
+    def request(self, cell, callback):
+        """Call ``callback(location or None)`` from a stage worker once ``cell`` is resolved."""
+        with self._lock:
+            waiting = self._waiting.get(cell)
+            if waiting is not None:
+                waiting.append(callback)
+                self.coalesced += 1
+                return True
+            self._waiting[cell] = [callback]
+        if self.submit is not None and self.submit(cell):
+            return True
+        with self._lock:
+            self._waiting.pop(cell, None)
+            self.rejected += 1
+        return False
+
+    def resolve_pending(self, cell):
+        """Stage handler: look the cell up, cache the result and run the waiting callbacks."""
+        self.lookups += 1
+        try:
+            location = self.resolver(*cell)
+        except Exception as e:
+            logger.warning(f'LBS lookup failed for cell {cell}: {e}')
+            location = None
+        if location is None or location.get('lat') is None or location.get('lon') is None:
+            location = None
+            self.failures += 1
+        self.store(cell, location)
+        with self._lock:
+            callbacks = self._waiting.pop(cell, [])
+        for callback in callbacks:
+            try:
+                callback(location)
+            except Exception as e:
+                logger.error(f'LBS callback failed for cell {cell}: {e}')
+        return location
+
+    def store(self, cell, location):
+        expires_at = self.clock() + (self.ttl if location is not None else self.negative_ttl)
+        with self._lock:
+            self._cache[cell] = (expires_at, location)
+            self._cache.move_to_end(cell)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'entries': len(self._cache),
+                'in_flight': len(self._waiting),
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'local_hits': self.local_hits,
+                'lookups': self.lookups,
+                'failures': self.failures,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+            }
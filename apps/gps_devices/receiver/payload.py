@@ -0,0 +1,119 @@
+"""
+WebSocket payload for device updates, built without database reads
+
+Everything ``device_data`` needs comes from the location row that was just
+written, the cached device (registry) and the device's hot state (last fix,
+current state, last known GSM/satellite values). The receiver only touches
+the database when a device's hot state is cold.
+"""
+from datetime import datetime, timezone
+
+# State name -> code shown on the map (P: Parked, M: Moving, S: Stopped, I: Idle, O: Offline)
+STATE_CODES = {
+    'Moving': 'M',
+    'Stopped': 'S',
+    'Idle': 'I',
+    'Offline': 'O',
+}
+
+STATUS_DISPLAY = {
+    'M': {'icon': 'fa-car', 'color': '#22c55e', 'text': 'در حرکت'},
+    'P': {'icon': 'P', 'color': '#f59e0b', 'text': 'پارک شده'},
+    'S': {'icon': 'S', 'color': '#ef4444', 'text': 'متوقف شده'},
+    'I': {'icon': 'fa-pause', 'color': '#64748b', 'text': 'بی‌حرکت'},
+    'O': {'icon': 'fa-power-off', 'color': '#94a3b8', 'text': 'آفلاین'},
+}
+ALARM_DISPLAY = {'icon': 'fa-exclamation-triangle', 'color': '#ef4444', 'text': 'هشدار'}
+UNKNOWN_DISPLAY = {'icon': 'fa-circle', 'color': '#f8fafc', 'text': 'نامشخص'}
+
+
+def state_code(state_name):
+    if not state_name:
+        return None
+    return STATE_CODES.get(state_name) or state_name[0].upper()
+
+
+def status_display_info(device_state, is_alarm=False):
+    if is_alarm:
+        return dict(ALARM_DISPLAY)
+    return dict(STATUS_DISPLAY.get(device_state, UNKNOWN_DISPLAY))
+
+
+def build_device_payload(device, hot=None, location_data=None, speed=0, heading=0):
+    """
+    device: Device (or registry record) with id, name, imei, status
+    hot: DeviceHotState of the device, if warm
+    location_data: the LocationData the update is about (may be None)
+    """
+    last_fix = hot.last_fix if hot is not None else None
+
+    lat = lng = None
+    last_update = None
+    if location_data is not None and location_data.latitude is not None:
+        lat = float(location_data.latitude)
+        lng = float(location_data.longitude)
+        if location_data.created_at:
+            last_update = location_data.created_at.isoformat()
+    elif last_fix is not None:
+        lat = last_fix.latitude
+        lng = last_fix.longitude
+        if last_fix.created_at:
+            last_update = last_fix.created_at.isoformat()
+    if not last_update:
+        last_update = datetime.now(timezone.utc).isoformat()
+
+    created_at = getattr(location_data, 'created_at', None)
+
+    # Keep the last valid GPS/GSM values (0 is a valid reading, only None falls back)
+    satellites_val = getattr(location_data, 'satellites', None)
+    gps_from_cache = False
+    gps_ts = created_at
+    if satellites_val is None and hot is not None and hot.last_satellites is not None:
+        satellites_val = hot.last_satellites
+        gps_from_cache = True
+        gps_ts = gps_ts or hot.last_satellites_at
+    satellites_val = satellites_val or 0
+
+    signal_val = getattr(location_data, 'signal_strength', None)
+    gsm_from_cache = False
+    gsm_ts = created_at
+    if signal_val is None and hot is not None and hot.last_signal is not None:
+        signal_val = hot.last_signal
+        gsm_from_cache = True
+        gsm_ts = gsm_ts or hot.last_signal_at
+    signal_val = signal_val or 0
+
+    device_state = state_code(hot.state_name) if hot is not None else None
+    is_alarm = getattr(location_data, 'is_alarm', False) if location_data is not None else False
+    status_info = status_display_info(device_state, is_alarm)
+
+    return {
+        'id': device.id,
+        'name': device.name,
+        'imei': device.imei,
+        'device_id': device.imei,
+        'lat': lat,
+        'lng': lng,
+        'last_update': last_update,
+        'status': device.status,
+        'battery_level': getattr(location_data, 'battery_level', 0) if location_data is not None else 0,
+        'speed': float(speed) if speed is not None else 0,
+        'heading': float(heading) if heading is not None else 0,
+        'accuracy': getattr(location_data, 'accuracy', 0) if location_data is not None else 0,
+        'satellites': satellites_val,
+        'signal_strength': signal_val,
+        'matched_geometry': getattr(location_data, 'matched_geometry', None),
+        'is_alarm': is_alarm,
+        'alarm_type': getattr(location_data, 'alarm_type', '') if location_data is not None else '',
+        'device_state': device_state,  # وضعیت دستگاه (P, M, S, I)
+        'status_icon': status_info['icon'],
+        'status_color': status_info['color'],
+        'status_text': status_info['text'],
+        'gps_valid': satellites_val > 0,
+        'gsm_valid': signal_val > 0,
+        'gps_timestamp': gps_ts.isoformat() if gps_ts else None,
+        'gsm_timestamp': gsm_ts.isoformat() if gsm_ts else None,
+        'gps_from_cache': gps_from_cache,
+        'gsm_from_cache': gsm_from_cache,
+        'address': getattr(location_data, 'address', '') if location_data is not None else '',
+    }
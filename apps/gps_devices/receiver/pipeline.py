@@ -0,0 +1,375 @@
+"""
+Bounded, staged ingest pipeline
+
+    receive -> decode -> persist -> enrich -> broadcast
+
+Listener threads only receive and enqueue; every later stage has a bounded
+queue, so a reconnect storm (e.g. after a cell outage) costs queue slots,
+not unbounded memory and ever-growing latency:
+
+    decode     ``KeyedStage`` running process_gps_data (decode, checks, state)
+    persist    ``WriteBehindWriter`` queue (bounded, blocks when full)
+    enrich     ``Stage`` running reverse geocoding jobs
+    broadcast  ``DeviceBroadcaster`` (one pending update per device)
+
+When a stage queue is full its overflow policy decides what goes:
+
+    drop_oldest     drop the oldest queued item (stale positions are the least useful)
+    drop_heartbeat  drop the oldest queued heartbeat, else the oldest item
+    reject          refuse the new item; ``on_reject`` can NAK it
+
+``on_drop`` is called with each item a drop policy evicted.
+
+Dropped or rejected packets are not ACKed, so devices keep and resend them
+(in ack-first mode a packet is ACKed once queued, so a later drop loses it).
+Each stage starts ``min_workers`` threads and adds one (up to ``max_workers``)
+when no worker is idle and packets wait longer than ``target_wait`` seconds;
+extra workers exit after ``idle_timeout`` seconds without work.
+
+``KeyedStage`` is a stage of N single-threaded lanes: items are routed by a
+stable hash of their key (the device IMEI), so the packets of one device are
+processed one at a time and in arrival order, without locks, while different
+devices run in parallel.
+
+``LatencyRecorder`` keeps recent latency samples (e.g. last byte received ->
+ACK sent) and is reported with the queue metrics, as are counters registered
+with ``add_stats`` (e.g. dedup hit rates).
+"""
+import logging
+import threading
+import time
+import zlib
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_heartbeat', 'reject')
+
+
+class Stage:
+    def __init__(self, name, handler, max_queue=10000, policy='drop_oldest', min_workers=1, max_workers=8,
+                 target_wait=0.2, idle_timeout=30.0, is_low_priority=None, on_reject=None, on_drop=None,
+                 on_worker_exit=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Unknown overflow policy {policy!r} (expected one of {", ".join(OVERFLOW_POLICIES)})')
+        self.name = name
+        self.handler = handler
+        self.max_queue = max_queue
+        self.policy = policy
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.target_wait = target_wait
+        self.idle_timeout = idle_timeout
+        self.is_low_priority = is_low_priority
+        self.on_reject = on_reject
+        self.on_drop = on_drop
+        self.on_worker_exit = on_worker_exit
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.peak_depth = 0
+        self.wait_avg = 0.0  # moving average of queue wait (seconds)
+        self._items = deque()  # (enqueued_at, item, low_priority), oldest first
+        self._cond = threading.Condition()
+        self._workers = 0
+        self._idle = 0
+        self._last_scale = 0.0
+        self._closing = False
+        self._threads = set()
+
+    def __len__(self):
+        return len(self._items)
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def start(self):
+        with self._cond:
+            for _ in range(self.min_workers):
+                self._spawn()
+        return self
+
+    def put(self, item):
+        """Queue an item. Returns False if it was rejected (never blocks)."""
+        low = bool(self.is_low_priority and self.is_low_priority(item))
+        now = time.monotonic()
+        dropped = None
+        with self._cond:
+            if self._closing:
+                accepted = False
+            elif len(self._items) < self.max_queue:
+                accepted = True
+            else:
+                accepted, dropped = self._make_room(low)
+            if accepted:
+                self._items.append((now, item, low))
+                self.enqueued += 1
+                self.peak_depth = max(self.peak_depth, len(self._items))
+                self._maybe_scale(now)
+                self._cond.notify()
+            else:
+                self.rejected += 1
+        if dropped is not None and self.on_drop is not None:
+            try:
+                self.on_drop(dropped[1])
+            except Exception as e:
+                logger.error(f'Pipeline stage {self.name}: drop handler failed: {e}')
+        if not accepted and self.on_reject is not None:
+            try:
+                self.on_reject(item)
+            except Exception as e:
+                logger.error(f'Pipeline stage {self.name}: reject handler failed: {e}')
+        return accepted
+
+    def _make_room(self, low):
+        """(accepted, dropped queue entry or None)"""
+        if self.policy == 'reject':
+            return False, None
+        if self.policy == 'drop_heartbeat':
+            for index, entry in enumerate(self._items):
+                if entry[2]:
+                    del self._items[index]
+                    self.dropped += 1
+                    return True, entry
+            if low:
+                # Queue holds only real data: the new heartbeat is the one to lose
+                return False, None
+        self.dropped += 1
+        return True, self._items.popleft()
+
+    def _maybe_scale(self, now):
+        if self._idle or self._workers >= self.max_workers or now - self._last_scale < self.target_wait:
+            return
+        oldest_wait = now - self._items[0][0]
+        if max(self.wait_avg, oldest_wait) > self.target_wait:
+            self._last_scale = now
+            self._spawn()
+            logger.info(f'Pipeline stage {self.name}: scaled up to {self._workers} workers '
+                        f'(wait {self.wait_avg * 1000:.0f}ms, depth {len(self._items)})')
+
+    def _spawn(self):
+        self._workers += 1
+        thread = threading.Thread(target=self._run, name=f'GPS_{self.name}', daemon=True)
+        self._threads.add(thread)
+        thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._items:
+                        if self._closing:
+                            return
+                        self._idle += 1
+                        signalled = self._cond.wait(self.idle_timeout)
+                        self._idle -= 1
+                        if not signalled and not self._items and self._workers > self.min_workers:
+                            return
+                    enqueued_at, item, _ = self._items.popleft()
+                    self.wait_avg += 0.1 * ((time.monotonic() - enqueued_at) - self.wait_avg)
+                try:
+                    self.handler(item)
+                    self.processed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f'Pipeline stage {self.name} failed: {e}')
+        finally:
+            with self._cond:
+                self._workers -= 1
+                self._threads.discard(threading.current_thread())
+            if self.on_worker_exit is not None:
+                self.on_worker_exit()
+
+    def metrics(self):
+        with self._cond:
+            return {
+                'depth': len(self._items),
+                'peak_depth': self.peak_depth,
+                'max_queue': self.max_queue,
+                'workers': self._workers,
+                'wait_ms': round(self.wait_avg * 1000, 1),
+                'enqueued': self.enqueued,
+                'processed': self.processed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'rejected': self.rejected,
+            }
+
+    def close(self, timeout=5.0):
+        """Stop accepting items, let the workers drain the queue, then stop them."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+            threads = list(self._threads)
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+
+class KeyedStage:
+    """
+    ``lanes`` single-worker ``Stage`` lanes sharing one name and handler.
+    key: function(item) -> str; items with the same key always go to the same lane.
+    """
+
+    def __init__(self, name, handler, key, lanes=16, max_queue=10000, policy='drop_oldest', **options):
+        self.name = name
+        self.key = key
+        per_lane = max(1, max_queue // max(1, lanes))
+        self.lanes = [
+            Stage(f'{name}_{index}', handler, max_queue=per_lane, policy=policy, min_workers=1, max_workers=1,
+                  **options)
+            for index in range(max(1, lanes))
+        ]
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
+
+    @property
+    def workers(self):
+        return sum(lane.workers for lane in self.lanes)
+
+    def lane_for(self, key):
+        return self.lanes[zlib.crc32(str(key).encode()) % len(self.lanes)]
+
+    def start(self):
+        for lane in self.lanes:
+            lane.start()
+        return self
+
+    def put(self, item):
+        return self.lane_for(self.key(item)).put(item)
+
+    def metrics(self):
+        lanes = [lane.metrics() for lane in self.lanes]
+        totals = {name: sum(m[name] for m in lanes)
+                  for name in ('depth', 'max_queue', 'workers', 'enqueued', 'processed', 'failed', 'dropped', 'rejected')}
+        totals['peak_depth'] = max(m['peak_depth'] for m in lanes)  # deepest single lane (hot device)
+        totals['wait_ms'] = max(m['wait_ms'] for m in lanes)
+        totals['lanes'] = len(lanes)
+        return totals
+
+    def close(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        for lane in self.lanes:
+            lane.close(max(0.0, deadline - time.monotonic()))
+
+
+class LatencyRecorder:
+    """Last ``size`` latency samples (seconds); snapshot() gives percentiles in ms."""
+
+    def __init__(self, size=4096):
+        self.count = 0
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return {'count': self.count}
+
+        def percentile(fraction):
+            return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 2)
+
+        return {
+            'count': self.count,
+            'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': round(samples[-1] * 1000, 2),
+        }
+
+
+class Pipeline:
+    """
+    Named stages plus gauges for queues owned elsewhere (write-behind, broadcaster),
+    with a thread logging queue depths and drops every ``metrics_interval`` seconds.
+    """
+
+    def __init__(self, metrics_interval=60.0):
+        self.metrics_interval = metrics_interval
+        self.stages = {}
+        self.gauges = {}
+        self.latencies = {}
+        self.stats = {}
+        self._stopped = threading.Event()
+        self._reporter = None
+        self._reported = {}
+
+    def add_stage(self, stage):
+        self.stages[stage.name] = stage
+        return stage
+
+    def add_gauge(self, name, depth):
+        """depth: callable returning the current queue depth of an external stage."""
+        self.gauges[name] = depth
+
+    def add_latency(self, name, recorder):
+        self.latencies[name] = recorder
+        return recorder
+
+    def add_stats(self, name, snapshot):
+        """snapshot: callable returning a dict of counters to report."""
+        self.stats[name] = snapshot
+
+    def start(self):
+        for stage in self.stages.values():
+            stage.start()
+        if self.metrics_interval:
+            self._reporter = threading.Thread(target=self._report_loop, name='GPS_PipelineMetrics', daemon=True)
+            self._reporter.start()
+        return self
+
+    def metrics(self):
+        metrics = {name: stage.metrics() for name, stage in self.stages.items()}
+        for name, depth in self.gauges.items():
+            try:
+                metrics[name] = {'depth': depth()}
+            except Exception as e:
+                metrics[name] = {'error': str(e)}
+        for name, recorder in self.latencies.items():
+            metrics[f'{name}_latency'] = recorder.snapshot()
+        for name, snapshot in self.stats.items():
+            metrics[name] = snapshot()
+        return metrics
+
+    def _report_loop(self):
+        while not self._stopped.wait(self.metrics_interval):
+            self.report()
+
+    def report(self):
+        parts = []
+        for name, values in self.metrics().items():
+            if name in self.stats:
+                parts.append(f'{name}: ' + ' '.join(
+                    f'{key}={value}' for key, value in values.items() if not isinstance(value, dict)))
+                continue
+            if 'count' in values:
+                parts.append(f'{name}: n={values["count"]} p50={values.get("p50_ms")}ms '
+                             f'p95={values.get("p95_ms")}ms max={values.get("max_ms")}ms')
+                continue
+            if 'workers' not in values:
+                parts.append(f'{name}: depth={values.get("depth")}')
+                continue
+            lost = values['dropped'] + values['rejected']
+            new_lost = lost - self._reported.get(name, 0)
+            self._reported[name] = lost
+            parts.append(f'{name}: depth={values["depth"]}/{values["max_queue"]} workers={values["workers"]} '
+                         f'wait={values["wait_ms"]}ms dropped={values["dropped"]} rejected={values["rejected"]}')
+            if new_lost:
+                logger.warning(f'Pipeline stage {name} shed {new_lost} items since last report (queue full)')
+        logger.info('Pipeline ' + '; '.join(parts))
+
+    def close(self, timeout=5.0):
+        self._stopped.set()
+        for stage in self.stages.values():
+            stage.close(timeout)
@@ -0,0 +1,231 @@
+"""
+Device presence table and silence detection
+
+Heartbeats are most of the traffic and carry only "still alive" plus voltage
+and signal. Instead of replacing an HB ``LocationData`` row per heartbeat,
+the receiver records them here, in memory, and a flusher thread upserts the
+changed devices into ``DevicePresence`` (one narrow row per device) every
+``flush_interval`` seconds in one statement. Every packet also updates
+``last_seen_at``, so dashboards count online devices from this table instead
+of scanning ``LocationData``.
+
+A device deleted since its last packet is skipped (and forgotten), and rows
+that keep failing one by one are discarded, so one bad row cannot stall
+every later flush; only a failure of every row (database down) is retried.
+
+The hot state still gets the signal strength, and the HB counter still
+drives the Idle transition. ``SilenceDetector`` adds the transitions no
+packet announces: a timer wheel fires when a device stops sending locations
+(Idle) or stops sending anything (Offline), at O(1) cost per packet.
+"""
+import logging
+import math
+import threading
+import time
+
+from .timer_wheel import TimerWheel
+
+logger = logging.getLogger(__name__)
+
+
+class Presence:
+    __slots__ = ('device_id', 'last_seen_at', 'online', 'last_hb_at', 'device_time', 'voltage', 'signal_strength')
+
+    def __init__(self, device_id, last_seen_at=None, online=True):
+        self.device_id = device_id
+        self.last_seen_at = last_seen_at
+        self.online = online
+        self.last_hb_at = None  # None: no heartbeat seen by this process (row keeps its values)
+        self.device_time = None
+        self.voltage = None
+        self.signal_strength = None
+
+    def __repr__(self):
+        return f'<Presence {self.device_id} online={self.online} last_seen_at={self.last_seen_at}>'
+
+
+SEEN_FIELDS = ['last_seen_at', 'online']
+HEARTBEAT_FIELDS = SEEN_FIELDS + ['last_hb_at', 'device_time', 'voltage', 'signal_strength']
+
+
+def write_presence(entries):
+    """Upsert the entries; returns the ids of devices that no longer exist (not written)."""
+    from django.db import close_old_connections, transaction
+    from apps.gps_devices.models import Device, DevicePresence
+
+    close_old_connections()
+    ids = {entry.device_id for entry in entries}
+    existing = set(Device.objects.filter(id__in=ids).values_list('id', flat=True))
+    entries = [entry for entry in entries if entry.device_id in existing]
+    with transaction.atomic():
+        # Devices without a heartbeat since startup must not overwrite the stored one
+        for fields, group in ((HEARTBEAT_FIELDS, [e for e in entries if e.last_hb_at is not None]),
+                              (SEEN_FIELDS, [e for e in entries if e.last_hb_at is None])):
+            if not group:
+                continue
+            DevicePresence.objects.bulk_create(
+                [DevicePresence(device_id=entry.device_id, **{name: getattr(entry, name) for name in fields})
+                 for entry in group],
+                update_conflicts=True,
+                unique_fields=['device'],
+                update_fields=fields,
+            )
+    return ids - existing
+
+
+class PresenceTable:
+    def __init__(self, writer=write_presence, flush_interval=30.0):
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self._latest = {}  # device id -> Presence
+        self._dirty = {}  # device id -> Presence not yet written
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+
+    def _entry(self, device_id):
+        entry = self._latest.get(device_id)
+        if entry is None:
+            entry = self._latest[device_id] = Presence(device_id)
+        self._dirty[device_id] = entry
+        return entry
+
+    def seen(self, device_id, at):
+        """Any packet from the device: it is online."""
+        with self._lock:
+            entry = self._entry(device_id)
+            entry.last_seen_at = at
+            entry.online = True
+        return entry
+
+    def record(self, device_id, last_hb_at, device_time=None, voltage=None, signal_strength=None):
+        with self._lock:
+            entry = self._entry(device_id)
+            entry.last_seen_at = entry.last_hb_at = last_hb_at
+            entry.online = True
+            entry.device_time = device_time
+            entry.voltage = voltage
+            entry.signal_strength = signal_strength
+        return entry
+
+    def set_offline(self, device_id):
+        with self._lock:
+            self._entry(device_id).online = False
+
+    def get(self, device_id):
+        return self._latest.get(device_id)
+
+    @property
+    def pending(self):
+        return len(self._dirty)
+
+    def flush(self):
+        """Upsert the devices that sent a heartbeat since the last flush."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+        try:
+            missing = set(self.writer(list(dirty.values())) or ())
+        except Exception as e:
+            logger.error(f'Failed to flush device presence ({len(dirty)} devices): {e}; retrying row by row')
+            missing = set()
+            failed = []
+            for device_id, entry in dirty.items():
+                try:
+                    missing.update(self.writer([entry]) or ())
+                except Exception as row_error:
+                    failed.append((device_id, row_error))
+            if len(failed) == len(dirty):
+                # Nothing could be written (database down): keep them for the next flush
+                with self._lock:
+                    for device_id, entry in dirty.items():
+                        self._dirty.setdefault(device_id, entry)
+                return 0
+            for device_id, row_error in failed:
+                logger.error(f'Discarding presence of device {device_id}: {row_error}')
+            missing.update(device_id for device_id, _ in failed)
+        if missing:
+            self.forget(missing)
+        written = len(dirty) - len(missing)
+        self.rows_written += written
+        return written
+
+    def forget(self, device_ids):
+        """Drop devices (e.g. deleted ones) unless they were seen again since."""
+        with self._lock:
+            for device_id in device_ids:
+                if device_id not in self._dirty:
+                    self._latest.pop(device_id, None)
+
+    def start(self):
+        self._flusher = threading.Thread(target=self._run, name='GPS_Presence', daemon=True)
+        self._flusher.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stopped.set()
+        self.flush()
+
+
+class SilenceDetector:
+    """
+    Calls ``on_silent(device_id, payload, kind)`` from its own thread when a device
+    sent no location for ``idle_after`` seconds (kind 'idle') or nothing at all
+    for ``offline_after`` seconds (kind 'offline'). 0 disables a kind. ``payload``
+    is what the last ``touch`` passed (e.g. the IMEI).
+
+    The callback usually hands the work to another thread; by the time it runs a
+    packet may have restarted the timer, which ``is_silent`` tells.
+    """
+
+    def __init__(self, on_silent, idle_after=300.0, offline_after=600.0, tick=1.0, clock=time.monotonic):
+        self.on_silent = on_silent
+        self.idle_after = idle_after
+        self.offline_after = offline_after
+        self.clock = clock
+        # One turn of the wheel covers the longest delay, so timers never wait for extra turns
+        slots = math.ceil(max(idle_after, offline_after, tick) / tick) + 1
+        self.wheel = TimerWheel(tick=tick, slots=slots, now=clock())
+        self.fired = {'idle': 0, 'offline': 0}
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def touch(self, device_id, payload, location=True):
+        """A packet arrived; ``location`` is False for heartbeats (they do not end idleness)."""
+        now = self.clock()
+        if self.offline_after:
+            self.wheel.schedule((device_id, 'offline'), self.offline_after, payload, now=now)
+        if location and self.idle_after:
+            self.wheel.schedule((device_id, 'idle'), self.idle_after, payload, now=now)
+
+    def is_silent(self, device_id, kind):
+        """True if the device's ``kind`` timer fired and no packet restarted it since."""
+        return (device_id, kind) not in self.wheel
+
+    def poll(self):
+        fired = self.wheel.advance(self.clock())
+        for (device_id, kind), payload in fired:
+            self.fired[kind] += 1
+            try:
+                self.on_silent(device_id, payload, kind)
+            except Exception as e:
+                logger.error(f'Silence handler failed for device {device_id} ({kind}): {e}')
+        return len(fired)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='GPS_SilenceDetector', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.wheel.tick):
+            self.poll()
+
+    def close(self):
+        self._stopped.set()
@@ -0,0 +1,137 @@
+"""
+Token-bucket rate limiting for the receiver
+
+Each (scope, key) pair - e.g. ('ip', '1.2.3.4'), ('imei', '9176515388'),
+('protocol', 'udp') - has a bucket of ``burst`` tokens refilled at ``rate``
+tokens per second; a packet takes one token. Buckets live in a bounded LRU
+(``max_keys``) and idle ones are dropped after ``idle_ttl`` seconds, so
+scanning traffic from many addresses cannot grow memory without limit.
+
+With a Redis URL the buckets are kept in Redis (atomic Lua script), so all
+receiver workers and hosts enforce one shared limit. If Redis is unreachable
+the process falls back to its local buckets until Redis answers again.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+class LocalBucketStore:
+    def __init__(self, max_keys=100000, idle_ttl=600.0):
+        self.max_keys = max_keys
+        self.idle_ttl = idle_ttl
+        self._buckets = OrderedDict()  # (scope, key) -> [tokens, updated_at]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def consume(self, bucket_key, rate, burst, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            if bucket is None:
+                bucket = self._buckets[bucket_key] = [float(burst), now]
+                self._evict(now)
+            else:
+                self._buckets.move_to_end(bucket_key)
+                bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                return True
+            return False
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while len(buckets) > self.max_keys:
+            buckets.popitem(last=False)
+        # Least recently used first, so stop at the first bucket that is still active
+        while buckets:
+            oldest = next(iter(buckets.values()))
+            if now - oldest[1] < self.idle_ttl:
+                break
+            buckets.popitem(last=False)
+
+
+# KEYS[1] bucket; ARGV rate (tokens/s), burst, ttl (ms). Uses the Redis clock so hosts agree.
+_REDIS_BUCKET_SCRIPT = """
+local now_parts = redis.call('TIME')
+local now = tonumber(now_parts[1]) + tonumber(now_parts[2]) / 1000000
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 't', 'ts')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil then
+    tokens = burst
+else
+    tokens = math.min(burst, tokens + (now - ts) * rate)
+end
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 't', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+return allowed
+"""
+
+
+class RedisBucketStore:
+    def __init__(self, url, prefix='gps_rl', idle_ttl=600.0, fallback=None, retry_after=30.0):
+        self.prefix = prefix
+        self.idle_ttl = idle_ttl
+        self.fallback = fallback or LocalBucketStore(idle_ttl=idle_ttl)
+        self.retry_after = retry_after
+        self._client = redis.Redis.from_url(url, socket_connect_timeout=0.2, socket_timeout=0.2)
+        self._script = self._client.register_script(_REDIS_BUCKET_SCRIPT)
+        self._down_until = 0.0
+
+    def consume(self, bucket_key, rate, burst, now=None):
+        if time.monotonic() >= self._down_until:
+            scope, key = bucket_key
+            try:
+                return bool(self._script(keys=[f'{self.prefix}:{scope}:{key}'], args=[rate, burst, int(self.idle_ttl * 1000)]))
+            except Exception as e:
+                logger.warning(f'Rate limit backend unavailable ({e}); using local buckets for {self.retry_after:.0f}s')
+                self._down_until = time.monotonic() + self.retry_after
+        return self.fallback.consume(bucket_key, rate, burst, now)
+
+
+class RateLimiter:
+    """
+    limits: {scope: (per_minute, burst)}; a scope with per_minute <= 0 is unlimited.
+    """
+
+    def __init__(self, limits, max_keys=100000, idle_ttl=600.0, redis_url=None):
+        self.limits = {}
+        for scope, (per_minute, burst) in limits.items():
+            if per_minute and per_minute > 0:
+                self.limits[scope] = (per_minute / 60.0, max(1.0, float(burst or per_minute)))
+        local = LocalBucketStore(max_keys=max_keys, idle_ttl=idle_ttl)
+        if redis_url and REDIS_AVAILABLE:
+            self.store = RedisBucketStore(redis_url, idle_ttl=idle_ttl, fallback=local)
+        else:
+            if redis_url:
+                logger.warning('redis package not installed; rate limits are per process')
+            self.store = local
+
+    def allow(self, scope, key):
+        limit = self.limits.get(scope)
+        if limit is None or key is None:
+            return True
+        rate, burst = limit
+        return self.store.consume((scope, str(key)), rate, burst)
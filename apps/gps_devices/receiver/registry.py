@@ -0,0 +1,158 @@
+"""
+Process-local device registry for the ingest hot path
+
+Maps IMEI -> compact ``DeviceRecord`` so a packet does not need a
+``Device.objects.get(imei=...)`` round-trip (plus a second query for the
+owner ids when broadcasting). Entries are bounded (LRU) and expire after
+``ttl`` seconds; changes made elsewhere are pushed in through the
+invalidation bus (see ``invalidation.py`` and ``apps.gps_devices.signals``).
+
+``consecutive_count`` is only written by the receiver, so the cached copy is
+kept current by ``update_counters`` instead of being reloaded.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+# Device columns held in a record, in the order of Device._meta.concrete_fields
+RECORD_FIELDS = ('id', 'imei', 'owner_id', 'assigned_subuser_id', 'expires_at', 'name', 'status', 'consecutive_count')
+
+
+class DeviceRecord:
+    __slots__ = RECORD_FIELDS + ('loaded_at',)
+
+    def __init__(self, **values):
+        for field in RECORD_FIELDS:
+            setattr(self, field, values.get(field))
+        if self.consecutive_count is None:
+            self.consecutive_count = {}
+        self.loaded_at = time.monotonic()
+
+    @classmethod
+    def from_device(cls, device):
+        return cls(**{field: getattr(device, field, None) for field in RECORD_FIELDS})
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in RECORD_FIELDS}
+
+    def to_device(self):
+        """
+        Build a Device instance from the record. Columns that are not cached are
+        deferred, so a plain save() cannot overwrite them with stale values.
+        """
+        from apps.gps_devices.models import Device
+        from django.db import DEFAULT_DB_ALIAS
+
+        values = self.as_dict()
+        values['consecutive_count'] = copy.deepcopy(self.consecutive_count)
+        field_names = [f.attname for f in Device._meta.concrete_fields if f.attname in values]
+        return Device.from_db(DEFAULT_DB_ALIAS, field_names, [values[name] for name in field_names])
+
+    def __repr__(self):
+        return f'<DeviceRecord {self.imei} id={self.id} status={self.status}>'
+
+
+def load_device_record(imei):
+    from apps.gps_devices.models import Device
+
+    row = Device.objects.filter(imei=imei).values(*RECORD_FIELDS).first()
+    return DeviceRecord(**row) if row else None
+
+
+class DeviceRegistry:
+    """
+    Bounded LRU cache of DeviceRecord keyed by IMEI.
+
+    loader: function(imei) -> DeviceRecord or None, called on a miss.
+    Unknown IMEIs are not cached (the receiver auto-creates them).
+    """
+
+    def __init__(self, max_size=50000, ttl=300.0, loader=load_device_record):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.loader = loader
+        self.hits = 0
+        self.misses = 0
+        self._records = OrderedDict()  # imei -> DeviceRecord
+        self._imei_by_id = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def peek(self, imei):
+        """Cached record or None, without loading or refreshing the LRU position."""
+        return self._records.get(str(imei))
+
+    def get(self, imei):
+        imei = str(imei)
+        now = time.monotonic()
+        with self._lock:
+            record = self._records.get(imei)
+            if record is not None and (not self.ttl or now - record.loaded_at < self.ttl):
+                self._records.move_to_end(imei)
+                self.hits += 1
+                return record
+        self.misses += 1
+        record = self.loader(imei)
+        if record is None:
+            self.discard(imei=imei)
+            return None
+        return self.remember(record)
+
+    def get_device(self, imei):
+        """Device instance for an IMEI; raises Device.DoesNotExist like objects.get()."""
+        record = self.get(imei)
+        if record is None:
+            from apps.gps_devices.models import Device
+            raise Device.DoesNotExist(f'Device {imei} does not exist')
+        return record.to_device()
+
+    def remember(self, record):
+        """Add a record (or a Device instance, e.g. right after auto-create)."""
+        if not isinstance(record, DeviceRecord):
+            record = DeviceRecord.from_device(record)
+        imei = str(record.imei)
+        with self._lock:
+            old = self._records.pop(imei, None)
+            if old is not None and old.id != record.id:
+                self._imei_by_id.pop(old.id, None)
+            self._records[imei] = record
+            self._imei_by_id[record.id] = imei
+            while len(self._records) > self.max_size:
+                _, evicted = self._records.popitem(last=False)
+                self._imei_by_id.pop(evicted.id, None)
+        return record
+
+    def update_counters(self, imei, consecutive_count):
+        record = self._records.get(str(imei))
+        if record is not None:
+            record.consecutive_count = copy.deepcopy(consecutive_count)
+
+    def discard(self, device_id=None, imei=None):
+        with self._lock:
+            if imei is None and device_id is not None:
+                imei = self._imei_by_id.get(device_id)
+            if imei is None:
+                return
+            record = self._records.pop(str(imei), None)
+            if record is not None:
+                self._imei_by_id.pop(record.id, None)
+            if device_id is not None:
+                # The IMEI may have changed; drop the entry cached under the old one too
+                old_imei = self._imei_by_id.pop(device_id, None)
+                if old_imei is not None:
+                    self._records.pop(old_imei, None)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._imei_by_id.clear()
+
+    def handle_invalidation(self, payload):
+        """Subscriber for the 'device' invalidation kind."""
+        if not payload:
+            self.clear()
+            return
+        self.discard(device_id=payload.get('id'), imei=payload.get('imei'))
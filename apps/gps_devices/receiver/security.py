@@ -0,0 +1,282 @@
+"""
+Compiled MaliciousPattern matcher
+
+``check_security`` used to load every active ``MaliciousPattern`` per packet
+and test them one by one. ``PatternMatcher`` compiles the active rows once:
+
+- exact patterns        -> dict lookups on the text and hex forms
+- contains / startswith -> one Aho-Corasick automaton run over both forms
+- regex patterns        -> one combined precompiled regex as a prefilter
+- IP addresses          -> a dict keyed by IP
+
+When several patterns match, the one the old loop would have hit first
+(newest first, the model ordering) is reported. Hit counts are aggregated in
+memory and written in batches by ``flush_hits``. The matcher is rebuilt
+lazily after a 'malicious_patterns' invalidation (see ``invalidation.py``).
+"""
+import logging
+import re
+import threading
+from collections import deque
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class AhoCorasick:
+    """Multi-pattern substring search; ``iter(text)`` yields (start, value) for every occurrence."""
+
+    def __init__(self):
+        self._goto = [{}]
+        self._words = [[]]  # state -> [(length, value)] for words ending exactly there
+        self._fail = [0]
+        self._out = [[]]  # state -> words ending there, including via fail links
+        self._built = False
+
+    def add(self, word, value):
+        state = 0
+        for char in word:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._words.append([])
+            state = nxt
+        self._words[state].append((len(word), value))
+        self._built = False
+
+    def build(self):
+        goto = self._goto
+        self._fail = [0] * len(goto)
+        self._out = [list(words) for words in self._words]
+        todo = deque(goto[0].values())
+        while todo:
+            state = todo.popleft()
+            for char, nxt in goto[state].items():
+                todo.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in goto[fail]:
+                    fail = self._fail[fail]
+                target = goto[fail].get(char, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] += self._out[self._fail[nxt]]
+        self._built = True
+
+    def __bool__(self):
+        return len(self._goto) > 1
+
+    def iter(self, text):
+        if not self._built:
+            self.build()
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for pos, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, value in out[state]:
+                yield pos - length + 1, value
+
+
+class CompiledPattern:
+    __slots__ = ('id', 'priority', 'label', 'pattern', 'pattern_type', 'ip_address', 'regex')
+
+    def __init__(self, id, priority, pattern, pattern_type, ip_address, description=''):
+        self.id = id
+        self.priority = priority
+        self.label = description or (pattern or '')[:50]
+        self.pattern = pattern
+        self.pattern_type = pattern_type
+        self.ip_address = ip_address
+        self.regex = None
+
+
+class PatternMatcher:
+    """
+    rows: iterable of objects/dicts with id, pattern, pattern_type, ip_address, description,
+    in priority order (the order check_security used to test them).
+    """
+
+    def __init__(self, rows=()):
+        self.patterns = []
+        self._exact = {}
+        self._by_ip = {}
+        self._automaton = AhoCorasick()
+        self._regexes = []
+        self._combined_regex = None
+        for priority, row in enumerate(rows):
+            self._add(priority, row)
+        if self._automaton:
+            self._automaton.build()
+        if self._regexes:
+            try:
+                self._combined_regex = re.compile('|'.join(f'(?:{p.regex.pattern})' for p in self._regexes))
+            except re.error:
+                # e.g. numbered backreferences; test the regexes one by one instead
+                self._combined_regex = None
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _add(self, priority, row):
+        get = row.get if isinstance(row, dict) else (lambda name: getattr(row, name, None))
+        compiled = CompiledPattern(
+            get('id'), priority, get('pattern'), get('pattern_type') or 'contains', get('ip_address'),
+            get('description') or '',
+        )
+        self.patterns.append(compiled)
+
+        # Pattern and IP both set: either one matching is enough (OR logic)
+        if compiled.ip_address:
+            self._by_ip.setdefault(compiled.ip_address, []).append(compiled)
+        if not compiled.pattern:
+            return
+        if compiled.pattern_type == 'exact':
+            self._exact.setdefault(compiled.pattern, []).append(compiled)
+        elif compiled.pattern_type in ('contains', 'startswith'):
+            self._automaton.add(compiled.pattern, compiled)
+        elif compiled.pattern_type == 'regex':
+            try:
+                compiled.regex = re.compile(compiled.pattern)
+                self._regexes.append(compiled)
+            except re.error as e:
+                logger.warning(f'Ignoring invalid malicious regex {compiled.pattern[:50]!r}: {e}')
+
+    def match(self, ip_address, data, data_str=None, data_hex=None):
+        """Return the highest-priority CompiledPattern matching the packet, or None."""
+        if not self.patterns:
+            return None
+        if data_str is None:
+            data_str = data.decode('utf-8', errors='ignore')
+        if data_hex is None:
+            data_hex = data.hex()
+
+        best = None
+
+        def consider(candidate):
+            nonlocal best
+            if best is None or candidate.priority < best.priority:
+                best = candidate
+
+        for candidate in self._by_ip.get(ip_address, ()):
+            consider(candidate)
+        for text in (data_str, data_hex):
+            for candidate in self._exact.get(text, ()):
+                consider(candidate)
+        if self._automaton:
+            for text in (data_str, data_hex):
+                for start, candidate in self._automaton.iter(text):
+                    if candidate.pattern_type == 'contains' or start == 0:
+                        consider(candidate)
+        if self._regexes and (self._combined_regex is None
+                              or self._combined_regex.search(data_str) or self._combined_regex.search(data_hex)):
+            for candidate in self._regexes:
+                if best is not None and candidate.priority > best.priority:
+                    break
+                if candidate.regex.search(data_str) or candidate.regex.search(data_hex):
+                    consider(candidate)
+                    break
+        return best
+
+
+def load_active_patterns():
+    from apps.gps_devices.models import MaliciousPattern
+
+    return list(
+        MaliciousPattern.objects.filter(is_active=True)
+        .values('id', 'pattern', 'pattern_type', 'ip_address', 'description')
+    )
+
+
+class MaliciousPatternGuard:
+    """
+    Process-wide matcher + hit counter used by the receiver.
+    The matcher is built on first use and rebuilt after invalidate().
+    """
+
+    def __init__(self, loader=load_active_patterns, flush_interval=30.0):
+        self.loader = loader
+        self.flush_interval = flush_interval
+        self._matcher = None
+        self._stale = True
+        self._build_lock = threading.Lock()
+        self._hits = {}  # pattern id -> [count, last_hit]
+        self._hits_lock = threading.Lock()
+        self._flusher = None
+        self._stopped = threading.Event()
+
+    def invalidate(self, payload=None):
+        self._stale = True
+
+    def matcher(self):
+        if self._stale or self._matcher is None:
+            with self._build_lock:
+                if self._stale or self._matcher is None:
+                    self._stale = False
+                    try:
+                        self._matcher = PatternMatcher(self.loader())
+                        logger.info(f'Compiled {len(self._matcher)} malicious patterns')
+                    except Exception:
+                        self._stale = True
+                        if self._matcher is None:
+                            raise
+                        logger.exception('Failed to rebuild malicious patterns; keeping previous set')
+        return self._matcher
+
+    def check(self, ip_address, data, data_str=None, data_hex=None):
+        matched = self.matcher().match(ip_address, data, data_str=data_str, data_hex=data_hex)
+        if matched is not None and matched.id is not None:
+            self.record_hit(matched.id)
+        return matched
+
+    def record_hit(self, pattern_id, when=None):
+        if when is None:
+            when = datetime.now(timezone.utc)
+        with self._hits_lock:
+            entry = self._hits.get(pattern_id)
+            if entry is None:
+                self._hits[pattern_id] = [1, when]
+            else:
+                entry[0] += 1
+                entry[1] = when
+
+    def take_hits(self):
+        with self._hits_lock:
+            hits, self._hits = self._hits, {}
+        return hits
+
+    def flush_hits(self):
+        """Write aggregated hit counts (one UPDATE per pattern, one transaction)."""
+        hits = self.take_hits()
+        if not hits:
+            return 0
+        from django.db import close_old_connections, transaction
+        from django.db.models import F
+        from apps.gps_devices.models import MaliciousPattern
+
+        close_old_connections()
+        try:
+            with transaction.atomic():
+                for pattern_id, (count, last_hit) in hits.items():
+                    MaliciousPattern.objects.filter(id=pattern_id).update(hit_count=F('hit_count') + count, last_hit=last_hit)
+        except Exception as e:
+            logger.error(f'Failed to flush malicious pattern hits: {e}')
+            with self._hits_lock:
+                for pattern_id, (count, last_hit) in hits.items():
+                    entry = self._hits.setdefault(pattern_id, [0, last_hit])
+                    entry[0] += count
+            return 0
+        return len(hits)
+
+    def start(self):
+        self._flusher = threading.Thread(target=self._run, name='GPS_PatternHits', daemon=True)
+        self._flusher.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush_hits()
+
+    def close(self):
+        self._stopped.set()
+        self.flush_hits()
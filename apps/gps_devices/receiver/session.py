@@ -0,0 +1,56 @@
+"""
+Long-lived TCP device sessions
+
+One ``DeviceSession`` exists per open TCP connection. It owns the
+connection's stream framer and remembers the IMEI bound at login, so
+packets that do not carry an IMEI (GT06 location/heartbeat) can still be
+attributed to a device without a lookup.
+"""
+import itertools
+import random
+import time
+
+from .framing import StreamFramer
+
+# Random base so connection ids of different runs do not collide (see ingest_log)
+_connection_ids = itertools.count(random.getrandbits(47) << 16)
+
+
+class DeviceSession:
+    __slots__ = ('id', 'address', 'transport', 'framer', 'imei', 'connected_at', 'last_seen', 'frames_received')
+
+    def __init__(self, address, transport='tcp', max_buffer=None):
+        self.id = next(_connection_ids)
+        self.address = address
+        self.transport = transport
+        self.framer = StreamFramer(max_buffer=max_buffer) if max_buffer else StreamFramer()
+        self.imei = None
+        self.connected_at = time.monotonic()
+        self.last_seen = self.connected_at
+        self.frames_received = 0
+
+    @property
+    def ip_address(self):
+        return self.address[0] if self.address else None
+
+    @property
+    def protocol(self):
+        return self.framer.protocol
+
+    def feed(self, data):
+        """Buffer received bytes and return complete frames (may raise FrameBufferOverflow)."""
+        self.last_seen = time.monotonic()
+        frames = self.framer.feed(data)
+        self.frames_received += len(frames)
+        return frames
+
+    def bind(self, imei):
+        """Attach the connection to a device IMEI (normally on the login packet)."""
+        if imei:
+            self.imei = str(imei)
+
+    def idle_for(self):
+        return time.monotonic() - self.last_seen
+
+    def __repr__(self):
+        return f'<DeviceSession {self.address} protocol={self.protocol} imei={self.imei}>'
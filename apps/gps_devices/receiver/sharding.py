@@ -0,0 +1,223 @@
+"""
+IMEI-affine sharding between receiver worker processes
+
+With ``--workers N`` every worker accepts connections on the same port
+(``SO_REUSEPORT``), so the kernel decides which worker sees a packet. To keep
+``consecutive_count`` and ``DeviceState`` updates of one device ordered, each
+IMEI is owned by exactly one worker (``crc32(imei) % N``). A worker that
+receives a frame for a device it does not own sends it to the owner over a
+local Unix datagram socket, routing on the device id in the frame header
+(``frame_device_key``) before decoding it. The owner queues forwarded frames
+on its decode stage, in the device's lane, so they are ordered with the
+device's other packets.
+
+A forwarded frame that expects a reply carries the sender's worker index and
+a request id. The owner sends its reply (the protocol ACK, once the frame's
+rows are committed) back over the sender's socket, which hands it to the
+connection's reply callback; the receiving worker never ACKs a frame itself.
+If the owner drops the frame no reply comes and the device resends it.
+
+Sends never block: if the owner's socket buffer is full the frame is not
+forwarded and the receiving worker processes it itself.
+"""
+import logging
+import os
+import socket
+import struct
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# kind, protocol_type length, ip length, imei length, sender worker, request id (0: no reply)
+_HEADER = struct.Struct('!cBBBHI')
+# kind, request id
+_REPLY_HEADER = struct.Struct('!cI')
+FRAME = b'F'
+REPLY = b'R'
+MAX_FORWARD_SIZE = 64 * 1024
+
+
+def shard_for(imei, shards):
+    """Stable shard index for an IMEI (identical in every process, unlike hash())."""
+    if shards <= 1:
+        return 0
+    return zlib.crc32(str(imei).encode('utf-8')) % shards
+
+
+def encode_envelope(imei, data, ip_address, protocol_type, sender=0, request_id=0):
+    protocol_b = (protocol_type or '').encode('ascii')
+    ip_b = (ip_address or '').encode('ascii')
+    imei_b = str(imei).encode('utf-8')
+    header = _HEADER.pack(FRAME, len(protocol_b), len(ip_b), len(imei_b), sender, request_id)
+    return header + protocol_b + ip_b + imei_b + bytes(data)
+
+
+def decode_envelope(payload):
+    """(imei, data, ip_address, protocol_type) of a forwarded frame."""
+    return _decode_frame(payload)[2:]
+
+
+def _decode_frame(payload):
+    _, protocol_len, ip_len, imei_len, sender, request_id = _HEADER.unpack_from(payload)
+    pos = _HEADER.size
+    protocol_type = payload[pos:pos + protocol_len].decode('ascii')
+    pos += protocol_len
+    ip_address = payload[pos:pos + ip_len].decode('ascii') or None
+    pos += ip_len
+    imei = payload[pos:pos + imei_len].decode('utf-8')
+    pos += imei_len
+    return sender, request_id, imei, payload[pos:], ip_address, protocol_type
+
+
+class ShardRouter:
+    """
+    Routes frames to the worker owning their IMEI.
+
+    handler: function(imei, data, ip_address, protocol_type[, reply_callback])
+    called for frames forwarded to this worker by its siblings, on the router
+    thread (it should only queue the frame). ``reply_callback`` is passed when
+    the sender waits for a reply.
+
+    Reply callbacks of frames forwarded by this worker are kept until their
+    reply arrives; the oldest ``max_waiting`` are kept (a frame the owner
+    dropped never gets one).
+    """
+
+    def __init__(self, index, count, socket_dir=None, name='gps_receiver', max_waiting=10000):
+        self.index = index
+        self.count = count
+        self.socket_dir = socket_dir or os.path.join(tempfile.gettempdir(), f'{name}_shards')
+        self.max_waiting = max_waiting
+        self.forwarded = 0
+        self.failed = 0
+        self.received = 0
+        self.replies = 0
+        self.expired = 0
+        self._waiting = OrderedDict()  # request id -> reply callback
+        self._next_request = 0
+        self._lock = threading.Lock()
+        self._sock = None
+        self._send_sock = None
+        self._thread = None
+
+    def socket_path(self, index):
+        return os.path.join(self.socket_dir, f'worker-{index}.sock')
+
+    def owns(self, imei):
+        return shard_for(imei, self.count) == self.index
+
+    def start(self, handler):
+        os.makedirs(self.socket_dir, exist_ok=True)
+        path = self.socket_path(self.index)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self._sock.bind(path)
+        self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._send_sock.setblocking(False)
+        self._thread = threading.Thread(target=self._serve, args=(handler,), name=f'GPS_Shard_{self.index}', daemon=True)
+        self._thread.start()
+        logger.info(f'Shard router for worker {self.index}/{self.count} listening on {path}')
+
+    def forward(self, imei, data, ip_address, protocol_type, reply_callback=None):
+        """
+        Send a frame to its owning worker; its reply, if any, is passed to
+        ``reply_callback`` (router thread). Returns False if the owner is unreachable or busy.
+        """
+        owner = shard_for(imei, self.count)
+        request_id = self._wait_reply(reply_callback) if reply_callback is not None else 0
+        try:
+            self._send_sock.sendto(encode_envelope(imei, data, ip_address, protocol_type, self.index, request_id),
+                                   self.socket_path(owner))
+            self.forwarded += 1
+            return True
+        except BlockingIOError:
+            self.failed += 1
+            logger.warning(f'Worker {owner} is not keeping up; processing packet of {imei} locally')
+        except OSError as e:
+            self.failed += 1
+            logger.error(f'Failed to forward packet of {imei} to worker {owner}: {e}')
+        if request_id:
+            with self._lock:
+                self._waiting.pop(request_id, None)
+        return False
+
+    def _wait_reply(self, reply_callback):
+        with self._lock:
+            self._next_request = self._next_request % 0xFFFFFFFF + 1
+            request_id = self._next_request
+            self._waiting[request_id] = reply_callback
+            while len(self._waiting) > self.max_waiting:
+                self._waiting.popitem(last=False)
+                self.expired += 1
+        return request_id
+
+    def _reply_to(self, sender, request_id):
+        def reply(response):
+            try:
+                self._send_sock.sendto(_REPLY_HEADER.pack(REPLY, request_id) + bytes(response), self.socket_path(sender))
+            except OSError as e:
+                logger.error(f'Failed to send reply to worker {sender}: {e}')
+
+        return reply
+
+    def snapshot(self):
+        return {'forwarded': self.forwarded, 'failed': self.failed, 'received': self.received,
+                'replies': self.replies, 'expired': self.expired}
+
+    def _serve(self, handler):
+        while True:
+            try:
+                payload = self._sock.recv(MAX_FORWARD_SIZE)
+            except OSError:
+                break
+            if payload[:1] == REPLY:
+                self._deliver_reply(payload)
+                continue
+            try:
+                sender, request_id, imei, data, ip_address, protocol_type = _decode_frame(payload)
+            except Exception as e:
+                logger.error(f'Invalid forwarded packet: {e}')
+                continue
+            self.received += 1
+            try:
+                if request_id:
+                    handler(imei, data, ip_address, protocol_type, self._reply_to(sender, request_id))
+                else:
+                    handler(imei, data, ip_address, protocol_type)
+            except Exception as e:
+                logger.error(f'Error processing forwarded packet of {imei}: {e}')
+
+    def _deliver_reply(self, payload):
+        try:
+            _, request_id = _REPLY_HEADER.unpack_from(payload)
+        except struct.error as e:
+            logger.error(f'Invalid forwarded reply: {e}')
+            return
+        with self._lock:
+            reply_callback = self._waiting.pop(request_id, None)
+        if reply_callback is None:
+            return  # expired, or a second reply to the same frame
+        self.replies += 1
+        try:
+            reply_callback(payload[_REPLY_HEADER.size:])
+        except Exception as e:
+            logger.error(f'Error sending forwarded reply: {e}')
+
+    def close(self):
+        for sock in (self._sock, self._send_sock):
+            if sock is not None:
+                try:
+                    sock.close()
+                except Exception:
+                    pass
+        try:
+            os.unlink(self.socket_path(self.index))
+        except OSError:
+            pass
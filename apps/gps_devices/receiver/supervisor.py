@@ -0,0 +1,90 @@
+"""
+Pre-fork supervisor for multi-process receivers
+
+Forks ``workers`` children that each run ``run_worker(index)`` and restarts
+any child that exits, with an exponential backoff for children that keep
+crashing right after start. SIGTERM/SIGINT are forwarded to the children.
+"""
+import logging
+import os
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ReceiverSupervisor:
+    def __init__(self, workers, run_worker, restart_delay=1.0, max_restart_delay=30.0, stable_after=60.0):
+        self.workers = workers
+        self.run_worker = run_worker
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stable_after = stable_after
+        self.children = {}  # pid -> (index, started_at)
+        self.delays = {}  # index -> current restart delay
+        self.stopping = False
+
+    def start(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+
+        for index in range(self.workers):
+            self._spawn(index)
+        logger.info(f'Receiver supervisor {os.getpid()} started {self.workers} workers')
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            index, started_at = self.children.pop(pid, (None, None))
+            if index is None:
+                continue
+            if self.stopping:
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+            uptime = time.monotonic() - started_at
+            if uptime >= self.stable_after:
+                self.delays[index] = self.restart_delay
+            delay = self.delays.get(index, self.restart_delay)
+            logger.error(f'Receiver worker {index} (pid {pid}) exited with {code} after {uptime:.0f}s; '
+                         f'restarting in {delay:.0f}s')
+            time.sleep(delay)
+            self.delays[index] = min(delay * 2, self.max_restart_delay)
+            if not self.stopping:
+                self._spawn(index)
+
+        logger.info('Receiver supervisor stopped')
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                self.run_worker(index)
+            except KeyboardInterrupt:
+                pass
+            except BaseException as e:
+                logger.exception(f'Receiver worker {index} crashed: {e}')
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = (index, time.monotonic())
+        logger.info(f'Started receiver worker {index} (pid {pid})')
+
+    def _handle_stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info(f'Receiver supervisor received signal {signum}, stopping workers')
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,75 @@
+"""
+Hashed timer wheel
+
+Many per-key timers that are pushed back on almost every event (e.g. "device
+silent for 10 minutes", reset by each packet). ``slots`` buckets cover
+``tick`` seconds each; a timer lives in the bucket of its deadline with the
+number of full turns left, and rescheduling a key moves it to another bucket,
+so ``schedule`` and ``cancel`` are O(1). ``advance`` visits one bucket per
+elapsed tick and returns the timers that are due.
+
+Deadlines (``now`` + delay) are rounded up to the next tick, so a timer
+fires at most ``tick`` seconds late (plus however far ``advance`` lags) and
+never early. Without ``now`` the delay counts from the last tick processed,
+which is up to a tick (or the lag of ``advance``) in the past.
+"""
+import math
+import threading
+
+
+class TimerWheel:
+    def __init__(self, tick=1.0, slots=3600, now=0.0):
+        self.tick = tick
+        self.slots = slots
+        self._buckets = [dict() for _ in range(slots)]  # key -> [turns left, payload]
+        self._slot_of = {}  # key -> bucket index
+        self._current = int(now // tick)  # last tick processed
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def __contains__(self, key):
+        return key in self._slot_of
+
+    def schedule(self, key, delay, payload=None, now=None):
+        """(Re)start the timer of ``key`` to fire ``delay`` seconds after ``now`` (else the last advance())."""
+        with self._lock:
+            self._remove(key)
+            if now is None:
+                target = self._current + max(1, math.ceil(delay / self.tick))
+            else:
+                target = max(self._current + 1, math.ceil((now + delay) / self.tick))
+            ticks = target - self._current
+            slot = target % self.slots
+            self._buckets[slot][key] = [(ticks - 1) // self.slots, payload]
+            self._slot_of[key] = slot
+
+    def cancel(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    def _remove(self, key):
+        slot = self._slot_of.pop(key, None)
+        if slot is None:
+            return False
+        del self._buckets[slot][key]
+        return True
+
+    def advance(self, now):
+        """Process the ticks up to ``now``; returns [(key, payload)] of the timers that fired."""
+        fired = []
+        target = int(now // self.tick)
+        with self._lock:
+            while self._current < target:
+                self._current += 1
+                bucket = self._buckets[self._current % self.slots]
+                for key in list(bucket):
+                    entry = bucket[key]
+                    if entry[0] > 0:
+                        entry[0] -= 1
+                        continue
+                    del bucket[key]
+                    del self._slot_of[key]
+                    fired.append((key, entry[1]))
+        return fired
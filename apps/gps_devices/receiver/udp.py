@@ -0,0 +1,97 @@
+"""
+UDP socket sizing and kernel drop counters
+
+Datagrams that arrive while the socket's receive buffer is full are dropped
+by the kernel, silently for the receiver. ``set_receive_buffer`` sizes
+``SO_RCVBUF`` and ``UdpSocketStats`` reads what the kernel counted:
+
+    /proc/net/udp, /proc/net/udp6   per socket: rx_queue bytes and drops
+    /proc/net/snmp                  host-wide Udp: InErrors, RcvbufErrors
+
+The socket is matched by inode, so sibling worker processes sharing the port
+(SO_REUSEPORT) each report their own drops. Counters are None where /proc
+is not available (non-Linux).
+"""
+import logging
+import os
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+PROC_UDP = ('/proc/net/udp', '/proc/net/udp6')
+PROC_SNMP = '/proc/net/snmp'
+
+
+def set_receive_buffer(sock, size):
+    """Request an SO_RCVBUF of ``size`` bytes (capped by net.core.rmem_max); returns the effective size."""
+    if size:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        except OSError as e:
+            logger.warning(f'Could not set SO_RCVBUF to {size}: {e}')
+    effective = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if size and effective < size:
+        logger.warning(f'UDP receive buffer is {effective} bytes (asked {size}); raise net.core.rmem_max')
+    return effective
+
+
+def read_socket_counters(inode, paths=PROC_UDP):
+    """(rx_queue bytes, drops) of the UDP socket with this inode, or None if it is not listed."""
+    for path in paths:
+        try:
+            with open(path) as f:
+                lines = f.read().splitlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            # sl local rem st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode ref pointer drops
+            fields = line.split()
+            if len(fields) >= 13 and fields[9] == str(inode):
+                return int(fields[4].split(':')[1], 16), int(fields[12])
+    return None
+
+
+def read_snmp_udp(path=PROC_SNMP):
+    """Host-wide Udp counters from /proc/net/snmp (empty dict if unavailable)."""
+    try:
+        with open(path) as f:
+            lines = [line.split() for line in f if line.startswith('Udp:')]
+    except OSError:
+        return {}
+    if len(lines) < 2:
+        return {}
+    header, values = lines[0][1:], lines[1][1:]
+    return {name: int(value) for name, value in zip(header, values)}
+
+
+class UdpSocketStats:
+    """
+    Datagrams received by the receiver plus the kernel's counters for its socket.
+    ``count`` may be called from several receive threads.
+    """
+
+    def __init__(self, sock):
+        self.inode = os.fstat(sock.fileno()).st_ino
+        self.receive_buffer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self.received = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+
+    def count(self, datagrams, batches=1):
+        with self._lock:
+            self.received += datagrams
+            self.batches += batches
+
+    def snapshot(self):
+        counters = read_socket_counters(self.inode)
+        snmp = read_snmp_udp()
+        return {
+            'received': self.received,
+            'batches': self.batches,
+            'rcvbuf': self.receive_buffer,
+            'rx_queue': counters[0] if counters else None,
+            'socket_drops': counters[1] if counters else None,
+            'host_rcvbuf_errors': snmp.get('RcvbufErrors'),
+            'host_in_errors': snmp.get('InErrors'),
+        }
@@ -0,0 +1,249 @@
+"""
+Write-behind batching for high-volume inserts (LocationData, DeviceState)
+
+Instead of one INSERT + COMMIT per packet, rows are queued and written by a
+background thread with ``bulk_create`` in one transaction every ``max_rows``
+rows or ``max_delay`` seconds, whichever comes first. Callbacks attached to a
+row (broadcast, geocoding) run after the batch commits, when the row has its
+real primary key.
+
+Modes:
+    sync        - save in the caller's thread, callbacks run inline (old behaviour)
+    before_ack  - batched; the packet's ACK waits until its rows are committed
+    after_ack   - batched; ACK immediately, rows are committed shortly after
+
+``with writer.batch():`` writes the rows added by the current thread inside
+the block in one ``bulk_create`` transaction when the block exits (any mode);
+used for multi-record packets such as HQ UPLOAD. If the block raises, its rows
+are not written. Do not open it inside ``transaction.atomic()``: the rows'
+callbacks would run before the outer transaction commits.
+
+Rows are written in the order they were added. A row that references a row
+of another writer passes ``before_write``, run on the writer thread right
+before the insert (e.g. wait for the referenced row and copy its pk), so the
+reference does not force it out of order.
+"""
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MODES = ('sync', 'before_ack', 'after_ack')
+
+
+class PendingWrite:
+    """A queued row; ``instance`` gets its pk once the batch is committed."""
+    __slots__ = ('instance', 'callbacks', 'before_write', 'error', '_done', '_lock')
+
+    def __init__(self, instance, before_write=None):
+        self.instance = instance
+        self.callbacks = []
+        self.before_write = before_write
+        self.error = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def add_callback(self, callback):
+        """Run callback(instance) after commit (immediately if already committed)."""
+        with self._lock:
+            if not self._done.is_set():
+                self.callbacks.append(callback)
+                return
+        if self.error is None:
+            _run_callback(callback, self.instance)
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def complete(self, error=None):
+        with self._lock:
+            self.error = error
+            callbacks, self.callbacks = self.callbacks, []
+            self._done.set()
+        if error is None:
+            for callback in callbacks:
+                _run_callback(callback, self.instance)
+
+
+def _prepare(pending):
+    if pending.before_write is not None:
+        try:
+            pending.before_write(pending.instance)
+        except Exception as e:
+            logger.error(f'Write-behind before_write failed for {pending.instance.__class__.__name__}: {e}')
+
+
+def _run_callback(callback, instance):
+    try:
+        callback(instance)
+    except Exception as e:
+        logger.error(f'Write-behind callback failed for {instance.__class__.__name__}: {e}')
+
+
+class WriteBehindWriter:
+    def __init__(self, model, mode='before_ack', max_rows=500, max_delay=0.05, max_queue=50000, ack_timeout=5.0):
+        if mode not in MODES:
+            raise ValueError(f'Unknown write-behind mode {mode!r} (expected one of {", ".join(MODES)})')
+        self.model = model
+        self.mode = mode
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.ack_timeout = ack_timeout
+        self.rows_written = 0
+        self.rows_failed = 0  # rows that could not be saved (callers compare it around a join())
+        self.batches_written = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._local = threading.local()
+        self._stopped = threading.Event()
+        self._thread = None
+        if mode != 'sync':
+            self._thread = threading.Thread(target=self._run, name=f'GPS_WriteBehind_{model.__name__}', daemon=True)
+            self._thread.start()
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def add(self, instance, callback=None, before_write=None):
+        """
+        Queue an unsaved instance. Blocks when max_queue rows are waiting
+        (backpressure on the receiver instead of unbounded memory).
+        before_write: function(instance) run just before the row is inserted.
+        """
+        pending = PendingWrite(instance, before_write)
+        if callback is not None:
+            pending.callbacks.append(callback)
+        collected = getattr(self._local, 'batch', None)
+        if collected is not None:
+            collected.append(pending)
+            return pending
+        if self._thread is None:
+            try:
+                _prepare(pending)
+                instance.save()
+            except Exception as e:
+                self.rows_failed += 1
+                pending.complete(error=e)
+                raise
+            pending.complete()
+            return pending
+        if self.mode == 'before_ack':
+            self._pending_list().append(pending)
+        self._queue.put(pending)
+        return pending
+
+    def _pending_list(self):
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            pending = self._local.pending = []
+        return pending
+
+    def wait_pending(self):
+        """
+        In before_ack mode, wait until every row queued by the current thread
+        since the last call is committed. Returns False on timeout or failure.
+        """
+        pending, self._local.pending = self._pending_list(), []
+        if self.mode != 'before_ack':
+            return True
+        deadline = time.monotonic() + self.ack_timeout
+        ok = True
+        for item in pending:
+            if not item.wait(max(0.0, deadline - time.monotonic())) or item.error is not None:
+                ok = False
+        return ok
+
+    def forget_pending(self):
+        self._local.pending = []
+
+    @contextmanager
+    def batch(self):
+        """Collect this thread's rows and write them in one transaction at the end of the block."""
+        collected = self._local.batch = []
+        try:
+            yield collected
+        except BaseException as e:
+            self._local.batch = None
+            for item in collected:
+                item.complete(error=e)
+            raise
+        self._local.batch = None
+        if collected:
+            self._write(collected)
+
+    def _run(self):
+        while not (self._stopped.is_set() and self._queue.empty()):
+            try:
+                first = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            batch = [first]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            from django.db import close_old_connections
+
+            close_old_connections()
+            try:
+                self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def join(self):
+        """Block until every row queued so far is committed (or failed)."""
+        self._queue.join()
+
+    def _write(self, batch):
+        from django.db import connections, transaction
+
+        for item in batch:
+            _prepare(item)
+        instances = [item.instance for item in batch]
+        errors = {}
+        try:
+            with transaction.atomic():
+                if connections['default'].features.can_return_rows_from_bulk_insert:
+                    self.model.objects.bulk_create(instances)
+                else:
+                    # Backend cannot return primary keys from a bulk insert (MySQL);
+                    # still a single transaction per batch
+                    for instance in instances:
+                        instance.save()
+        except Exception as e:
+            logger.error(f'Batch insert of {len(batch)} {self.model.__name__} rows failed ({e}); retrying row by row')
+            for item in batch:
+                item.instance.pk = None
+                item.instance._state.adding = True
+                try:
+                    # Savepoint per row: inside an outer transaction one failure must not break the rest
+                    with transaction.atomic():
+                        item.instance.save()
+                except Exception as row_error:
+                    logger.error(f'Failed to save {self.model.__name__}: {row_error}')
+                    errors[id(item)] = row_error
+
+        self.batches_written += 1
+        self.rows_written += len(batch) - len(errors)
+        self.rows_failed += len(errors)
+        for item in batch:
+            item.complete(error=errors.get(id(item)))
+
+    def close(self, timeout=10.0):
+        """Flush queued rows and stop the writer thread."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -0,0 +1,35 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.gps_devices.models import Device, MaliciousPattern
+from apps.gps_devices.receiver.invalidation import invalidate_device, publish_on_commit
+
+# Columns written by the receiver itself; saving only these does not invalidate caches
+RECEIVER_OWNED_FIELDS = {'consecutive_count', 'updated_at'}
+
+
+@receiver(post_save, sender=Device)
+def device_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        return
+    if update_fields and set(update_fields) <= RECEIVER_OWNED_FIELDS:
+        return
+    invalidate_device(device_id=instance.id, imei=instance.imei)
+
+
+@receiver(post_delete, sender=Device)
+def device_deleted(sender, instance, **kwargs):
+    invalidate_device(device_id=instance.id, imei=instance.imei)
+
+
+@receiver(post_save, sender=MaliciousPattern)
+def malicious_pattern_saved(sender, instance, update_fields=None, **kwargs):
+    # Hit statistics do not change what the receiver matches
+    if update_fields and set(update_fields) <= {'hit_count', 'last_hit'}:
+        return
+    publish_on_commit('malicious_patterns')
+
+
+@receiver(post_delete, sender=MaliciousPattern)
+def malicious_pattern_deleted(sender, instance, **kwargs):
+    publish_on_commit('malicious_patterns')
@@ -0,0 +1,1107 @@
+import os
+import pickle
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timezone
+
+from apps.gps_devices.receiver.broadcaster import DeviceBroadcaster
+from apps.gps_devices.receiver.dedup import DedupWindow, packet_key
+from apps.gps_devices.receiver.framing import (
+    FrameBufferOverflow,
+    GT06Framer,
+    HQFramer,
+    JT808Framer,
+    StreamFramer,
+    frame_device_key,
+    is_heartbeat,
+)
+from apps.gps_devices.receiver import invalidation
+from apps.gps_devices.receiver.lbs import CellLocator, cell_of
+from apps.gps_devices.receiver.cell_towers import CellTowerStore, build_cell_store, read_opencellid_csv
+from apps.gps_devices.receiver.ingest_log import IngestLog, IngestLogReader, decode_frame, encode_frame
+from apps.gps_devices.receiver.hot_state import DeviceHotState, HotStateCache, LocationPoint
+from apps.gps_devices.receiver.payload import build_device_payload
+from apps.gps_devices.receiver.presence import PresenceTable, SilenceDetector
+from apps.gps_devices.receiver.timer_wheel import TimerWheel
+from apps.gps_devices.receiver.udp import UdpSocketStats, read_snmp_udp, read_socket_counters
+from apps.gps_devices.receiver.pipeline import KeyedStage, LatencyRecorder, Stage
+from apps.gps_devices.receiver.rate_limit import LocalBucketStore, RateLimiter
+from apps.gps_devices.receiver.registry import DeviceRecord, DeviceRegistry
+from apps.gps_devices.receiver.security import AhoCorasick, MaliciousPatternGuard, PatternMatcher
+from apps.gps_devices.receiver.session import DeviceSession
+from apps.gps_devices.receiver.write_behind import PendingWrite, WriteBehindWriter
+from apps.gps_devices.decoders.GT06_Decoder import GT06Decoder
+from apps.gps_devices.decoders.HQ_Decoder import FLAGS_MAP, HQFlags, HQFullDecoder
+from apps.gps_devices.decoders.JT808_Decoder import JT808Decoder
+from apps.gps_devices.receiver.sharding import ShardRouter, decode_envelope, encode_envelope, shard_for
+
+
+HQ_V1 = b"*HQ,9176515388,V1,150429,A,2928.2347,N,05232.7644,E,0.00,0,201125,fbfffbff,432,35,32645,31251#"
+GT06_LOGIN = bytes.fromhex('78780d010123456789012345000199810d0a')
+JT808_HB = bytes.fromhex('7e000200000123456789010001' + '00' + '7e')
+
+
+class HQFramerTest(unittest.TestCase):
+    """Test cases for HQ text framing"""
+
+    def test_split_frame(self):
+        framer = HQFramer()
+        self.assertEqual(framer.feed(HQ_V1[:20]), [])
+        self.assertEqual(framer.feed(HQ_V1[20:]), [HQ_V1])
+
+    def test_concatenated_frames(self):
+        framer = HQFramer()
+        self.assertEqual(framer.feed(HQ_V1 + HQ_V1 + HQ_V1[:5]), [HQ_V1, HQ_V1])
+        self.assertEqual(framer.feed(HQ_V1[5:]), [HQ_V1])
+
+    def test_garbage_and_truncated_frame(self):
+        framer = HQFramer()
+        self.assertEqual(framer.feed(b'\r\nxx*HQ,123,V1' + HQ_V1), [HQ_V1])
+
+
+class GT06FramerTest(unittest.TestCase):
+    """Test cases for GT06 length-prefixed framing"""
+
+    def test_byte_by_byte(self):
+        framer = GT06Framer()
+        frames = []
+        for i in range(len(GT06_LOGIN)):
+            frames += framer.feed(GT06_LOGIN[i:i + 1])
+        self.assertEqual(frames, [GT06_LOGIN])
+
+    def test_concatenated_frames(self):
+        framer = GT06Framer()
+        self.assertEqual(framer.feed(GT06_LOGIN * 3), [GT06_LOGIN] * 3)
+
+    def test_resync_after_bad_length(self):
+        framer = GT06Framer()
+        broken = b'\x78\x78\x30\x01\x02'
+        self.assertEqual(framer.feed(broken + b'\x00' * 60 + GT06_LOGIN), [GT06_LOGIN])
+
+
+class JT808FramerTest(unittest.TestCase):
+    """Test cases for 0x7E delimited framing"""
+
+    def test_split_and_concatenated(self):
+        framer = JT808Framer()
+        self.assertEqual(framer.feed(JT808_HB + JT808_HB[:4]), [JT808_HB])
+        self.assertEqual(framer.feed(JT808_HB[4:]), [JT808_HB])
+
+    def test_back_to_back_delimiters(self):
+        framer = JT808Framer()
+        self.assertEqual(framer.feed(b'\x7e\x7e' + JT808_HB[1:]), [JT808_HB])
+
+
+class StreamFramerTest(unittest.TestCase):
+    """Test cases for protocol sniffing and sessions"""
+
+    def test_detects_protocol(self):
+        framer = StreamFramer()
+        self.assertEqual(framer.feed(b'\x78'), [])
+        self.assertEqual(framer.feed(GT06_LOGIN[1:]), [GT06_LOGIN])
+        self.assertEqual(framer.protocol, 'GT06')
+
+    def test_unknown_protocol_passthrough(self):
+        framer = StreamFramer()
+        self.assertEqual(framer.feed(b'GET / HTTP/1.1\r\n'), [b'GET / HTTP/1.1\r\n'])
+        self.assertIsNone(framer.protocol)
+
+    def test_buffer_overflow(self):
+        framer = StreamFramer(max_buffer=64)
+        framer.feed(b'*HQ,')
+        with self.assertRaises(FrameBufferOverflow):
+            framer.feed(b'x' * 100)
+
+    def test_session_binds_imei(self):
+        session = DeviceSession(('10.0.0.1', 4000))
+        self.assertEqual(session.feed(HQ_V1), [HQ_V1])
+        session.bind('9176515388')
+        self.assertEqual(session.imei, '9176515388')
+        self.assertEqual(session.protocol, 'HQ')
+        self.assertEqual(session.frames_received, 1)
+
+
+class ShardRouterTest(unittest.TestCase):
+    """Test cases for IMEI-affine routing between workers"""
+
+    def test_shard_is_stable(self):
+        self.assertEqual(shard_for('9176515388', 4), shard_for('9176515388', 4))
+        self.assertEqual(shard_for('9176515388', 1), 0)
+        self.assertEqual({shard_for(str(i), 4) for i in range(200)}, {0, 1, 2, 3})
+
+    def test_envelope_roundtrip(self):
+        payload = encode_envelope('123', GT06_LOGIN, '10.0.0.1', 'tcp')
+        self.assertEqual(decode_envelope(payload), ('123', GT06_LOGIN, '10.0.0.1', 'tcp'))
+        self.assertEqual(decode_envelope(encode_envelope('123', b'x', None, 'mqtt'))[2], None)
+
+    def test_forward_to_owner(self):
+        received = []
+        done = threading.Event()
+
+        def handler(*args):
+            received.append(args)
+            done.set()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            router = ShardRouter(0, 1, socket_dir=tmp)
+            router.start(handler)
+            try:
+                self.assertTrue(router.forward('123', HQ_V1, '10.0.0.1', 'udp'))
+                self.assertTrue(done.wait(2))
+            finally:
+                router.close()
+        self.assertEqual(received, [('123', HQ_V1, '10.0.0.1', 'udp')])
+
+    def test_unreachable_owner_is_not_fatal(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            router = ShardRouter(0, 2, socket_dir=tmp)
+            router.start(lambda *args: None)
+            try:
+                imei = next(str(i) for i in range(100) if not router.owns(str(i)))
+                self.assertFalse(router.forward(imei, HQ_V1, '10.0.0.1', 'udp'))
+            finally:
+                router.close()
+        self.assertEqual(router.snapshot(),
+                         {'forwarded': 0, 'failed': 1, 'received': 0, 'replies': 0, 'expired': 0})
+
+    def test_reply_returns_to_sender(self):
+        replies = []
+        done = threading.Event()
+
+        def handler(imei, data, ip_address, protocol_type, reply_callback=None):
+            reply_callback(b'ACK')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            router = ShardRouter(0, 1, socket_dir=tmp)
+            router.start(handler)
+            try:
+                self.assertTrue(router.forward('123', HQ_V1, '10.0.0.1', 'tcp',
+                                               lambda response: (replies.append(response), done.set())))
+                self.assertTrue(done.wait(2))
+            finally:
+                router.close()
+        self.assertEqual(replies, [b'ACK'])
+        self.assertEqual(router.snapshot()['replies'], 1)
+
+
+class DeviceRegistryTest(unittest.TestCase):
+    """Test cases for the IMEI -> device record cache"""
+
+    def setUp(self):
+        self.loads = []
+
+        def loader(imei):
+            self.loads.append(imei)
+            return DeviceRecord(id=int(imei), imei=imei, status='active', owner_id=1)
+
+        self.registry = DeviceRegistry(max_size=2, ttl=60, loader=loader)
+
+    def test_hit_after_first_load(self):
+        self.assertEqual(self.registry.get('1').owner_id, 1)
+        self.registry.get('1')
+        self.assertEqual(self.loads, ['1'])
+
+    def test_lru_eviction(self):
+        for imei in ('1', '2', '1', '3'):
+            self.registry.get(imei)
+        self.assertIsNotNone(self.registry.peek('1'))
+        self.assertIsNone(self.registry.peek('2'))
+        self.assertEqual(len(self.registry), 2)
+
+    def test_invalidation_by_id_and_clear(self):
+        invalidation.subscribe('device', self.registry.handle_invalidation)
+        try:
+            self.registry.get('1')
+            self.registry.get('2')
+            invalidation.dispatch('device', {'id': 1, 'imei': None})
+            self.assertIsNone(self.registry.peek('1'))
+            invalidation.dispatch('device', None)
+            self.assertEqual(len(self.registry), 0)
+        finally:
+            invalidation.unsubscribe('device', self.registry.handle_invalidation)
+
+    def test_counters_kept_in_cache(self):
+        self.registry.get('1')
+        counts = {'HB': 2}
+        self.registry.update_counters('1', counts)
+        counts['HB'] = 5
+        self.assertEqual(self.registry.peek('1').consecutive_count, {'HB': 2})
+
+
+class FakeLocation:
+    def __init__(self, id, latitude=None, longitude=None, speed=0, satellites=None, signal_strength=None):
+        self.id = id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.speed = speed
+        self.heading = 0
+        self.accuracy = 0
+        self.satellites = satellites
+        self.signal_strength = signal_strength
+        self.created_at = None
+
+
+class FakeDevice:
+    def __init__(self, id):
+        self.id = id
+        self.consecutive_count = {}
+
+
+class DeviceHotStateTest(unittest.TestCase):
+    """Test cases for the per-device in-memory state"""
+
+    def test_ring_buffer_keeps_recent_fixes(self):
+        state = DeviceHotState(1)
+        for i in range(12):
+            state.record_location(FakeLocation(i, 29.0 + i, 52.0, speed=i % 2))
+        self.assertEqual(len(state.points), 9)
+        self.assertEqual(state.last_fix.id, 11)
+        self.assertEqual([p.id for p in state.recent(2)], [11, 10])
+
+    def test_rows_without_coordinates_keep_last_fix(self):
+        state = DeviceHotState(1, points=[LocationPoint(5, '29.5', '52.5')])
+        state.record_location(FakeLocation(6, signal_strength=20))
+        state.record_heartbeat(0, None)
+        self.assertEqual(state.last_fix.id, 5)
+        self.assertEqual(state.last_fix.latitude, 29.5)
+        self.assertEqual(state.last_signal, 20)
+
+    def test_cache_reload_keeps_counters(self):
+        loads = []
+
+        def loader(device):
+            loads.append(device.id)
+            return DeviceHotState(device.id, counters={'HB': 0})
+
+        cache = HotStateCache(max_size=10, ttl=60, loader=loader)
+        device = FakeDevice(1)
+        state = cache.get(device)
+        state.counters['HB'] = 2
+        self.assertIs(cache.get(device), state)
+        state.loaded_at -= 120
+        self.assertEqual(cache.get(device).counters, {'HB': 2})
+        self.assertEqual(loads, [1, 1])
+
+
+
+class DevicePayloadTest(unittest.TestCase):
+    """Test cases for the broadcast payload built from cached state"""
+
+    def setUp(self):
+        self.device = DeviceRecord(id=1, imei='9176515388', name='Car', status='active')
+        self.hot = DeviceHotState(1, points=[LocationPoint(5, '29.5', '52.5')], state_name='Moving',
+                                  last_signal=18, last_satellites=7)
+
+    def test_location_values_win(self):
+        location = FakeLocation(6, 30.0, 53.0, satellites=0, signal_strength=25)
+        data = build_device_payload(self.device, self.hot, location, speed=12, heading=None)
+        self.assertEqual((data['lat'], data['lng'], data['speed'], data['heading']), (30.0, 53.0, 12.0, 0))
+        self.assertEqual((data['satellites'], data['gps_from_cache'], data['gps_valid']), (0, False, False))
+        self.assertEqual((data['signal_strength'], data['gsm_from_cache']), (25, False))
+        self.assertEqual((data['device_state'], data['status_icon']), ('M', 'fa-car'))
+
+    def test_falls_back_to_hot_state(self):
+        data = build_device_payload(self.device, self.hot, FakeLocation(6))
+        self.assertEqual((data['lat'], data['lng']), (29.5, 52.5))
+        self.assertEqual((data['satellites'], data['gps_from_cache']), (7, True))
+        self.assertEqual((data['signal_strength'], data['gsm_from_cache']), (18, True))
+        self.assertEqual(data['imei'], data['device_id'])
+        self.assertIsNone(build_device_payload(self.device)['device_state'])
+
+class FakeRow:
+    saved = 0
+
+    def __init__(self):
+        self.id = None
+
+    def save(self):
+        FakeRow.saved += 1
+        self.id = FakeRow.saved
+
+
+class WriteBehindTest(unittest.TestCase):
+    """Test cases for write-behind callbacks"""
+
+    def test_callbacks_run_after_commit(self):
+        row = FakeRow()
+        pending = PendingWrite(row)
+        seen = []
+        pending.add_callback(lambda r: seen.append(('first', r.id)))
+        self.assertEqual(seen, [])
+        row.id = 7
+        pending.complete()
+        pending.add_callback(lambda r: seen.append(('late', r.id)))
+        self.assertEqual(seen, [('first', 7), ('late', 7)])
+
+    def test_failed_write_skips_callbacks(self):
+        pending = PendingWrite(FakeRow())
+        seen = []
+        pending.add_callback(seen.append)
+        pending.complete(error=ValueError('boom'))
+        self.assertEqual(seen, [])
+        self.assertTrue(pending.wait(0))
+
+    def test_sync_mode_saves_inline(self):
+        writer = WriteBehindWriter(FakeRow, mode='sync')
+        seen = []
+        pending = writer.add(FakeRow(), callback=lambda r: seen.append(r.id))
+        self.assertTrue(pending.done)
+        self.assertEqual(seen, [pending.instance.id])
+        self.assertTrue(writer.wait_pending())
+
+    def test_batch_block_writes_once(self):
+        writer = WriteBehindWriter(FakeRow, mode='sync')
+        batches = []
+
+        def write(batch):
+            batches.append(len(batch))
+            for item in batch:
+                item.complete()
+
+        writer._write = write
+        with writer.batch():
+            first = writer.add(FakeRow())
+            writer.add(FakeRow())
+            self.assertFalse(first.done)
+        self.assertEqual(batches, [2])
+        self.assertTrue(first.done)
+        self.assertTrue(writer.add(FakeRow()).done)  # outside the block: normal path again
+
+    def test_failed_batch_block_writes_nothing(self):
+        writer = WriteBehindWriter(FakeRow, mode='sync')
+        writer._write = lambda batch: self.fail('rows of a failed block were written')
+        seen = []
+        with self.assertRaises(ValueError):
+            with writer.batch():
+                pending = writer.add(FakeRow(), callback=seen.append)
+                raise ValueError('rolled back')
+        self.assertTrue(pending.done)
+        self.assertIsInstance(pending.error, ValueError)
+        self.assertEqual(seen, [])
+
+    def test_failed_rows_are_counted(self):
+        class BrokenRow(FakeRow):
+            def save(self):
+                raise RuntimeError('database is down')
+
+        writer = WriteBehindWriter(BrokenRow, mode='sync')
+        with self.assertRaises(RuntimeError):
+            writer.add(BrokenRow())
+        self.assertEqual(writer.rows_failed, 1)
+
+    def test_before_write_runs_before_insert(self):
+        writer = WriteBehindWriter(FakeRow, mode='sync')
+        seen = []
+        pending = writer.add(FakeRow(), before_write=lambda r: seen.append(r.id))
+        self.assertEqual(seen, [None])
+        self.assertIsNotNone(pending.instance.id)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            WriteBehindWriter(FakeRow, mode='later')
+
+
+class PatternMatcherTest(unittest.TestCase):
+    """Test cases for the compiled MaliciousPattern matcher"""
+
+    ROWS = [
+        {'id': 1, 'pattern': 'GET /', 'pattern_type': 'startswith', 'ip_address': None},
+        {'id': 2, 'pattern': 'bc', 'pattern_type': 'contains', 'ip_address': None},
+        {'id': 3, 'pattern': 'abc', 'pattern_type': 'contains', 'ip_address': '10.0.0.9'},
+        {'id': 4, 'pattern': '2a4851', 'pattern_type': 'startswith', 'ip_address': None},
+        {'id': 5, 'pattern': r'V\d+,9{3}', 'pattern_type': 'regex', 'ip_address': None},
+        {'id': 6, 'pattern': 'ping', 'pattern_type': 'exact', 'ip_address': None},
+        {'id': 7, 'pattern': '', 'pattern_type': 'contains', 'ip_address': '10.0.0.7'},
+        {'id': 8, 'pattern': '([', 'pattern_type': 'regex', 'ip_address': None},
+    ]
+
+    def setUp(self):
+        self.matcher = PatternMatcher(self.ROWS)
+
+    def match_id(self, data, ip='1.2.3.4'):
+        matched = self.matcher.match(ip, data)
+        return matched.id if matched else None
+
+    def test_overlapping_substrings(self):
+        automaton = AhoCorasick()
+        for word in ('he', 'she', 'hers'):
+            automaton.add(word, word)
+        self.assertEqual(sorted(automaton.iter('ushers')), [(1, 'she'), (2, 'he'), (2, 'hers')])
+
+    def test_text_and_hex_forms(self):
+        self.assertEqual(self.match_id(b'GET / HTTP/1.1'), 1)
+        self.assertIsNone(self.match_id(b'x GET /'))
+        self.assertEqual(self.match_id(HQ_V1), 4)
+        self.assertEqual(self.match_id(b'ping'), 6)
+        self.assertIsNone(self.match_id(b'pings'))
+
+    def test_priority_follows_row_order(self):
+        self.assertEqual(self.match_id(b'xxabcxx'), 2)
+        self.assertEqual(self.match_id(b'xx', ip='10.0.0.9'), 3)
+        self.assertEqual(self.match_id(b'bc', ip='10.0.0.9'), 2)
+
+    def test_regex_and_ip_only(self):
+        self.assertEqual(self.match_id(b'#V12,999'), 5)
+        self.assertEqual(self.match_id(GT06_LOGIN, ip='10.0.0.7'), 7)
+        self.assertIsNone(self.match_id(GT06_LOGIN))
+
+    def test_guard_aggregates_hits_and_rebuilds(self):
+        rows = list(self.ROWS[:2])
+        guard = MaliciousPatternGuard(loader=lambda: rows)
+        self.assertEqual(guard.check('1.2.3.4', b'abc').id, 2)
+        guard.check('1.2.3.4', b'abc')
+        rows.pop()
+        self.assertIsNotNone(guard.check('1.2.3.4', b'abc'))
+        guard.invalidate()
+        self.assertIsNone(guard.check('1.2.3.4', b'abc'))
+        self.assertEqual(guard.take_hits()[2][0], 3)
+
+
+class RateLimiterTest(unittest.TestCase):
+    """Test cases for token-bucket rate limiting"""
+
+    def test_burst_then_refill(self):
+        store = LocalBucketStore()
+        key = ('ip', '1.2.3.4')
+        self.assertEqual([store.consume(key, 1.0, 3, now=0) for _ in range(4)], [True, True, True, False])
+        self.assertTrue(store.consume(key, 1.0, 3, now=1.0))
+        self.assertFalse(store.consume(key, 1.0, 3, now=1.5))
+
+    def test_memory_cap_and_idle_eviction(self):
+        store = LocalBucketStore(max_keys=100, idle_ttl=10)
+        for i in range(500):
+            store.consume(('ip', str(i)), 1.0, 5, now=0)
+        self.assertEqual(len(store), 100)
+        store.consume(('ip', 'new'), 1.0, 5, now=20)
+        self.assertEqual(len(store), 1)
+
+    def test_scopes(self):
+        limiter = RateLimiter({'ip': (60, 2), 'imei': (0, 0)})
+        self.assertEqual([limiter.allow('ip', '1.2.3.4') for _ in range(3)], [True, True, False])
+        self.assertTrue(limiter.allow('ip', '5.6.7.8'))
+        self.assertTrue(all(limiter.allow('imei', '123') for _ in range(100)))
+
+
+class FakeChannelLayer:
+    def __init__(self):
+        self.messages = []
+        self.sent = threading.Event()
+
+    async def group_send(self, group, message):
+        self.messages.append((group, message))
+        self.sent.set()
+
+
+class DeviceBroadcasterTest(unittest.TestCase):
+    """Test cases for coalesced WebSocket broadcasting"""
+
+    def test_coalesces_and_batches_per_group(self):
+        layer = FakeChannelLayer()
+        broadcaster = DeviceBroadcaster(channel_layer=layer, window=0.05).start()
+        try:
+            broadcaster.publish(1, ['admins_group', 'user_group_7'], {'id': 1, 'speed': 10})
+            broadcaster.publish(1, ['admins_group', 'user_group_7'], {'id': 1, 'speed': 20})
+            broadcaster.publish(2, ['admins_group'], {'id': 2, 'speed': 5})
+            self.assertTrue(layer.sent.wait(2))
+        finally:
+            broadcaster.close()
+        by_group = {group: message['data'] for group, message in layer.messages}
+        self.assertEqual(by_group['admins_group'], [{'id': 1, 'speed': 20}, {'id': 2, 'speed': 5}])
+        self.assertEqual(by_group['user_group_7'], [{'id': 1, 'speed': 20}])
+        self.assertEqual(layer.messages[0][1]['type'], 'device_updates')
+
+    def test_close_flushes_pending(self):
+        layer = FakeChannelLayer()
+        broadcaster = DeviceBroadcaster(channel_layer=layer, window=30).start()
+        broadcaster.publish(1, ['admins_group'], {'id': 1})
+        broadcaster.close()
+        self.assertEqual(len(layer.messages), 1)
+
+
+class StageTest(unittest.TestCase):
+    """Test cases for bounded pipeline stages"""
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.handled = []
+
+    def handler(self, item):
+        self.started.set()
+        self.release.wait(2)
+        self.handled.append(item)
+
+    def blocked_stage(self, **kwargs):
+        # One worker busy with item 0, so later puts stay queued
+        stage = Stage('test', self.handler, min_workers=1, max_workers=1, **kwargs).start()
+        stage.put(0)
+        self.assertTrue(self.started.wait(2))
+        return stage
+
+    def finish(self, stage):
+        self.release.set()
+        stage.close()
+
+    def test_drop_oldest(self):
+        stage = self.blocked_stage(max_queue=2, policy='drop_oldest')
+        for item in (1, 2, 3):
+            self.assertTrue(stage.put(item))
+        self.finish(stage)
+        self.assertEqual(self.handled, [0, 2, 3])
+        self.assertEqual(stage.metrics()['dropped'], 1)
+
+    def test_drop_calls_handler(self):
+        dropped = []
+        stage = self.blocked_stage(max_queue=1, policy='drop_oldest', on_drop=dropped.append)
+        self.assertTrue(stage.put(1))
+        self.assertTrue(stage.put(2))
+        self.finish(stage)
+        self.assertEqual((self.handled, dropped), ([0, 2], [1]))
+
+    def test_drop_heartbeat_first(self):
+        stage = self.blocked_stage(max_queue=2, policy='drop_heartbeat', is_low_priority=lambda item: item == 'hb')
+        self.assertTrue(stage.put('hb'))
+        self.assertTrue(stage.put(1))
+        self.assertTrue(stage.put(2))  # evicts the queued heartbeat
+        self.assertFalse(stage.put('hb'))  # only data queued: the new heartbeat is refused
+        self.finish(stage)
+        self.assertEqual(self.handled, [0, 1, 2])
+
+    def test_reject_calls_handler(self):
+        rejected = []
+        stage = self.blocked_stage(max_queue=1, policy='reject', on_reject=rejected.append)
+        self.assertTrue(stage.put(1))
+        self.assertFalse(stage.put(2))
+        self.finish(stage)
+        self.assertEqual((self.handled, rejected), ([0, 1], [2]))
+
+    def test_scales_up_on_queue_wait(self):
+        stage = Stage('test', self.handler, min_workers=1, max_workers=3, target_wait=0.01).start()
+        try:
+            stage.put(0)
+            self.assertTrue(self.started.wait(2))
+            stage.put(1)
+            time.sleep(0.05)
+            stage.put(2)
+            self.assertEqual(stage.workers, 2)
+        finally:
+            self.finish(stage)
+        self.assertEqual(sorted(self.handled), [0, 1, 2])
+
+    def test_heartbeat_detection(self):
+        self.assertTrue(is_heartbeat(JT808_HB))
+        self.assertTrue(is_heartbeat(b'*HQ,9176515388,HB,A#'))
+        self.assertTrue(is_heartbeat(bytes.fromhex('78780a134406040001000c7f0d0a')))
+        self.assertFalse(is_heartbeat(HQ_V1))
+        self.assertFalse(is_heartbeat(GT06_LOGIN))
+
+    def test_keyed_stage_orders_per_key(self):
+        handled = []
+        active = set()
+        overlaps = []
+        lock = threading.Lock()
+
+        def handler(item):
+            key, seq = item
+            with lock:
+                if key in active:
+                    overlaps.append(key)
+                active.add(key)
+            time.sleep(0.001)
+            with lock:
+                active.discard(key)
+                handled.append(item)
+
+        stage = KeyedStage('test', handler, key=lambda item: item[0], lanes=4).start()
+        for seq in range(20):
+            for key in ('a', 'b', 'c'):
+                stage.put((key, seq))
+        stage.close()
+        self.assertEqual(overlaps, [])
+        for key in ('a', 'b', 'c'):
+            self.assertEqual([seq for k, seq in handled if k == key], list(range(20)))
+        self.assertEqual(stage.metrics()['processed'], 60)
+
+    def test_frame_device_key(self):
+        self.assertEqual(frame_device_key(HQ_V1), '9176515388')
+        self.assertEqual(frame_device_key(JT808_HB), '012345678901')
+        # Escaped terminal id byte (0x7E sent as 7D 02) and escaped length byte
+        escaped = bytes.fromhex('7e0002007d0101234567' + '7d0201' + '0001' + '00' + '7e')
+        self.assertEqual(frame_device_key(escaped), '012345677e01')
+        self.assertIsNone(frame_device_key(GT06_LOGIN))
+
+    def test_latency_percentiles(self):
+        recorder = LatencyRecorder(size=100)
+        self.assertEqual(recorder.snapshot(), {'count': 0})
+        for ms in range(1, 201):
+            recorder.record(ms / 1000)
+        snapshot = recorder.snapshot()
+        self.assertEqual(snapshot['count'], 200)
+        self.assertEqual((snapshot['p50_ms'], snapshot['max_ms']), (151.0, 200.0))
+
+    def test_jt808_ack_from_header(self):
+        decoder = JT808Decoder()
+        content = bytes.fromhex('000200000123456789010001')
+        frame = b'\x7e' + content + bytes([decoder.calculate_checksum(content)]) + b'\x7e'
+        self.assertEqual(decoder.generate_ack(frame), decoder.decode(frame)['response'])
+        self.assertIsNone(decoder.generate_ack(frame[:-2] + b'\x00\x7e'))  # bad checksum
+
+    def test_jt808_failure_response(self):
+        nak = JT808Decoder().generate_failure_response(JT808_HB)
+        self.assertEqual(nak[1:3], b'\x80\x01')
+        # Body: serial 0001, message id 0002, result 1
+        self.assertEqual(nak[13:18], bytes.fromhex('0001000201'))
+
+
+class IngestLogTest(unittest.TestCase):
+    """Test cases for the segmented ingest log"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.dir = self.tmp.name
+
+    def write(self, count, segment_size=128):
+        log = IngestLog(self.dir, segment_size=segment_size, flush_interval=0, retention=0)
+        offsets = [log.append(b'frame-%d' % i + b'x' * 20, timestamp=1000.0 + i) for i in range(count)]
+        log.close()
+        return offsets
+
+    def test_append_and_read_across_segments(self):
+        self.assertEqual(self.write(7), list(range(7)))
+        self.assertGreater(len([n for n in os.listdir(self.dir) if n.endswith('.log')]), 1)
+        reader = IngestLogReader(self.dir, group='test')
+        records = reader.read(0, max_records=100)
+        reader.close()
+        self.assertEqual([r.offset for r in records], list(range(7)))
+        self.assertEqual(records[3].payload[:7], b'frame-3')
+        self.assertEqual(records[3].timestamp, 1003.0)
+
+    def test_time_lookup_and_commit(self):
+        self.write(7)
+        reader = IngestLogReader(self.dir, group='test')
+        self.assertEqual(reader.offset_for_time(1003.5), 4)
+        self.assertEqual(reader.committed(), 0)
+        reader.commit(3)
+        self.assertEqual(IngestLogReader(self.dir, group='test').committed(), 3)
+        reader.close()
+
+    def test_recovers_from_torn_tail(self):
+        self.write(3, segment_size=4096)
+        segment = os.path.join(self.dir, '%020d.log' % 0)
+        with open(segment, 'r+b') as f:
+            f.seek(2 * 43 + 16 + 3)  # records are 16 + 27 bytes: inside the payload of the last one
+            f.write(b'!')
+        log = IngestLog(self.dir, segment_size=4096, flush_interval=0, retention=0)
+        self.assertEqual(log.next_offset, 2)
+        self.assertEqual(log.append(b'after-crash'), 2)
+        log.close()
+        reader = IngestLogReader(self.dir)
+        self.assertEqual([r.payload[:5] for r in reader.read(0)], [b'frame', b'frame', b'after'])
+        reader.close()
+
+    def test_frame_encoding(self):
+        frame = decode_frame(encode_frame(GT06_LOGIN, '10.0.0.1', 'tcp', connection_id=42, imei='123', processed=True))
+        self.assertEqual(frame.data, GT06_LOGIN)
+        self.assertEqual((frame.ip_address, frame.protocol_type, frame.connection_id), ('10.0.0.1', 'tcp', 42))
+        self.assertEqual((frame.imei, frame.processed), ('123', True))
+        frame = decode_frame(encode_frame(b'x', None, 'mqtt'))
+        self.assertEqual((frame.ip_address, frame.imei, frame.processed), (None, None, False))
+
+
+class DedupWindowTest(unittest.TestCase):
+    """Test cases for the retransmission dedup window"""
+
+    def test_duplicate_within_window(self):
+        dedup = DedupWindow(window=60)
+        key = packet_key('9176515388', '2025-11-20T15:04:29', HQ_V1)
+        self.assertFalse(dedup.seen(key, 'HQ', now=0))
+        self.assertTrue(dedup.seen(key, 'HQ', now=30))
+        # The window counts from the first copy
+        self.assertFalse(dedup.seen(key, 'HQ', now=61))
+        snapshot = dedup.snapshot()
+        self.assertEqual((snapshot['hits'], snapshot['misses'], snapshot['hit_rate']), (1, 2, 0.3333))
+        self.assertEqual(snapshot['hits_by_protocol'], {'HQ': 1})
+
+    def test_key_added_after_save(self):
+        dedup = DedupWindow(window=60)
+        key = packet_key('9176515388', '2025-11-20T15:04:29', HQ_V1)
+        self.assertFalse(dedup.contains(key, now=0))
+        # First copy failed to save: its key was never added, the retransmission is processed
+        self.assertFalse(dedup.contains(key, now=5))
+        dedup.add(key, now=5)
+        self.assertTrue(dedup.contains(key, now=10))
+
+    def test_key_includes_serial_and_timestamp(self):
+        base = packet_key('1', 't1', b'frame', 7)
+        self.assertEqual(base, packet_key('1', 't1', b'frame', 7))
+        self.assertNotEqual(base, packet_key('1', 't1', b'frame', 8))
+        self.assertNotEqual(base, packet_key('1', 't2', b'frame', 7))
+        self.assertNotEqual(base, packet_key('2', 't1', b'frame', 7))
+
+    def test_memory_bound(self):
+        dedup = DedupWindow(window=60, max_entries=3)
+        for key in range(5):
+            dedup.seen(key, now=0)
+        self.assertEqual((len(dedup), dedup.evicted), (3, 2))
+        self.assertFalse(dedup.seen(0, now=1))
+
+
+class PresenceTableTest(unittest.TestCase):
+    """Test cases for the heartbeat presence table"""
+
+    def test_flush_writes_latest_heartbeat_per_device(self):
+        written = []
+        table = PresenceTable(writer=written.append)
+        table.record(1, 100, voltage=4.1, signal_strength=20)
+        table.record(1, 130, voltage=4.0, signal_strength=18)
+        table.record(2, 120)
+        self.assertEqual(table.pending, 2)
+        self.assertEqual(table.flush(), 2)
+        self.assertEqual(sorted((e.device_id, e.last_hb_at) for e in written[0]), [(1, 130), (2, 120)])
+        self.assertEqual(table.flush(), 0)
+        self.assertEqual(table.get(1).signal_strength, 18)
+
+    def test_failed_flush_is_retried(self):
+        def failing(entries):
+            raise RuntimeError('db down')
+
+        table = PresenceTable(writer=failing)
+        table.record(1, 100)
+        self.assertEqual(table.flush(), 0)
+        table.record(1, 160)
+        written = []
+        table.writer = written.append
+        self.assertEqual(table.flush(), 1)
+        self.assertEqual(written[0][0].last_hb_at, 160)
+
+
+    def test_bad_row_does_not_block_flush(self):
+        written = []
+
+        def writer(entries):
+            if any(entry.device_id == 2 for entry in entries):
+                raise RuntimeError('violates foreign key constraint')
+            written.extend(entry.device_id for entry in entries)
+
+        table = PresenceTable(writer=writer)
+        table.record(1, 100)
+        table.record(2, 100)  # device deleted since
+        self.assertEqual(table.flush(), 1)
+        self.assertEqual(written, [1])
+        self.assertIsNone(table.get(2))
+        table.record(1, 130)
+        self.assertEqual(table.flush(), 1)
+        self.assertEqual(written, [1, 1])
+
+    def test_missing_devices_are_forgotten(self):
+        table = PresenceTable(writer=lambda entries: {2})
+        table.record(1, 100)
+        table.record(2, 100)
+        self.assertEqual(table.flush(), 1)
+        self.assertIsNone(table.get(2))
+        self.assertIsNotNone(table.get(1))
+
+
+class TimerWheelTest(unittest.TestCase):
+    """Test cases for the hashed timer wheel and the silence detector"""
+
+    def test_fires_once_at_deadline(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        wheel.schedule('a', 3, payload='A')
+        self.assertEqual(wheel.advance(2.5), [])
+        self.assertEqual(wheel.advance(3.0), [('a', 'A')])
+        self.assertEqual(wheel.advance(20.0), [])
+        self.assertEqual(len(wheel), 0)
+
+    def test_reschedule_and_multiple_turns(self):
+        wheel = TimerWheel(tick=1.0, slots=4)
+        wheel.schedule('a', 2)
+        wheel.schedule('long', 10)
+        wheel.advance(1.0)
+        wheel.schedule('a', 2)  # pushed back by a new packet
+        self.assertEqual(wheel.advance(2.0), [])
+        self.assertEqual([key for key, _ in wheel.advance(3.0)], ['a'])
+        self.assertEqual(wheel.advance(9.0), [])
+        self.assertEqual([key for key, _ in wheel.advance(10.0)], ['long'])
+        wheel.schedule('b', 1)
+        self.assertTrue(wheel.cancel('b'))
+        self.assertEqual(wheel.advance(30.0), [])
+
+    def test_never_fires_early(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        # Scheduled mid-tick, and while advance() lags two ticks behind
+        wheel.schedule('a', 3, now=2.5)
+        self.assertEqual(wheel.advance(5.0), [])
+        self.assertEqual(wheel.advance(6.0), [('a', None)])
+
+    def test_silence_detector(self):
+        now = [0.0]
+        silent = []
+        detector = SilenceDetector(lambda *args: silent.append(args), idle_after=5, offline_after=10,
+                                   clock=lambda: now[0])
+        detector.touch(1, '111')
+        now[0] = 4.0
+        detector.touch(1, '111', location=False)  # heartbeat: alive, but not moving
+        detector.poll()
+        now[0] = 5.0
+        detector.poll()
+        self.assertEqual(silent, [(1, '111', 'idle')])
+        now[0] = 14.0
+        detector.poll()
+        self.assertEqual(silent[-1], (1, '111', 'offline'))
+        self.assertEqual(detector.fired, {'idle': 1, 'offline': 1})
+
+    def test_silence_detector_restarted_timer(self):
+        now = [0.0]
+        detector = SilenceDetector(lambda *args: None, idle_after=5, offline_after=0, clock=lambda: now[0])
+        detector.touch(1, '111')
+        now[0] = 5.0
+        detector.poll()
+        self.assertTrue(detector.is_silent(1, 'idle'))
+        # A packet queued before the handler ran: the device is no longer silent
+        detector.touch(1, '111')
+        self.assertFalse(detector.is_silent(1, 'idle'))
+
+
+PROC_NET_UDP = """\
+   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops
+  120: 00000000:1388 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 4242 2 0000000000000000 0
+  121: 00000000:1388 00000000:0000 07 00000000:00003A00 00:00000000 00000000     0        0 4343 2 0000000000000000 17
+"""
+
+PROC_NET_SNMP = """\
+Ip: Forwarding DefaultTTL
+Ip: 1 64
+Udp: InDatagrams NoPorts InErrors OutDatagrams RcvbufErrors SndbufErrors
+Udp: 1000 3 25 990 21 0
+UdpLite: InDatagrams NoPorts InErrors OutDatagrams RcvbufErrors SndbufErrors
+UdpLite: 0 0 0 0 0 0
+"""
+
+
+class UdpStatsTest(unittest.TestCase):
+    def write(self, text):
+        handle, path = tempfile.mkstemp()
+        with os.fdopen(handle, 'w') as f:
+            f.write(text)
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def test_socket_counters_by_inode(self):
+        path = self.write(PROC_NET_UDP)
+        # Two workers share port 5000 (SO_REUSEPORT); each sees only its own socket
+        self.assertEqual(read_socket_counters(4343, paths=(path,)), (0x3A00, 17))
+        self.assertEqual(read_socket_counters(4242, paths=(path,)), (0, 0))
+        self.assertIsNone(read_socket_counters(1, paths=(path, '/nonexistent')))
+
+    def test_snmp_udp(self):
+        counters = read_snmp_udp(self.write(PROC_NET_SNMP))
+        self.assertEqual(counters['RcvbufErrors'], 21)
+        self.assertEqual(counters['InErrors'], 25)
+        self.assertEqual(read_snmp_udp('/nonexistent'), {})
+
+    def test_snapshot_of_a_real_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(('127.0.0.1', 0))
+        stats = UdpSocketStats(sock)
+        stats.count(3)
+        snapshot = stats.snapshot()
+        self.assertGreater(snapshot['rcvbuf'], 0)
+        self.assertIn('socket_drops', snapshot)
+        self.assertEqual((snapshot['received'], snapshot['batches']), (3, 1))
+
+
+class BinaryDecoderTest(unittest.TestCase):
+    # Location frames from the benchmark_decoders command
+    GT06_LOCATION = bytes.fromhex('787822221805110c1e2d' + 'c8' + '03d3ec60' + '0898bd80' + '3c' + '1432' + '000100000d0a')
+
+    def jt808_location(self, terminal_id='012345678901'):
+        decoder = JT808Decoder()
+        body = (struct.pack('>IIIIHHH', 0, 3, 35700000, 51400000, 1200, 325, 90)
+                + bytes.fromhex('240517123045'))
+        content = struct.pack('>HH', 0x0200, len(body)) + bytes.fromhex(terminal_id) + b'\x00\x07' + body
+        content += bytes([decoder.calculate_checksum(content)])
+        return b'\x7e' + decoder.escape(content) + b'\x7e'
+
+    def test_gt06_location(self):
+        decoded = GT06Decoder().decode(self.GT06_LOCATION)
+        self.assertEqual(decoded['timestamp'], datetime(2024, 5, 17, 12, 30, 45, tzinfo=timezone.utc))
+        self.assertAlmostEqual(decoded['latitude'], 64220256 / 1800000.0)
+        self.assertEqual((decoded['speed'], decoded['heading'], decoded['packet_type']), (60, 50, 'V1'))
+        self.assertIn('error', GT06Decoder().decode(self.GT06_LOCATION[:12] + b'\x0d\x0a'))
+
+    def test_jt808_location_escaped_and_plain(self):
+        decoder = JT808Decoder()
+        plain = decoder.decode(self.jt808_location())
+        self.assertEqual(plain['imei'], '12345678901')
+        self.assertEqual((plain['latitude'], plain['longitude'], plain['speed']), (35.7, 51.4, 32.5))
+        self.assertEqual(plain['timestamp'], datetime(2024, 5, 17, 12, 30, 45, tzinfo=timezone.utc))
+        escaped = self.jt808_location('01234567897e')
+        self.assertIn(b'\x7d\x02', escaped)
+        decoded = decoder.decode(escaped)
+        self.assertEqual(decoded['imei'], '1234567897E')
+        self.assertEqual(decoded['latitude'], 35.7)
+        self.assertEqual(decoder.parse_header(escaped), (0x0200, 7, bytes.fromhex('01234567897e')))
+
+    def test_raw_is_lazy(self):
+        frame = self.jt808_location()
+        decoded = JT808Decoder().decode(frame)
+        self.assertNotIn('raw', dict.keys(decoded))
+        self.assertIn('raw', decoded)
+        self.assertEqual(decoded.get('raw'), frame.hex())
+        # Whole-dict views include it like any other field
+        other = JT808Decoder().decode(frame)
+        self.assertEqual(dict(other)['raw'], frame.hex())
+        self.assertEqual(decoded, other)
+        self.assertIs(type(pickle.loads(pickle.dumps(JT808Decoder().decode(frame)))), dict)
+
+
+class HQFlagsTest(unittest.TestCase):
+    def test_v1_flags(self):
+        decoded = HQFullDecoder().decode(HQ_V1.decode())
+        flags = decoded['flags']
+        self.assertEqual(flags, HQFlags(0xfffbfffb))
+        self.assertEqual(decoded['flags_value'], 0xfffbfffb)
+        self.assertEqual((decoded['acc_on'], decoded['sos_active']), (True, True))
+        # Expanded on demand into the verbose per-bit dicts
+        self.assertEqual(flags[2], {'bit': 2, 'value': False, **FLAGS_MAP[2]})
+        self.assertEqual(len(flags.expand()), 32)
+        self.assertNotIn('charging', flags.active_names())
+
+    def test_from_hex(self):
+        self.assertEqual(HQFlags.from_hex('01000000').value, 1)
+        self.assertEqual(HQFlags.from_hex('01000000', byteorder='big').value, 1 << 24)
+        self.assertEqual(HQFlags.from_hex('0a-00').value, 10)  # cleaned and padded
+        self.assertEqual(HQFlags.from_hex('zz').value, 0)
+
+    def test_v2_alarm_names(self):
+        decoded = HQFullDecoder().decode('*HQ,9176515388,V2,150429,A,09000000,201125#')
+        self.assertEqual(decoded['alarm_info'].active_names(), ['acc_on', 'sos'])
+        self.assertEqual(pickle.loads(pickle.dumps(decoded['alarm_info'])), decoded['alarm_info'])
+
+
+class DecodeManyTest(unittest.TestCase):
+    def test_columns(self):
+        frames = [BinaryDecoderTest.GT06_LOCATION, GT06_LOGIN, b'\x78\x78\x00', BinaryDecoderTest.GT06_LOCATION]
+        columns = GT06Decoder().decode_many(frames)
+        self.assertEqual(columns.frame, [0, 1, 3])
+        self.assertEqual(columns.packet_type, ['V1', 'LOGIN', 'V1'])
+        self.assertEqual(columns.course, [50, None, 50])
+        self.assertEqual([index for index, _ in columns.errors], [2])
+        self.assertEqual(next(columns.rows())['speed'], 60)
+
+    def test_hq_upload_and_text(self):
+        upload = '*HQ,9176515388,UPLOAD,V1:150429:A:2928.2347:N:05232.7644:E:10.00:90:201125:fbfffbff#'
+        columns = HQFullDecoder().decode_many([HQ_V1, upload])
+        self.assertEqual(columns.frame, [0, 1])
+        self.assertEqual(columns.imei, ['9176515388', '9176515388'])
+        self.assertEqual(columns.timestamp[0], datetime(2025, 11, 20, 15, 4, 29, tzinfo=timezone.utc))
+        self.assertEqual(columns.course, [0, 90])
+        self.assertEqual(columns.flags[0], 0xfffbfffb)
+
+    def test_process_pool(self):
+        decoder = JT808Decoder()
+        frames = [BinaryDecoderTest().jt808_location(), JT808_HB] * 5
+        inline = decoder.decode_many(frames, keep_results=True)
+        pooled = decoder.decode_many(frames, processes=2, chunk_size=3, keep_results=True)
+        self.assertEqual(list(pooled.rows()), list(inline.rows()))
+        self.assertEqual(pooled.results, inline.results)
+
+
+class CellLocatorTest(unittest.TestCase):
+    V0 = '*HQ,9176515388,V0,150429,201125,432,11,32645,31251#'
+
+    def test_decode_does_no_lookup(self):
+        decoder = HQFullDecoder()
+        calls = []
+        decoder.lbs.resolve = lambda *args, **kwargs: calls.append((args, kwargs)) or {'lat': 35.7, 'lon': 51.4}
+        decoded = decoder.decode(self.V0)
+        self.assertEqual((decoded['latitude'], decoded['location_resolved_via']), (None, 'pending'))
+        self.assertEqual(calls, [])
+        self.assertEqual(cell_of(decoded), (432, 11, 32645, 31251))
+        decoder.resolve_lbs(decoded)
+        self.assertEqual(calls, [((32645, 31251), {'mcc': 432, 'mnc': 11})])
+        self.assertEqual(decoded['latitude'], 35.7)
+
+    def test_cache_coalescing_and_negative_ttl(self):
+        now = [0.0]
+        queued, lookups, results = [], [], []
+        known = {(432, 11, 1, 1): {'lat': 35.7, 'lon': 51.4, 'provider': 'test'}}
+        locator = CellLocator(lambda *cell: lookups.append(cell) or known.get(cell),
+                              submit=lambda cell: queued.append(cell) or True,
+                              negative_ttl=60, clock=lambda: now[0])
+        self.assertEqual(locator.get((432, 11, 1, 1)), (False, None))
+        locator.request((432, 11, 1, 1), results.append)
+        locator.request((432, 11, 1, 1), results.append)  # shares the lookup in flight
+        locator.request((432, 11, 2, 2), results.append)
+        for cell in queued:
+            locator.resolve_pending(cell)
+        self.assertEqual(len(lookups), 2)
+        self.assertEqual([r and r['lat'] for r in results], [35.7, 35.7, None])
+        self.assertEqual(locator.get((432, 11, 1, 1))[1]['provider'], 'test')
+        self.assertEqual(locator.get((432, 11, 2, 2)), (True, None))  # negative entry
+        now[0] = 61.0
+        self.assertEqual(locator.get((432, 11, 2, 2)), (False, None))
+        self.assertEqual(locator.snapshot()['coalesced'], 1)
+
+    def test_rejected_when_stage_full(self):
+        locator = CellLocator(lambda *cell: None, submit=lambda cell: False)
+        self.assertFalse(locator.request((432, 11, 1, 1), lambda location: None))
+        self.assertEqual(locator.snapshot()['in_flight'], 0)
+
+
+class CellTowerStoreTest(unittest.TestCase):
+    CSV = (
+        'radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,created,updated,averageSignal\n'
+        'GSM,432,11,100,1000,0,51.40,35.70,500,12,1,0,0,0\n'
+        'GSM,432,11,100,1002,0,51.42,35.72,700,3,1,0,0,0\n'
+        'LTE,432,11,100,90000,0,51.50,35.80,1000,9,1,0,0,0\n'
+        'GSM,310,260,100,1000,0,-122.0,37.0,500,1,1,0,0,0\n'
+        'GSM,432,11,bad,row\n'
+    )
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        csv_path = os.path.join(self.dir.name, 'cells.csv')
+        with open(csv_path, 'w') as f:
+            f.write(self.CSV)
+        self.db_path = os.path.join(self.dir.name, 'cells.sqlite3')
+        self.counts = build_cell_store(self.db_path, read_opencellid_csv(csv_path, {432}))
+        self.store = CellTowerStore.open(self.db_path)
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def test_import(self):
+        self.assertEqual(self.counts, (3, 1))
+        self.assertIsNone(CellTowerStore.open(os.path.join(self.dir.name, 'missing.sqlite3')))
+
+    def test_lookup_fallbacks(self):
+        exact = self.store.lookup(432, 11, 100, 1000)
+        self.assertEqual((exact['lat'], exact['lon'], exact['accuracy'], exact['provider']), (35.70, 51.40, 500, 'local'))
+        neighbour = self.store.lookup(432, 11, 100, 1003)
+        self.assertEqual((neighbour['lat'], neighbour['provider']), (35.72, 'local_neighbour'))
+        area = self.store.lookup(432, 11, 100, 50000)
+        self.assertEqual(area['provider'], 'local_lac')
+        self.assertAlmostEqual(area['lat'], (35.70 + 35.72 + 35.80) / 3)
+        self.assertIsNone(self.store.lookup(432, 11, 101, 1000))
+        self.assertIsNone(self.store.lookup(310, 260, 100, 1000))  # other MCCs not imported
+
+    def test_locator_resolves_locally(self):
+        queued = []
+        locator = CellLocator(lambda *cell: None, submit=lambda cell: queued.append(cell) or True,
+                              local_resolver=self.store.lookup)
+        found, location = locator.get((432, 11, 100, 1000))
+        self.assertTrue(found)
+        self.assertEqual(location['provider'], 'local')
+        self.assertEqual(locator.get((432, 11, 101, 1)), (False, None))
+        self.assertEqual(locator.snapshot()['local_hits'], 1)
+        self.assertEqual(locator.get((432, 11, 100, 1000))[1]['provider'], 'local')  # now cached
+        self.assertEqual(locator.snapshot()['hits'], 1)
@@ -175,7 +175,7 @@ def map_v2(request):
         latest_location = device.locations.first()
 
         # Determine status based on latest location
-        status = determine_device_status(latest_location)
+        status = determine_device_status(latest_location, getattr(device, 'presence', None))
 
         device_data.append({
             'id': device.id,
@@ -243,7 +243,7 @@ def api_markers(request):
     payload = []
     for device in devices:
         latest_location = device.locations.first()
-        status = determine_device_status(latest_location)
+        status = determine_device_status(latest_location, getattr(device, 'presence', None))
         payload.append({
             'id': device.id,
             'name': device.name,
@@ -562,8 +562,11 @@ def report(request):
 
     return render(request, 'gps_devices/report.html', context)
 
-def determine_device_status(latest_location):
-    """Determine device status based on latest location data"""
+def determine_device_status(latest_location, presence=None):
+    """Determine device status based on latest location data (and the device presence row, if any)"""
+    if presence is not None and presence.last_seen_at is not None and not presence.online:
+        # Marked offline by the receiver after a period of silence
+        return 'offline'
     if latest_location:
         if latest_location.is_alarm:
             return 'alert'
@@ -571,6 +574,9 @@ def determine_device_status(latest_location):
             return 'moving'
         elif latest_location.packet_type == 'HB':
             return 'idle'
+        elif presence is not None and presence.last_hb_at and presence.last_hb_at > latest_location.created_at:
+            # Heartbeats after the last location (kept in DevicePresence, not LocationData)
+            return 'idle'
         else:
             return 'parked'
     else:
@@ -585,13 +591,13 @@ def build_user_tree(user, is_admin=False):
         user_devices = Device.objects.filter(
             assigned_subuser=user,
             status='active'
-        ).select_related('model')
+        ).select_related('model', 'presence')
     else:
         user_devices = Device.objects.filter(
             owner=user,
             assigned_subuser__isnull=True,
             status='active'
-        ).select_related('model')
+        ).select_related('model', 'presence')
     
     # Get device data with latest location
     devices_list = []
@@ -599,7 +605,7 @@ def build_user_tree(user, is_admin=False):
         latest_location = device.locations.first()
 
         # Determine status based on latest location
-        status = determine_device_status(latest_location)
+        status = determine_device_status(latest_location, getattr(device, 'presence', None))
         
         devices_list.append({
             'id': device.id,
@@ -635,7 +641,7 @@ def build_user_tree(user, is_admin=False):
     return user_node
 
 def build_unowned_devices_node():
-    unowned_devices = Device.objects.filter(owner__isnull=True, status='active').select_related('model')
+    unowned_devices = Device.objects.filter(owner__isnull=True, status='active').select_related('model', 'presence')
 
     if not unowned_devices.exists():
         return None
@@ -643,7 +649,7 @@ def build_unowned_devices_node():
     devices_list = []
     for device in unowned_devices:
         latest_location = device.locations.first()
-        status = determine_device_status(latest_location)
+        status = determine_device_status(latest_location, getattr(device, 'presence', None))
 
         devices_list.append({
             'id': device.id,
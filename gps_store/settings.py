@@ -125,6 +125,8 @@ DATABASES = {
         'PORT': os.getenv('DATABASE_PORT', ''),
         'OPTIONS': {},
         'CONN_MAX_AGE': 60,
+        # Persistent connections are checked before reuse (one extra round trip per request / packet)
+        'CONN_HEALTH_CHECKS': os.getenv('DATABASE_CONN_HEALTH_CHECKS', 'True').lower() == 'true',
         'ATOMIC_REQUESTS': True,
     }
 }
@@ -137,6 +139,27 @@ if database_engine == 'django.db.backends.mysql':
         'charset': 'utf8mb4',
     }
 
+# PostgreSQL connection pool (psycopg 3): threads borrow a connection per packet / request and give it
+# back, instead of each receiver session or worker thread holding its own connection.
+# Needs requirements_pool.txt; with psycopg 3 installed Django uses it instead of psycopg2.
+DATABASE_POOL = os.getenv('DATABASE_POOL', 'False').lower() == 'true'
+if database_engine == 'django.db.backends.postgresql' and DATABASE_POOL:
+    try:
+        from psycopg_pool import ConnectionPool
+    except ImportError:
+        from django.core.exceptions import ImproperlyConfigured
+        raise ImproperlyConfigured('DATABASE_POOL=True needs psycopg 3: pip install -r requirements_pool.txt')
+    DATABASES['default']['CONN_MAX_AGE'] = 0  # required by the pool: closing returns the connection
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.getenv('DATABASE_POOL_MIN_SIZE') or 2),
+        'max_size': int(os.getenv('DATABASE_POOL_MAX_SIZE') or 20),
+        'timeout': float(os.getenv('DATABASE_POOL_TIMEOUT') or 10),  # seconds to wait for a free connection
+        'max_lifetime': float(os.getenv('DATABASE_POOL_MAX_LIFETIME') or 1800),  # recycle connections after this
+        'max_idle': float(os.getenv('DATABASE_POOL_MAX_IDLE') or 300),
+    }
+    # Health check on checkout: broken connections are replaced instead of failing a packet
+    DATABASES['default']['OPTIONS']['pool']['check'] = ConnectionPool.check_connection
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -490,6 +513,72 @@ NESHAN_SERVICE_API_KEY = os.getenv('NESHAN_SERVICE_API_KEY', '')
 NOMINATIM_BASE_URL = os.getenv('NOMINATIM_BASE_URL', 'https://nominatim.openstreetmap.org/reverse')
 OPENCAGE_API_KEY = os.getenv('OPENCAGE_API_KEY', '701355a7d3d84c66a6dec0e8817804b8')
 
+# GPS Receiver Configuration
+GPS_RECEIVER_ENGINE = os.getenv('GPS_RECEIVER_ENGINE', 'threads')  # threads | asyncio
+GPS_RECEIVER_TCP_BACKLOG = int(os.getenv('GPS_RECEIVER_TCP_BACKLOG') or 1024)
+GPS_RECEIVER_MAX_PENDING = int(os.getenv('GPS_RECEIVER_MAX_PENDING') or 2000)
+GPS_RECEIVER_TCP_IDLE_TIMEOUT = float(os.getenv('GPS_RECEIVER_TCP_IDLE_TIMEOUT') or 300)
+GPS_RECEIVER_MAX_TCP_SESSIONS = int(os.getenv('GPS_RECEIVER_MAX_TCP_SESSIONS') or 1000)  # threads engine only
+GPS_UDP_RECEIVE_WORKERS = int(os.getenv('GPS_UDP_RECEIVE_WORKERS') or 1)  # threads engine: threads reading the UDP socket; >1 does not keep per-device order
+GPS_UDP_BATCH_SIZE = int(os.getenv('GPS_UDP_BATCH_SIZE') or 64)  # datagrams drained per wakeup
+GPS_UDP_MAX_DATAGRAM = int(os.getenv('GPS_UDP_MAX_DATAGRAM') or 4096)  # bytes; longer datagrams are truncated
+GPS_UDP_RCVBUF_BYTES = int(os.getenv('GPS_UDP_RCVBUF_BYTES') or 4194304)  # SO_RCVBUF, capped by net.core.rmem_max (0: OS default)
+GPS_RECEIVER_WORKERS = int(os.getenv('GPS_RECEIVER_WORKERS') or 1)  # >1 forks workers sharing the port (SO_REUSEPORT)
+GPS_RECEIVER_SHARD_SOCKET_DIR = os.getenv('GPS_RECEIVER_SHARD_SOCKET_DIR') or None
+GPS_DEVICE_REGISTRY_SIZE = int(os.getenv('GPS_DEVICE_REGISTRY_SIZE') or 50000)
+GPS_DEVICE_REGISTRY_TTL = float(os.getenv('GPS_DEVICE_REGISTRY_TTL') or 300)  # seconds; fallback when invalidations are missed
+GPS_DEVICE_HOT_STATE_SIZE = int(os.getenv('GPS_DEVICE_HOT_STATE_SIZE') or 50000)
+GPS_DEVICE_HOT_STATE_TTL = float(os.getenv('GPS_DEVICE_HOT_STATE_TTL') or 3600)  # seconds before re-reading last fix/state from DB
+GPS_DEVICE_COUNTER_FLUSH_INTERVAL = float(os.getenv('GPS_DEVICE_COUNTER_FLUSH_INTERVAL') or 60)  # seconds between consecutive_count writes
+GPS_LOCATION_WRITE_MODE = os.getenv('GPS_LOCATION_WRITE_MODE', 'before_ack')  # sync | before_ack | after_ack
+GPS_LOCATION_WRITE_BATCH_SIZE = int(os.getenv('GPS_LOCATION_WRITE_BATCH_SIZE') or 500)
+GPS_LOCATION_WRITE_MAX_DELAY_MS = float(os.getenv('GPS_LOCATION_WRITE_MAX_DELAY_MS') or 50)
+GPS_MALICIOUS_HITS_FLUSH_INTERVAL = float(os.getenv('GPS_MALICIOUS_HITS_FLUSH_INTERVAL') or 30)  # seconds between hit_count writes
+# Receiver rate limits (token buckets; PER_MINUTE=0 disables a scope)
+GPS_RATE_LIMIT_IP_PER_MINUTE = float(os.getenv('GPS_RATE_LIMIT_IP_PER_MINUTE') or 20)
+GPS_RATE_LIMIT_IP_BURST = float(os.getenv('GPS_RATE_LIMIT_IP_BURST') or 20)
+GPS_RATE_LIMIT_IMEI_PER_MINUTE = float(os.getenv('GPS_RATE_LIMIT_IMEI_PER_MINUTE') or 0)
+GPS_RATE_LIMIT_IMEI_BURST = float(os.getenv('GPS_RATE_LIMIT_IMEI_BURST') or 0)
+GPS_RATE_LIMIT_PROTOCOL_PER_MINUTE = float(os.getenv('GPS_RATE_LIMIT_PROTOCOL_PER_MINUTE') or 0)
+GPS_RATE_LIMIT_PROTOCOL_BURST = float(os.getenv('GPS_RATE_LIMIT_PROTOCOL_BURST') or 0)
+GPS_RATE_LIMIT_MAX_KEYS = int(os.getenv('GPS_RATE_LIMIT_MAX_KEYS') or 100000)
+GPS_RATE_LIMIT_REDIS_URL = os.getenv('GPS_RATE_LIMIT_REDIS_URL') or None  # shared limits across workers/hosts
+GPS_BROADCAST_WINDOW_MS = float(os.getenv('GPS_BROADCAST_WINDOW_MS') or 250)  # WebSocket updates of a device within the window collapse to the latest
+GPS_BROADCAST_MAX_BATCH = int(os.getenv('GPS_BROADCAST_MAX_BATCH') or 200)
+GPS_RECEIVER_ACK_FIRST = os.getenv('GPS_RECEIVER_ACK_FIRST', 'False').lower() == 'true'  # ACK valid JT808/HQ frames before processing them
+# Staged ingest pipeline: bounded decode/enrich queues, overflow policy drop_oldest | drop_heartbeat | reject
+GPS_PIPELINE_MAX_QUEUE = int(os.getenv('GPS_PIPELINE_MAX_QUEUE') or 10000)
+GPS_PIPELINE_LANES = int(os.getenv('GPS_PIPELINE_LANES') or 16)  # decode lanes keyed by IMEI hash (0: one autoscaled pool, no per-device order)
+GPS_PIPELINE_OVERFLOW_POLICY = os.getenv('GPS_PIPELINE_OVERFLOW_POLICY', 'drop_heartbeat')
+GPS_PIPELINE_MIN_WORKERS = int(os.getenv('GPS_PIPELINE_MIN_WORKERS') or 2)
+GPS_PIPELINE_MAX_WORKERS = int(os.getenv('GPS_PIPELINE_MAX_WORKERS') or 32)
+GPS_PIPELINE_TARGET_WAIT_MS = float(os.getenv('GPS_PIPELINE_TARGET_WAIT_MS') or 200)  # add a worker when packets wait longer
+GPS_PIPELINE_METRICS_INTERVAL = float(os.getenv('GPS_PIPELINE_METRICS_INTERVAL') or 60)  # seconds between queue-depth log lines (0: off)
+GPS_ENRICH_MAX_QUEUE = int(os.getenv('GPS_ENRICH_MAX_QUEUE') or 5000)
+GPS_ENRICH_MAX_WORKERS = int(os.getenv('GPS_ENRICH_MAX_WORKERS') or 20)
+GPS_LBS_MAX_WORKERS = int(os.getenv('GPS_LBS_MAX_WORKERS') or 4)  # concurrent cell lookups (network)
+GPS_LBS_MAX_QUEUE = int(os.getenv('GPS_LBS_MAX_QUEUE') or 1000)
+GPS_LBS_CACHE_SIZE = int(os.getenv('GPS_LBS_CACHE_SIZE') or 100000)  # cells
+GPS_LBS_CACHE_TTL = float(os.getenv('GPS_LBS_CACHE_TTL') or 86400)  # seconds
+GPS_LBS_NEGATIVE_TTL = float(os.getenv('GPS_LBS_NEGATIVE_TTL') or 900)  # seconds an unresolvable cell is not retried
+GPS_CELL_DB_PATH = os.getenv('GPS_CELL_DB_PATH') or str(BASE_DIR / 'cell_towers.sqlite3')  # local cell store (manage.py import_cell_towers)
+GPS_LBS_NETWORK = os.getenv('GPS_LBS_NETWORK', 'True').lower() == 'true'  # query OpenCellID/Mozilla for cells missing locally
+GPS_LBS_PSEUDO_FALLBACK = os.getenv('GPS_LBS_PSEUDO_FALLBACK', 'False').lower() == 'true'  # fake coordinates for unknown cells (dev only)
+GPS_PRESENCE_FLUSH_INTERVAL = float(os.getenv('GPS_PRESENCE_FLUSH_INTERVAL') or 30)  # seconds between DevicePresence upserts
+GPS_IDLE_AFTER_SECONDS = float(os.getenv('GPS_IDLE_AFTER_SECONDS') or 300)  # no location for this long: Idle state (0: off)
+GPS_OFFLINE_AFTER_SECONDS = float(os.getenv('GPS_OFFLINE_AFTER_SECONDS') or 600)  # no packet for this long: Offline state (0: off)
+GPS_DEDUP_WINDOW_SECONDS = float(os.getenv('GPS_DEDUP_WINDOW_SECONDS') or 600)  # retransmitted packets within the window are ACKed, not stored (0: off)
+GPS_DEDUP_MAX_ENTRIES = int(os.getenv('GPS_DEDUP_MAX_ENTRIES') or 100000)
+# Durable ingest log of received frames (unset: off). Mode tee: receiver still processes, log is for replay;
+# consumer: frames that can be ACKed without decoding are only logged and processed by gps_ingest_consumer
+GPS_INGEST_LOG_DIR = os.getenv('GPS_INGEST_LOG_DIR') or None
+GPS_INGEST_LOG_MODE = os.getenv('GPS_INGEST_LOG_MODE', 'tee')
+GPS_INGEST_LOG_SEGMENT_MB = int(os.getenv('GPS_INGEST_LOG_SEGMENT_MB') or 64)
+GPS_INGEST_LOG_FLUSH_INTERVAL_MS = float(os.getenv('GPS_INGEST_LOG_FLUSH_INTERVAL_MS') or 200)
+GPS_INGEST_LOG_RETENTION_HOURS = float(os.getenv('GPS_INGEST_LOG_RETENTION_HOURS') or 72)
+# Redis pub/sub used to invalidate receiver caches when devices change (unset: TTL only)
+GPS_CACHE_INVALIDATION_REDIS_URL = os.getenv('GPS_CACHE_INVALIDATION_REDIS_URL') or os.getenv('REDIS_URL') or None
+
 import logging
 logger.info("Test log from settings.py")
 print("Settings file loaded. LOGGING is configured:", bool(LOGGING))